@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 Matt Settles
+
+Micro benchmarks of the gem barcode correction engines (proc10x/whitelist.py), the
+classification core of process_10xReads.py.
+
+Each engine is timed separately for:
+    load     - building the engine from the whitelist
+    key      - hashing (keying) the barcodes
+    exact    - whitelist lookup of the keys
+    hamming1 - resolving the barcodes that did not match, against the one mismatch neighbours
+    counter  - counting the barcodes of the MATCH and MISMATCH1 reads
+    classify - the complete per read classification and count, as process_10xReads.py does
+over a sweep of barcode error rates (per base substitutions) and batch sizes (the
+barcodes are processed in batches, stage by stage).
+
+Before timing, every engine must classify a fixed corpus (whitelisted barcodes, one and
+two mismatches, barcodes one mismatch from two whitelisted barcodes, N and lower case)
+identically to the current engine, status and corrected barcode, the exit status is 1
+if any differs. --check runs only this check.
+"""
+import sys
+import os
+import time
+import json
+import random
+import socket
+import platform
+import argparse
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from proc10x.whitelist import engines  # noqa: E402
+
+bases = 'ACGT'
+stages = ['key', 'exact', 'hamming1', 'counter', 'classify']
+
+
+def random_seq(rand, length):
+    return ''.join(rand.choice(bases) for i in range(length))
+
+
+def mutate(rand, seq, pos):
+    return seq[:pos] + rand.choice([b for b in bases if b != seq[pos]]) + seq[pos + 1:]
+
+
+def synthetic_whitelist(rand, size, length, pairs):
+    """
+    random whitelist, with pairs of barcodes 2 mismatches apart (midpoints are AMBIGUOUS)
+    """
+    whitelist = set()
+    while len(whitelist) < size - 2 * pairs:
+        whitelist.add(random_seq(rand, length))
+    while len(whitelist) < size:
+        bc = random_seq(rand, length)
+        i, j = rand.sample(range(length), 2)
+        whitelist.add(bc)
+        whitelist.add(mutate(rand, mutate(rand, bc, i), j))
+    return sorted(whitelist)
+
+
+def make_corpus(rand, whitelist, size, error_rate, n_rate):
+    """
+    whitelisted barcodes with per base substitutions at error_rate and N at n_rate
+    """
+    corpus = []
+    for i in xrange(size):
+        bc = list(rand.choice(whitelist))
+        for p in range(len(bc)):
+            r = rand.random()
+            if r < n_rate:
+                bc[p] = 'N'
+            elif r < n_rate + error_rate:
+                bc[p] = rand.choice([b for b in bases if b != bc[p]])
+        corpus.append(''.join(bc))
+    return corpus
+
+
+def check_corpus(rand, whitelist, size):
+    """
+    fixed corpus covering every status and the N/lower case handling
+    """
+    wl = set(whitelist)
+    length = len(whitelist[0])
+    corpus = []
+    for bc in rand.sample(whitelist, min(size, len(whitelist))):
+        i, j = rand.sample(range(length), 2)
+        corpus.append(bc)
+        corpus.append(bc.lower())
+        corpus.append(mutate(rand, bc, i))
+        corpus.append(mutate(rand, mutate(rand, bc, i), j))
+        corpus.append(bc[:i] + 'N' + bc[i + 1:])
+        corpus.append((bc[:i] + 'N' + bc[i + 1:]).lower())
+        corpus.append(random_seq(rand, length))
+        # midpoints of whitelisted barcodes 2 mismatches apart
+        for p in range(length):
+            for b in bases:
+                if b != bc[p]:
+                    other = bc[:p] + b + bc[p + 1:]
+                    for q in range(length):
+                        if q != p:
+                            for c in bases:
+                                if c != other[q] and other[:q] + c + other[q + 1:] in wl:
+                                    corpus.append(other)
+    return corpus
+
+
+def check_engines(loaded, corpus, verbose):
+    """
+    compare (status, corrected barcode) of every engine to the first, returns the number of differences
+    """
+    reference = loaded[0]
+    expected = []
+    for seq in corpus:
+        status, key = reference.classify(seq)
+        expected.append((status, reference.barcode(key) if key is not None else None))
+    if verbose:
+        counts = Counter(status for status, bc in expected)
+        sys.stderr.write("BENCH\tCHECK\t%s\tbarcodes:%i|%s\n" % (reference.name, len(corpus), '|'.join('%s:%i' % (s, counts[s]) for s in ['MATCH', 'MISMATCH1', 'AMBIGUOUS', 'UNKNOWN'])))
+    differences = 0
+    for engine in loaded[1:]:
+        diff = 0
+        for seq, exp in zip(corpus, expected):
+            status, key = engine.classify(seq)
+            got = (status, engine.barcode(key) if key is not None else None)
+            if got != exp:
+                if diff < 10:
+                    sys.stderr.write("BENCH\tMISMATCH\t%s\t%s\t%s:%s\t%s:%s\n" % (engine.name, seq, reference.name, exp, engine.name, got))
+                diff += 1
+        if verbose or diff > 0:
+            sys.stderr.write("BENCH\tCHECK\t%s\t%s\n" % (engine.name, 'identical' if diff == 0 else '%i differences' % diff))
+        differences += diff
+    return differences
+
+
+def time_stages(engine, corpus, batch_size):
+    """
+    seconds of each stage over the corpus, processed in batches
+    """
+    seconds = dict((stage, 0.0) for stage in stages)
+    for b in xrange(0, len(corpus), batch_size):
+        batch = corpus[b:b + batch_size]
+
+        stime = time.time()
+        keys = [engine.key(seq) for seq in batch]
+        seconds['key'] += time.time() - stime
+
+        stime = time.time()
+        exact = [engine.exact(key) for key in keys]
+        seconds['exact'] += time.time() - stime
+
+        other = [seq for seq, e in zip(batch, exact) if not e]
+        stime = time.time()
+        hits = [engine.hamming1(seq) for seq in other]
+        seconds['hamming1'] += time.time() - stime
+
+        counted = [key for key, e in zip(keys, exact) if e] + [h[0] for h in hits if len(h) == 1]
+        counter = Counter()
+        stime = time.time()
+        for key in counted:
+            counter[key] += 1
+        seconds['counter'] += time.time() - stime
+
+        counter = Counter()
+        stime = time.time()
+        for seq in batch:
+            status, key = engine.classify(seq)
+            if key is not None:
+                counter[key] += 1
+        seconds['classify'] += time.time() - stime
+    return seconds
+
+
+def main(options):
+    rand = random.Random(options.seed)
+    if options.whitelist is not None:
+        with open(options.whitelist, 'r') as f:
+            whitelist = [bc.strip() for bc in f if bc.strip() != '']
+    else:
+        whitelist = synthetic_whitelist(rand, options.nbarcodes, options.length, max(1, options.nbarcodes // 100))
+    if options.verbose:
+        sys.stderr.write("BENCH\tWHITELIST\t%i barcodes\n" % len(whitelist))
+
+    loaded = []
+    load_seconds = {}
+    for engine in options.engines:
+        best = None
+        for rep in range(options.repeat):
+            stime = time.time()
+            e = engine(whitelist)
+            seconds = time.time() - stime
+            if best is None or seconds < best:
+                best = seconds
+        loaded.append(e)
+        load_seconds[e.name] = best
+        if options.verbose:
+            sys.stderr.write("BENCH\tLOAD\t%s\tseconds:%.3f\n" % (e.name, best))
+
+    differences = check_engines(loaded, check_corpus(random.Random(options.seed), whitelist, options.check_size), options.verbose)
+    if options.check:
+        sys.exit(1 if differences > 0 else 0)
+
+    results = []
+    for error_rate in options.error_rates:
+        corpus = make_corpus(rand, whitelist, options.nreads, error_rate, options.n_rate)
+        for batch_size in options.batch_sizes:
+            for engine in loaded:
+                best = None
+                for rep in range(options.repeat):
+                    seconds = time_stages(engine, corpus, batch_size)
+                    if best is None:
+                        best = seconds
+                    else:
+                        best = dict((stage, min(best[stage], seconds[stage])) for stage in stages)
+                result = {'engine': engine.name,
+                          'error_rate': error_rate,
+                          'batch_size': batch_size,
+                          'barcodes': len(corpus),
+                          'load_seconds': round(load_seconds[engine.name], 4)}
+                for stage in stages:
+                    result[stage + '_ns'] = int(round(best[stage] * 1e9 / len(corpus)))
+                result['barcodes_per_sec'] = int(round(len(corpus) / best['classify'])) if best['classify'] > 0 else 0
+                results.append(result)
+                if options.verbose:
+                    sys.stderr.write("BENCH\tBARCODES\t%s\terror_rate:%g|batch:%i|%s|barcodes/sec:%i\n" % (engine.name, error_rate, batch_size, '|'.join('%s_ns:%i' % (stage, result[stage + '_ns']) for stage in stages), result['barcodes_per_sec']))
+
+    report = {'version': version_num,
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'host': socket.gethostname(),
+              'python_version': platform.python_version(),
+              'seed': options.seed,
+              'repeat': options.repeat,
+              'whitelist': len(whitelist),
+              'check_differences': differences,
+              'results': results}
+    if options.json is not None:
+        with open(options.json, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write('\n')
+
+    if differences > 0:
+        sys.exit(1)
+
+
+#####################################
+# Parse options and setup #
+version_num = "0.0.1"
+parser = argparse.ArgumentParser(description='bench_barcodes.py, micro benchmarks and equivalence check of the gem barcode correction engines',
+                                 epilog='For questions or comments, please contact Matt Settles <settles@ucdavis.edu>\n%(prog)s version: ' + version_num, add_help=True)
+parser.add_argument('--version', action='version', version="%(prog)s version: " + version_num)
+
+parser.add_argument('-w', '--whitelist', help="barcode whitelist [default: a random whitelist]",
+                    action="store", type=str, dest="whitelist", default=None)
+
+parser.add_argument('--nbarcodes', help="size of the random whitelist [default: %(default)s]",
+                    type=int, dest="nbarcodes", default=100000)
+
+parser.add_argument('--length', help="barcode length of the random whitelist [default: %(default)s]",
+                    type=int, dest="length", default=16)
+
+parser.add_argument('-n', '--nreads', help="barcodes classified per error rate [default: %(default)s]",
+                    type=int, dest="nreads", default=100000)
+
+parser.add_argument('-e', '--error-rates', help="per base barcode error rates, comma separated [default: %(default)s]",
+                    action="store", type=str, dest="error_rates", default="0,0.01,0.05")
+
+parser.add_argument('--n-rate', help="per base rate of N in the barcodes [default: %(default)s]",
+                    type=float, dest="n_rate", default=0.001)
+
+parser.add_argument('-b', '--batch-sizes', help="batch sizes, comma separated [default: %(default)s]",
+                    action="store", type=str, dest="batch_sizes", default="1000,100000")
+
+parser.add_argument('--engines', help="engines to run, comma separated, from %s, the first is the reference of the check [default: all]" % ','.join(e.name for e in engines),
+                    action="store", type=str, dest="engines", default=','.join(e.name for e in engines))
+
+parser.add_argument('-r', '--repeat', help="runs of each measurement, the fastest is reported [default: %(default)s]",
+                    type=int, dest="repeat", default=3)
+
+parser.add_argument('--seed', help="random seed [default: %(default)s]",
+                    type=int, dest="seed", default=1)
+
+parser.add_argument('--check', help="only check that the engines classify identically",
+                    action="store_true", dest="check", default=False)
+
+parser.add_argument('--check-size', help="whitelisted barcodes the check corpus is built from [default: %(default)s]",
+                    type=int, dest="check_size", default=2000)
+
+parser.add_argument('-j', '--json', help="write the results to this file [default: stdout]",
+                    action="store", type=str, dest="json", default=None)
+
+parser.add_argument('--quiet', help="turn off verbose output",
+                    action="store_false", dest="verbose", default=True)
+
+options = parser.parse_args()
+
+options.error_rates = [float(e) for e in options.error_rates.split(',')]
+options.batch_sizes = [int(b) for b in options.batch_sizes.split(',')]
+names = dict((e.name, e) for e in engines)
+for name in options.engines.split(','):
+    if name not in names:
+        sys.exit("BENCH\tERROR\tunknown engine %s\n" % name)
+options.engines = [names[name] for name in options.engines.split(',')]
+
+main(options)
+
+sys.exit(0)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 Matt Settles
+
+Generate synthetic 10x linked reads (raw fastq, as from bcl2fastq/longranger mkfastq),
+deterministic for a given seed, for testing and benchmarking.
+
+Reads are drawn from molecules (random positions on a random reference) of a set of
+whitelisted barcodes. The gem barcode of each read pair is then given a status of
+MATCH, MISMATCH1 (one mismatch from a single whitelisted barcode), AMBIGUOUS (one
+mismatch from more than one whitelisted barcode) or UNKNOWN, in the requested mix.
+
+When no whitelist is given a random whitelist is generated and written to
+[output]_whitelist.txt (use with process_10xReads.py -w). --sam also writes the
+reference ([output]_ref.fa) and the bwa mem -C style sam of the processed reads
+([output].sam, the read comment appended as bwa mem -C does), for samConcat2Tag.py.
+"""
+import sys
+import os
+import time
+import random
+import argparse
+from subprocess import Popen, PIPE
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from proc10x.sam import revcomp  # noqa: E402
+
+bases = 'ACGT'
+
+
+def sp_gzip_write(file, bufsize=-1):
+    filep = open(file, 'wb')
+    p = Popen(['gzip', '-1'], stdin=PIPE, stdout=filep, bufsize=bufsize)
+    filep.close()
+    return p
+
+
+def random_seq(rand, length):
+    return ''.join(rand.choice(bases) for i in range(length))
+
+
+def neighbors(seq):
+    """
+    the sequences one mismatch away
+    """
+    res = []
+    for i in range(len(seq)):
+        for b in bases:
+            if b != seq[i]:
+                res.append(seq[:i] + b + seq[i + 1:])
+    return res
+
+
+def whitelist_hits(seq, whitelist):
+    return sum(1 for n in neighbors(seq) if n in whitelist)
+
+
+class BarcodeMaker:
+    """
+    produce read barcodes of each status, checked against the whitelist with the same
+    rules as process_10xReads.py
+    """
+    def __init__(self, rand, whitelist, length, ambiguous=None, max_search=2000):
+        self.rand = rand
+        self.whitelist = whitelist
+        self.wl_list = sorted(whitelist)
+        self.length = length
+        if ambiguous is None:
+            ambiguous = self.find_ambiguous(max_search)
+        self.ambiguous = sorted(a for a in ambiguous if a not in whitelist and whitelist_hits(a, whitelist) > 1)
+
+    def find_ambiguous(self, max_search, want=100):
+        """
+        barcodes one mismatch from two whitelisted barcodes, from whitelisted barcodes
+        that have another whitelisted barcode two mismatches away
+        """
+        found = set()
+        for n in range(max_search):
+            bc = self.rand.choice(self.wl_list)
+            for i in range(self.length):
+                for j in range(i + 1, self.length):
+                    for bi in bases:
+                        if bi == bc[i]:
+                            continue
+                        for bj in bases:
+                            if bj == bc[j]:
+                                continue
+                            other = bc[:i] + bi + bc[i + 1:j] + bj + bc[j + 1:]
+                            if other in self.whitelist:
+                                found.add(bc[:i] + bi + bc[i + 1:])
+            if len(found) >= want:
+                break
+        return found
+
+    def mismatch1(self, bc):
+        for n in range(100):
+            i = self.rand.randrange(self.length)
+            seq = bc[:i] + self.rand.choice(bases.replace(bc[i], '')) + bc[i + 1:]
+            if seq not in self.whitelist and whitelist_hits(seq, self.whitelist) == 1:
+                return seq
+        return None
+
+    def unknown(self):
+        while True:
+            seq = random_seq(self.rand, self.length)
+            if seq not in self.whitelist and whitelist_hits(seq, self.whitelist) == 0:
+                return seq
+
+
+def main(options):
+    rand = random.Random(options.seed)
+    stime = time.time()
+    bclen = options.bclen
+
+    # whitelist
+    if options.whitelist is not None:
+        with open(options.whitelist, 'r') as f:
+            whitelist = set(line.strip() for line in f if line.strip() != '')
+        ambiguous = None
+    else:
+        whitelist = set()
+        while len(whitelist) < options.whitelist_size:
+            whitelist.add(random_seq(rand, bclen))
+        # plant pairs two mismatches apart, the barcodes between them are AMBIGUOUS
+        ambiguous = set()
+        for bc in rand.sample(sorted(whitelist), min(100, len(whitelist))):
+            i, j = sorted(rand.sample(range(bclen), 2))
+            amb = bc[:i] + rand.choice(bases.replace(bc[i], '')) + bc[i + 1:]
+            whitelist.add(amb[:j] + rand.choice(bases.replace(bc[j], '')) + amb[j + 1:])
+            ambiguous.add(amb)
+        with open(options.output + '_whitelist.txt', 'w') as f:
+            for bc in sorted(whitelist):
+                f.write(bc + '\n')
+    maker = BarcodeMaker(rand, whitelist, bclen, ambiguous)
+
+    # status mix
+    mix = [('MATCH', options.match), ('MISMATCH1', options.mismatch1), ('AMBIGUOUS', options.ambiguous), ('UNKNOWN', options.unknown)]
+    if len(maker.ambiguous) == 0 and options.ambiguous > 0:
+        sys.stderr.write("GENERATE\tWARNING\tno AMBIGUOUS barcodes in the whitelist, generating UNKNOWN instead\n")
+        mix = [('MATCH', options.match), ('MISMATCH1', options.mismatch1), ('UNKNOWN', options.unknown + options.ambiguous)]
+    total = float(sum(m[1] for m in mix))
+    cumulative = []
+    acc = 0.0
+    for status, frac in mix:
+        acc += frac / total
+        cumulative.append((acc, status))
+
+    # reference and molecules
+    contig_size = options.genome_size // options.contigs
+    reference = [random_seq(rand, contig_size) for i in range(options.contigs)]
+    barcodes = rand.sample(maker.wl_list, min(options.barcodes, len(maker.wl_list)))
+    molecules = {}
+    for bc in barcodes:
+        molecules[bc] = [(rand.randrange(options.contigs), rand.randrange(max(1, contig_size - options.molecule_length))) for i in range(options.molecules)]
+
+    qualities = [''.join(rand.choice('AFJ<-') for i in range(max(options.read_length, options.read2_length))) for j in range(1000)]
+    r1len = options.read_length - bclen - options.trim
+
+    if options.sam:
+        with open(options.output + '_ref.fa', 'w') as f:
+            for i, seq in enumerate(reference):
+                f.write('>contig%i\n' % (i + 1))
+                for j in range(0, len(seq), 80):
+                    f.write(seq[j:j + 80] + '\n')
+        sam = open(options.output + '.sam', 'w')
+        for i in range(options.contigs):
+            sam.write('@SQ\tSN:contig%i\tLN:%i\n' % (i + 1, contig_size))
+        sam.write('@PG\tID:bwa\tPN:bwa\tVN:0.7.13\tCL:generate_10xReads.py\n')
+
+    counts = dict((status, 0) for status, frac in mix)
+    lane_reads = -(-options.reads // options.lanes)
+    read_number = 0
+    for lane in range(1, options.lanes + 1):
+        prefix = '%s_S1_L%03i' % (options.output, lane)
+        R1p = sp_gzip_write(prefix + '_R1_001.fastq.gz')
+        R2p = sp_gzip_write(prefix + '_R2_001.fastq.gz')
+        R1, R2 = R1p.stdin, R2p.stdin
+        for n in range(min(lane_reads, options.reads - read_number)):
+            read_number += 1
+            bc = rand.choice(barcodes)
+            contig, start = rand.choice(molecules[bc])
+            insert = max(r1len, options.read2_length, int(rand.gauss(options.insert_size, options.insert_sd)))
+            pos = start + rand.randrange(max(1, options.molecule_length - insert))
+            pos = min(pos, contig_size - insert)
+            frag = reference[contig][pos:pos + insert]
+            reverse = rand.random() < 0.5
+            if reverse:
+                frag = revcomp(frag)
+
+            r = rand.random()
+            status = [s for c, s in cumulative if r < c]
+            status = status[0] if len(status) > 0 else cumulative[-1][1]
+            read_bc = bc
+            if status == 'MISMATCH1':
+                read_bc = maker.mismatch1(bc)
+                if read_bc is None:
+                    read_bc = bc
+                    status = 'MATCH'
+            elif status == 'AMBIGUOUS':
+                read_bc = rand.choice(maker.ambiguous)
+            elif status == 'UNKNOWN':
+                read_bc = maker.unknown()
+            counts[status] += 1
+
+            primer = random_seq(rand, options.trim)
+            seq1 = read_bc + primer + frag[:r1len]
+            seq2 = revcomp(frag)[:options.read2_length]
+            qual1 = rand.choice(qualities)[:len(seq1)]
+            qual2 = rand.choice(qualities)[:len(seq2)]
+            rid = 'SYN:1:HSYNTHXX:%i:1101:%i:%i' % (lane, read_number % 30000, read_number)
+            R1.write('@%s 1:N:0:%s\n%s\n+\n%s\n' % (rid, options.library_bc, seq1, qual1))
+            R2.write('@%s 2:N:0:%s\n%s\n+\n%s\n' % (rid, options.library_bc, seq2, qual2))
+
+            if options.sam:
+                # as process_10xReads.py -a | bwa mem -p -C would produce
+                name = '%s:%s' % (bc if status in ('MATCH', 'MISMATCH1') else read_bc, rid)
+                comment = '_'.join([status, read_bc, qual1[:bclen], primer, qual1[bclen:bclen + options.trim]])
+                rname = 'contig%i' % (contig + 1)
+                pos1 = pos + 1 if not reverse else pos + insert - r1len + 1
+                pos2 = pos + insert - options.read2_length + 1 if not reverse else pos + 1
+                tlen = insert if pos1 <= pos2 else -insert
+                seq1s, qual1s = frag[:r1len], qual1[bclen + options.trim:]
+                seq2s, qual2s = seq2, qual2
+                if reverse:
+                    seq1s, qual1s = revcomp(seq1s), qual1s[::-1]
+                else:
+                    seq2s, qual2s = revcomp(seq2s), qual2s[::-1]
+                sam.write('\t'.join([name, str(83 if reverse else 99), rname, str(pos1), '60', '%iM' % r1len, '=', str(pos2), str(tlen),
+                                     seq1s, qual1s, 'NM:i:0', 'MD:Z:%i' % r1len, 'AS:i:%i' % r1len, 'XS:i:0',
+                                     '1:N:0:%s:%s' % (options.library_bc, comment)]) + '\n')
+                sam.write('\t'.join([name, str(163 if reverse else 147), rname, str(pos2), '60', '%iM' % len(seq2), '=', str(pos1), str(-tlen),
+                                     seq2s, qual2s, 'NM:i:0', 'MD:Z:%i' % len(seq2), 'AS:i:%i' % len(seq2), 'XS:i:0',
+                                     '2:N:0:%s:%s' % (options.library_bc, comment)]) + '\n')
+        R1.close()
+        R2.close()
+        R1p.wait()
+        R2p.wait()
+    if options.sam:
+        sam.close()
+
+    if options.verbose:
+        sys.stderr.write("GENERATE\tREADS\treads:%i|lanes:%i|barcodes:%i|molecules/barcode:%i|seconds:%i\n" % (read_number, options.lanes, len(barcodes), options.molecules, round(time.time() - stime)))
+        for status, frac in mix:
+            sys.stderr.write("GENERATE\tBARCODE\t%s: %i\n" % (status, counts[status]))
+
+
+#####################################
+# Parse options and setup #
+version_num = "0.0.1"
+parser = argparse.ArgumentParser(description='generate_10xReads.py, generate synthetic 10x linked read fastq files (and optionally bwa style sam)',
+                                 epilog='For questions or comments, please contact Matt Settles <settles@ucdavis.edu>\n%(prog)s version: ' + version_num, add_help=True)
+parser.add_argument('--version', action='version', version="%(prog)s version: " + version_num)
+
+parser.add_argument('-o', '--output', help="Directory + prefix of the output files [default: %(default)s]",
+                    action="store", type=str, dest="output", default="synthetic")
+
+parser.add_argument('-n', '--reads', help="number of read pairs [default: %(default)s]",
+                    type=int, dest="reads", default=100000)
+
+parser.add_argument('--lanes', help="number of lanes (file pairs) to split the reads over [default: %(default)s]",
+                    type=int, dest="lanes", default=1)
+
+parser.add_argument('--seed', help="random seed [default: %(default)s]",
+                    type=int, dest="seed", default=1)
+
+parser.add_argument('-w', '--whitelist', help="barcode whitelist to draw barcodes from [default: generate one]",
+                    action="store", type=str, dest="whitelist", default=None)
+
+parser.add_argument('--whitelist-size', help="size of the generated whitelist [default: %(default)s]",
+                    type=int, dest="whitelist_size", default=100000)
+
+parser.add_argument('--barcodes', help="number of (whitelisted) barcodes with molecules [default: %(default)s]",
+                    type=int, dest="barcodes", default=1000)
+
+parser.add_argument('--molecules', help="molecules per barcode [default: %(default)s]",
+                    type=int, dest="molecules", default=10)
+
+parser.add_argument('--molecule-length', help="molecule length [default: %(default)s]",
+                    type=int, dest="molecule_length", default=50000)
+
+parser.add_argument('--genome-size', help="reference size [default: %(default)s]",
+                    type=int, dest="genome_size", default=2000000)
+
+parser.add_argument('--contigs', help="number of reference contigs [default: %(default)s]",
+                    type=int, dest="contigs", default=4)
+
+parser.add_argument('--read-length', help="read 1 length, including gem barcode and primer [default: %(default)s]",
+                    type=int, dest="read_length", default=150)
+
+parser.add_argument('--read2-length', help="read 2 length [default: %(default)s]",
+                    type=int, dest="read2_length", default=150)
+
+parser.add_argument('--insert-size', help="mean insert size [default: %(default)s]",
+                    type=int, dest="insert_size", default=350)
+
+parser.add_argument('--insert-sd', help="insert size standard deviation [default: %(default)s]",
+                    type=int, dest="insert_sd", default=50)
+
+parser.add_argument('--bclen', help="gem barcode length [default: %(default)s]",
+                    type=int, dest="bclen", default=16)
+
+parser.add_argument('--trim', help="primer length after the gem barcode [default: %(default)s]",
+                    type=int, dest="trim", default=7)
+
+parser.add_argument('--library-bc', help="library (sample) barcode [default: %(default)s]",
+                    action="store", type=str, dest="library_bc", default="CCGATTAA")
+
+parser.add_argument('--match', help="fraction of MATCH barcodes [default: %(default)s]",
+                    type=float, dest="match", default=0.85)
+
+parser.add_argument('--mismatch1', help="fraction of MISMATCH1 barcodes [default: %(default)s]",
+                    type=float, dest="mismatch1", default=0.09)
+
+parser.add_argument('--ambiguous', help="fraction of AMBIGUOUS barcodes [default: %(default)s]",
+                    type=float, dest="ambiguous", default=0.01)
+
+parser.add_argument('--unknown', help="fraction of UNKNOWN barcodes [default: %(default)s]",
+                    type=float, dest="unknown", default=0.05)
+
+parser.add_argument('--sam', help="also write the reference and bwa mem -C style sam of the processed reads [default: %(default)s]",
+                    action="store_true", dest="sam", default=False)
+
+parser.add_argument('--quiet', help="turn off verbose output",
+                    action="store_false", dest="verbose", default=True)
+
+options = parser.parse_args()
+
+if options.read_length <= options.bclen + options.trim:
+    sys.exit("GENERATE\tERROR\tread 1 length must be longer than the gem barcode and primer\n")
+
+main(options)
+
+sys.exit(0)
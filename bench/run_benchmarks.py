@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 Matt Settles
+
+End to end benchmarks of the proc10xG scripts on synthetic data (generate_10xReads.py).
+
+For every input size the synthetic reads (and sam) are generated once, then each
+stage is run as its own process and timed:
+    process   - process_10xReads.py -a (with the synthetic whitelist)
+    filter    - filter_10xReads.py on the processed reads
+    regen     - regen_10xReads.py on the processed reads
+    samconcat - samConcat2Tag.py on the bwa mem -C style sam
+
+Reported per stage: wall seconds, user/sys cpu seconds, reads (pairs) per second and
+peak resident memory of the stage process.
+
+Start up is timed separately (the fastest of --startup-repeat runs), on the data of
+the first size:
+    SCRIPT --version   - interpreter and module imports of each script
+    process_first_read - process_10xReads.py --nreads 1, imports, whitelist load and the
+                         inputs opened, the fixed cost of every run
+
+Output settings are timed on the data of the last size, regen_10xReads.py (the lightest
+stage, so the output cost shows most) on the processed reads, for each of --output-settings
+(nogzip, -g, or a gzip --compress-level) and --block-sizes. Reported: wall seconds,
+reads per second and the bytes written.
+
+Results are written as JSON (--json), a previous result file can be given as a
+baseline (--baseline) to flag stages or output settings whose reads/sec dropped, or
+start ups whose seconds grew, by more than --threshold.
+"""
+import sys
+import os
+import glob
+import json
+import time
+import shutil
+import socket
+import platform
+import argparse
+from subprocess import Popen
+
+bench_path = os.path.dirname(os.path.realpath(__file__))
+repo_path = os.path.dirname(bench_path)
+
+stages = ['process', 'filter', 'regen', 'samconcat']
+scripts = {'process': 'process_10xReads.py', 'filter': 'filter_10xReads.py', 'regen': 'regen_10xReads.py', 'samconcat': 'samConcat2Tag.py'}
+
+
+def run_timed(cmd, log, stdout=None):
+    """
+    run cmd, returns wall seconds and the resource usage of the process (and its waited children)
+    """
+    with open(log, 'w') as err:
+        out = open(os.devnull, 'w') if stdout is None else open(stdout, 'w')
+        stime = time.time()
+        p = Popen(cmd, stdout=out, stderr=err)
+        pid, status, usage = os.wait4(p.pid, 0)
+        seconds = time.time() - stime
+        out.close()
+    if status != 0:
+        sys.stderr.write("BENCH\tERROR\t%s failed, see %s\n" % (' '.join(cmd), log))
+        sys.exit(1)
+    return seconds, usage
+
+
+def stage_command(stage, python, data, work):
+    if stage == 'process':
+        return [python, os.path.join(repo_path, 'process_10xReads.py'), '-a', '-w', data + '_whitelist.txt', '-o', work + '_process',
+                '-1', data + '_S1_L001_R1_001.fastq.gz', '-2', data + '_S1_L001_R2_001.fastq.gz'], None
+    if stage == 'filter':
+        return [python, os.path.join(repo_path, 'filter_10xReads.py'), '-o', work + '_filter',
+                '-1', work + '_process_R1_001.fastq.gz', '-2', work + '_process_R2_001.fastq.gz'], None
+    if stage == 'regen':
+        return [python, os.path.join(repo_path, 'regen_10xReads.py'), '-o', work + '_regen',
+                '-1', work + '_process_R1_001.fastq.gz', '-2', work + '_process_R2_001.fastq.gz'], None
+    if stage == 'samconcat':
+        return [python, os.path.join(repo_path, 'samConcat2Tag.py'), data + '.sam'], None
+    raise ValueError(stage)
+
+
+def startup_commands(python, data, work):
+    """
+    (name, command) of the start up measurements
+    """
+    commands = [(stage + ' --version', [python, os.path.join(repo_path, scripts[stage]), '--version']) for stage in stages]
+    commands.append(('process_first_read', [python, os.path.join(repo_path, 'process_10xReads.py'), '-w', data + '_whitelist.txt', '-o', work + '_startup', '--nreads', '1',
+                                            '-1', data + '_S1_L001_R1_001.fastq.gz', '-2', data + '_S1_L001_R2_001.fastq.gz']))
+    return commands
+
+
+def output_command(python, work, setting, block_kb):
+    """
+    regen_10xReads.py of the processed reads with an output setting, nogzip or a gzip level
+    """
+    cmd = [python, os.path.join(repo_path, 'regen_10xReads.py'), '-o', work + '_output', '--block-size', str(block_kb),
+           '-1', work + '_process_R1_001.fastq.gz', '-2', work + '_process_R2_001.fastq.gz']
+    if setting == 'nogzip':
+        return cmd + ['-g']
+    return cmd + ['--compress-level', setting]
+
+
+def compare(results, startup, output, baseline, threshold):
+    """
+    report the change in reads/sec and start up seconds against a baseline result file, returns the number of regressions
+    """
+    with open(baseline, 'r') as f:
+        previous = json.load(f)
+    base = dict(((r['size'], r['stage']), r) for r in previous['results'])
+    base_startup = dict((r['name'], r) for r in previous.get('startup', []))
+    base_output = dict(((r['size'], r['setting'], r['block_kb']), r) for r in previous.get('output', []))
+    regressions = 0
+    for r in startup:
+        b = base_startup.get(r['name'])
+        if b is None or b['seconds'] == 0:
+            continue
+        change = r['seconds'] / b['seconds'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '\tREGRESSION'
+            regressions += 1
+        sys.stderr.write("BENCH\tBASELINE\t%s\tseconds:%.3f -> %.3f (%+.1f%%)%s\n" % (r['name'], b['seconds'], r['seconds'], change * 100, flag))
+    for r in results:
+        b = base.get((r['size'], r['stage']))
+        if b is None or b['reads_per_sec'] == 0:
+            continue
+        change = float(r['reads_per_sec']) / b['reads_per_sec'] - 1
+        flag = ''
+        if change < -threshold:
+            flag = '\tREGRESSION'
+            regressions += 1
+        sys.stderr.write("BENCH\tBASELINE\t%s\t%i\treads/sec:%i -> %i (%+.1f%%)%s\n" % (r['stage'], r['size'], b['reads_per_sec'], r['reads_per_sec'], change * 100, flag))
+    for r in output:
+        b = base_output.get((r['size'], r['setting'], r['block_kb']))
+        if b is None or b['reads_per_sec'] == 0:
+            continue
+        change = float(r['reads_per_sec']) / b['reads_per_sec'] - 1
+        flag = ''
+        if change < -threshold:
+            flag = '\tREGRESSION'
+            regressions += 1
+        sys.stderr.write("BENCH\tBASELINE\toutput %s block_kb:%i\t%i\treads/sec:%i -> %i (%+.1f%%)%s\n" % (r['setting'], r['block_kb'], r['size'], b['reads_per_sec'], r['reads_per_sec'], change * 100, flag))
+    return regressions
+
+
+def main(options):
+    python = options.python
+    if not os.path.isdir(options.workdir):
+        os.makedirs(options.workdir)
+    results = []
+    startup = []
+    output = []
+    for size in options.sizes:
+        data = os.path.join(options.workdir, 'synthetic_%i' % size)
+        work = os.path.join(options.workdir, 'run_%i' % size)
+        if not os.path.isfile(data + '.sam'):
+            seconds, usage = run_timed([python, os.path.join(bench_path, 'generate_10xReads.py'), '--quiet', '--sam', '--seed', str(options.seed),
+                                        '-n', str(size), '-o', data], data + '_generate.log')
+            if options.verbose:
+                sys.stderr.write("BENCH\tGENERATE\t%i reads in %.1f seconds\n" % (size, seconds))
+        if size == options.sizes[0] and options.startup_repeat > 0:
+            for name, cmd in startup_commands(python, data, work):
+                best = None
+                for rep in range(options.startup_repeat):
+                    seconds, usage = run_timed(cmd, work + '_startup.log')
+                    if best is None or seconds < best[0]:
+                        best = (seconds, usage)
+                seconds, usage = best
+                startup.append({'name': name,
+                                'seconds': round(seconds, 4),
+                                'max_rss_kb': usage.ru_maxrss})
+                if options.verbose:
+                    sys.stderr.write("BENCH\tSTARTUP\t%s\tseconds:%.3f|max_rss_mb:%.1f\n" % (name, seconds, usage.ru_maxrss / 1024.0))
+        for stage in options.stages:
+            cmd, stdout = stage_command(stage, python, data, work)
+            best = None
+            for rep in range(options.repeat):
+                seconds, usage = run_timed(cmd, work + '_' + stage + '.log', stdout)
+                if best is None or seconds < best[0]:
+                    best = (seconds, usage)
+            seconds, usage = best
+            result = {'size': size,
+                      'stage': stage,
+                      'seconds': round(seconds, 3),
+                      'user': round(usage.ru_utime, 3),
+                      'sys': round(usage.ru_stime, 3),
+                      'reads_per_sec': int(round(size / seconds)),
+                      'max_rss_kb': usage.ru_maxrss}
+            results.append(result)
+            if options.verbose:
+                sys.stderr.write("BENCH\tSTAGE\t%s\t%i\tseconds:%.2f|user:%.2f|sys:%.2f|reads/sec:%i|max_rss_mb:%.1f\n" % (stage, size, seconds, usage.ru_utime, usage.ru_stime, result['reads_per_sec'], usage.ru_maxrss / 1024.0))
+        if size == options.sizes[-1] and len(options.output_settings) > 0:
+            if not os.path.isfile(work + '_process_R1_001.fastq.gz'):
+                cmd, stdout = stage_command('process', python, data, work)
+                run_timed(cmd, work + '_process.log', stdout)
+            for setting in options.output_settings:
+                for block_kb in options.block_sizes:
+                    best = None
+                    for rep in range(options.repeat):
+                        seconds, usage = run_timed(output_command(python, work, setting, block_kb), work + '_output.log')
+                        if best is None or seconds < best[0]:
+                            best = (seconds, usage)
+                    seconds, usage = best
+                    result = {'size': size,
+                              'setting': setting,
+                              'block_kb': block_kb,
+                              'seconds': round(seconds, 3),
+                              'reads_per_sec': int(round(size / seconds)),
+                              'output_bytes': sum(os.path.getsize(f) for f in glob.glob(work + '_output_*'))}
+                    output.append(result)
+                    if options.verbose:
+                        sys.stderr.write("BENCH\tOUTPUT\t%s\tblock_kb:%i\t%i\tseconds:%.2f|reads/sec:%i|output_mb:%.1f\n" % (setting, block_kb, size, seconds, result['reads_per_sec'], result['output_bytes'] / 1024.0**2))
+                    for f in glob.glob(work + '_output_*'):
+                        os.remove(f)
+
+    report = {'version': version_num,
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'host': socket.gethostname(),
+              'python': python,
+              'python_version': platform.python_version(),
+              'seed': options.seed,
+              'repeat': options.repeat,
+              'startup': startup,
+              'results': results,
+              'output': output}
+    if options.json is not None:
+        with open(options.json, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write('\n')
+
+    regressions = 0
+    if options.baseline is not None:
+        regressions = compare(results, startup, output, options.baseline, options.threshold)
+    if not options.keep:
+        shutil.rmtree(options.workdir)
+    if regressions > 0:
+        sys.exit(1)
+
+
+#####################################
+# Parse options and setup #
+version_num = "0.0.1"
+parser = argparse.ArgumentParser(description='run_benchmarks.py, end to end benchmarks of the proc10xG scripts on synthetic 10x reads',
+                                 epilog='For questions or comments, please contact Matt Settles <settles@ucdavis.edu>\n%(prog)s version: ' + version_num, add_help=True)
+parser.add_argument('--version', action='version', version="%(prog)s version: " + version_num)
+
+parser.add_argument('-s', '--sizes', help="input sizes (read pairs), comma separated [default: %(default)s]",
+                    action="store", type=str, dest="sizes", default="10000,100000")
+
+parser.add_argument('--stages', help="stages to run, comma separated, from %s [default: all]" % ','.join(stages),
+                    action="store", type=str, dest="stages", default=','.join(stages))
+
+parser.add_argument('-r', '--repeat', help="runs of each stage, the fastest is reported [default: %(default)s]",
+                    type=int, dest="repeat", default=1)
+
+parser.add_argument('--startup-repeat', help="runs of each start up measurement, the fastest is reported, 0 to skip them [default: %(default)s]",
+                    type=int, dest="startup_repeat", default=5)
+
+parser.add_argument('--output-settings', help="output settings timed with regen, nogzip or gzip levels, comma separated, empty to skip [default: %(default)s]",
+                    action="store", type=str, dest="output_settings", default="nogzip,1,6")
+
+parser.add_argument('--block-sizes', help="--block-size (KiB) of each output setting, comma separated [default: %(default)s]",
+                    action="store", type=str, dest="block_sizes", default="64,1024")
+
+parser.add_argument('-w', '--workdir', help="directory for the synthetic data and outputs [default: %(default)s]",
+                    action="store", type=str, dest="workdir", default="bench_work")
+
+parser.add_argument('--keep', help="keep the working directory (synthetic data is reused when kept) [default: %(default)s]",
+                    action="store_true", dest="keep", default=False)
+
+parser.add_argument('--seed', help="random seed of the synthetic data [default: %(default)s]",
+                    type=int, dest="seed", default=1)
+
+parser.add_argument('--python', help="python interpreter to run the scripts with [default: this interpreter]",
+                    action="store", type=str, dest="python", default=sys.executable)
+
+parser.add_argument('-j', '--json', help="write the results to this file [default: stdout]",
+                    action="store", type=str, dest="json", default=None)
+
+parser.add_argument('-b', '--baseline', help="previous results to compare to, exit status 1 on a regression",
+                    action="store", type=str, dest="baseline", default=None)
+
+parser.add_argument('--threshold', help="fractional drop in reads/sec (or growth in start up seconds) reported as a regression [default: %(default)s]",
+                    type=float, dest="threshold", default=0.1)
+
+parser.add_argument('--quiet', help="turn off verbose output",
+                    action="store_false", dest="verbose", default=True)
+
+options = parser.parse_args()
+
+options.sizes = [int(s) for s in options.sizes.split(',')]
+options.stages = options.stages.split(',')
+options.output_settings = [s for s in options.output_settings.split(',') if s != '']
+options.block_sizes = [int(s) for s in options.block_sizes.split(',')]
+for setting in options.output_settings:
+    if setting != 'nogzip' and setting not in [str(level) for level in range(1, 10)]:
+        sys.exit("BENCH\tERROR\tunknown output setting %s, nogzip or a gzip level 1 to 9\n" % setting)
+for stage in options.stages:
+    if stage not in stages:
+        sys.exit("BENCH\tERROR\tunknown stage %s\n" % stage)
+
+main(options)
+
+sys.exit(0)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 Matt Settles
+
+Merge whitelisted barcode count files ([output]_barcodes.txt from process_10xReads.py,
+text or binary) of many runs/lanes into a single count file, sorted by barcode.
+
+With a whitelist (-w) counts are summed into an array indexed by the whitelist
+ordinal (memory is fixed by the whitelist size). Without a whitelist the files
+are k-way merged, files that are not sorted are first sorted (one at a time)
+into a temporary binary run, so memory is bounded by the largest single input.
+"""
+import traceback
+import argparse
+import sys
+import os
+import time
+import heapq
+import shutil
+import tempfile
+from array import array
+from bisect import bisect_left
+
+from proc10x.barcodes import read_counts, seq_to_code, BinaryCountWriter, TextCountWriter
+from proc10x.metrics import RunMetrics
+
+
+def input_length(path):
+    for code, count, length in read_counts(path):
+        return length
+    return None
+
+
+def is_sorted(path):
+    last = -1
+    for code, count, length in read_counts(path):
+        if code < last:
+            return False
+        last = code
+    return True
+
+
+def sorted_run(path, tmpdir, length):
+    """
+    sort an input into a temporary binary run, returns the run file name
+    """
+    records = sorted((code, count) for code, count, l in read_counts(path))
+    fd, run = tempfile.mkstemp(prefix='merge_barcodes_', suffix='.bin', dir=tmpdir)
+    os.close(fd)
+    out = BinaryCountWriter(run, length)
+    for code, count in records:
+        out.write(code, count)
+    out.close()
+    return run
+
+
+def sum_sorted(stream):
+    """
+    sum the counts of consecutive equal codes of a sorted (code, count, length) stream
+    """
+    code = None
+    total = 0
+    for c, count, length in stream:
+        if c != code:
+            if code is not None:
+                yield code, total
+            code = c
+            total = 0
+        total += count
+    if code is not None:
+        yield code, total
+
+
+def merge_whitelist(inputs, whitelist, out, verbose):
+    """
+    sum counts into a whitelist ordinal array
+    """
+    with open(whitelist, 'r') as f:
+        codes = array('L', sorted(seq_to_code(bc.strip()) for bc in f if bc.strip() != ''))
+    counts = array('L', [0]) * len(codes)
+    if verbose:
+        sys.stderr.write("MERGE\tNOTE\tFinished reading in barcode whitelist (%i barcodes)\n" % len(codes))
+    unknown = 0
+    for path in inputs:
+        for code, count, length in read_counts(path):
+            i = bisect_left(codes, code)
+            if i < len(codes) and codes[i] == code:
+                counts[i] += count
+            else:
+                unknown += count
+        if verbose:
+            sys.stderr.write("MERGE\tFILES\t%s\n" % path)
+    barcodes = 0
+    for i in xrange(len(codes)):
+        if counts[i] > 0:
+            out.write(codes[i], counts[i])
+            barcodes += 1
+    if unknown > 0:
+        sys.stderr.write("MERGE\tWARNING\t%i reads of barcodes not in the whitelist were dropped\n" % unknown)
+    return barcodes
+
+
+def merge_sorted(inputs, tmpdir, length, out, verbose):
+    """
+    k-way merge of the inputs, sorting the unsorted ones first
+    """
+    tmpdir = tempfile.mkdtemp(prefix='merge_barcodes_', dir=tmpdir)
+    try:
+        runs = []
+        for path in inputs:
+            if is_sorted(path):
+                runs.append(path)
+            else:
+                runs.append(sorted_run(path, tmpdir, length))
+                if verbose:
+                    sys.stderr.write("MERGE\tFILES\t%s (sorted)\n" % path)
+        barcodes = 0
+        for code, count in sum_sorted(heapq.merge(*[read_counts(run) for run in runs])):
+            out.write(code, count)
+            barcodes += 1
+    finally:
+        shutil.rmtree(tmpdir)
+    return barcodes
+
+
+def main(inputs, output, binary, whitelist, tmpdir, verbose, metrics_file=None):
+    stime = time.time()
+    # a snapshot is written at the start and the end of the merge
+    done = {'barcodes': None, 'files': len(inputs)}
+    metrics = None
+    if metrics_file is not None:
+        metrics = RunMetrics(metrics_file, 'merge', lambda: {'barcodes': done['barcodes'],
+                                                             'queues': {'files': done['files']}}, run=output)
+    lengths = set(input_length(path) for path in inputs) - set([None])
+    if len(lengths) > 1:
+        sys.exit("MERGE\tERROR\tbarcode files have different barcode lengths: %s\n" % ','.join(str(l) for l in lengths))
+    length = lengths.pop() if len(lengths) == 1 else 16
+
+    if binary:
+        if output == 'stdout':
+            sys.exit("MERGE\tERROR\tbinary output requires an output file (-o)\n")
+        out = BinaryCountWriter(output, length)
+    else:
+        out = TextCountWriter(output, length)
+
+    try:
+        if whitelist is not None:
+            barcodes = merge_whitelist(inputs, whitelist, out, verbose)
+        else:
+            barcodes = merge_sorted(inputs, tmpdir, length, out, verbose)
+        out.close()
+    except (KeyboardInterrupt, SystemExit):
+        if metrics is not None:
+            metrics.finish('failed')
+        sys.exit("MERGE\tERROR\t%s unexpectedly terminated\n" % (__name__))
+    except Exception:
+        if metrics is not None:
+            metrics.finish('failed')
+        sys.stderr.write("".join(traceback.format_exception(*sys.exc_info())))
+        sys.exit("MERGE\tERROR\tAn unknown fatal error was encountered.\n")
+
+    if metrics is not None:
+        done['barcodes'] = barcodes
+        done['files'] = 0
+        metrics.finish()
+    if verbose:
+        sys.stderr.write("MERGE\tBARCODES\tfiles:%i|barcodes:%i|seconds:%i\n" % (len(inputs), barcodes, round(time.time() - stime)))
+
+
+#####################################
+# Parse options and setup #
+version_num = "0.0.1"
+parser = argparse.ArgumentParser(description='merge_barcodes.py, merge (sum) barcode count files produced by process_10xReads.py, output is sorted by barcode',
+                                 epilog='For questions or comments, please contact Matt Settles <settles@ucdavis.edu>\n%(prog)s version: ' + version_num, add_help=True)
+parser.add_argument('--version', action='version', version="%(prog)s version: " + version_num)
+
+parser.add_argument('-o', '--output', help="output barcode count file, [default: %(default)s]",
+                    action="store", type=str, dest="output", default="stdout")
+
+parser.add_argument('-b', '--binary', help="write the compact binary format (loaded faster by filter_10xReads.py) [default: %(default)s]",
+                    action="store_true", dest="binary", default=False)
+
+parser.add_argument('-w', '--whitelist', help="sum into the barcode whitelist, rather than merging the sorted files [default: %(default)s]",
+                    action="store", type=str, dest="whitelist", default=None)
+
+parser.add_argument('-T', '--tmpdir', help="directory for sorted runs of unsorted inputs [default: system temp]",
+                    action="store", type=str, dest="tmpdir", default=None)
+
+parser.add_argument('--quiet', help="turn off verbose output",
+                    action="store_false", dest="verbose", default=True)
+
+parser.add_argument('--metrics', help="write run metrics to this file (at the start and end), JSON or Prometheus text format if the name ends in .prom [default: %(default)s]",
+                    action="store", type=str, dest="metrics", default=None)
+
+parser.add_argument('inputs', metavar="barcodes.txt", help="barcode count files (text or binary) to merge",
+                    nargs='+')
+
+options = parser.parse_args()
+
+main(options.inputs, options.output, options.binary, options.whitelist, options.tmpdir, options.verbose, options.metrics)
+
+sys.exit(0)
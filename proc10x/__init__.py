@@ -0,0 +1,5 @@
+"""
+Copyright 2018 Matt Settles
+
+Shared code for the proc10xG scripts
+"""
@@ -0,0 +1,151 @@
+"""
+Copyright 2018 Matt Settles
+
+Whitelisted barcode counts ([output]_barcodes.txt), in text (barcode<TAB>count) or
+compact binary form, and the 2 bit barcode codes used to sort and merge them.
+
+The code of a barcode packs the first base in the most significant bits, so codes
+sort in the same order as the barcode strings. seq_to_hash is the (reversed)
+packing used as the dictionary key by process_10xReads.py and filter_10xReads.py.
+
+binary count file:
+    magic '10XBCNT1', uint32 barcode length, then blocks of
+    uint32 n, n uint64 codes, n uint32 counts (little endian)
+"""
+import sys
+import struct
+import string
+
+MAGIC = '10XBCNT1'
+BLOCK = 65536
+
+_code_table = string.maketrans('ACGTacgt' + ''.join(chr(i) for i in range(256) if chr(i) not in 'ACGTacgt'),
+                               '01230123' + '0' * 248)
+_base = 'ACGT'
+# reverse of the 8 bases (16 bits) of a code
+_rev8 = None
+
+
+def seq_to_code(seq):
+    """
+    2 bit code of the barcode, first base most significant (N defaults to A)
+    """
+    return int(seq.translate(_code_table), 4)
+
+
+def seq_to_hash(seq):
+    """
+    same value as seqToHash, first base least significant (N defaults to A)
+    """
+    return int(seq[::-1].translate(_code_table), 4)
+
+
+def code_to_seq(code, length):
+    seq = []
+    for i in range(length):
+        seq.append(_base[code & 3])
+        code >>= 2
+    return ''.join(reversed(seq))
+
+
+def code_to_hash(code, length):
+    """
+    seq_to_hash(code_to_seq(code, length)) without building the string
+    """
+    global _rev8
+    if _rev8 is None:
+        _rev8 = [seq_to_hash(code_to_seq(c, 8)) for c in range(65536)]
+    code <<= 2 * ((-length) % 8)
+    h = 0
+    for i in range((length + 7) // 8):
+        h = (h << 16) | _rev8[code & 0xFFFF]
+        code >>= 16
+    return h
+
+
+def is_binary(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_binary_blocks(path):
+    """
+    yields (length, codes, counts) blocks of a binary count file
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a binary barcode count file: %s" % path)
+        length = struct.unpack('<I', f.read(4))[0]
+        while True:
+            head = f.read(4)
+            if len(head) < 4:
+                break
+            n = struct.unpack('<I', head)[0]
+            codes = struct.unpack('<%iQ' % n, f.read(8 * n))
+            counts = struct.unpack('<%iI' % n, f.read(4 * n))
+            yield length, codes, counts
+
+
+def read_counts(path):
+    """
+    yields (code, count, length) of a text or binary barcode count file, in file order,
+    single column text files (barcode lists) have a count of 0
+    """
+    if is_binary(path):
+        for length, codes, counts in read_binary_blocks(path):
+            for code, count in zip(codes, counts):
+                yield code, count, length
+    else:
+        with open(path, 'r') as f:
+            for line in f:
+                line2 = line.rstrip('\n').split('\t')
+                if line2[0] == '':
+                    continue
+                yield seq_to_code(line2[0]), int(line2[1]) if len(line2) > 1 else 0, len(line2[0])
+
+
+class BinaryCountWriter:
+    """
+    write (code, count) pairs to a binary count file, in blocks
+    """
+    def __init__(self, path, length):
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC + struct.pack('<I', length))
+        self.codes = []
+        self.counts = []
+
+    def write(self, code, count):
+        self.codes.append(code)
+        self.counts.append(count)
+        if len(self.codes) >= BLOCK:
+            self.flush()
+
+    def flush(self):
+        n = len(self.codes)
+        if n > 0:
+            self.f.write(struct.pack('<I', n) + struct.pack('<%iQ' % n, *self.codes) + struct.pack('<%iI' % n, *self.counts))
+        self.codes = []
+        self.counts = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+class TextCountWriter:
+    """
+    write (code, count) pairs as barcode<TAB>count lines, path may be stdout
+    """
+    def __init__(self, path, length):
+        if path == 'stdout':
+            self.f = sys.stdout
+        else:
+            self.f = open(path, 'w')
+        self.length = length
+
+    def write(self, code, count):
+        self.f.write('%s\t%i\n' % (code_to_seq(code, self.length), count))
+
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
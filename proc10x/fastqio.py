@@ -0,0 +1,702 @@
+"""
+Copyright 2018 Matt Settles
+
+Reading and writing paired fastq files, shared by process_10xReads.py, filter_10xReads.py
+and regen_10xReads.py (and the gzip helpers by samConcat2Tag.py and scatter_10xReads.py).
+
+    sp_gzip_read / sp_gzip_write - gzip subprocesses, (de)compression runs alongside python,
+                                   reading and writing through a pipe, sp_gzip_wait checks
+                                   the gzip exit status
+    TwoReadIlluminaRun - the input, read 1 and read 2 files (several pairs read in the order
+                         given) or interleaved files or stdin, possibly gzipped
+    IlluminaTwoReadOutput - the output, paired, interleaved or supernova (R1, R2 and I1)
+                            files, possibly gzipped, or stdout (interleaved)
+
+A read pair is a fragment dict (id, status, library_bc, gem_bc, sgem_bc, sgem_qual,
+trim_seq, trim_qual, read1_seq, read1_qual, read2_seq, read2_qual). next_raw parses raw 10x
+reads (gem barcode and trim at the start of read 1), next_processed parses reads written
+by process_10xReads.py (barcode, status and trim in the read ids). raw_batch and
+processed_batch return lists of reads, for reading on a thread (--pipeline).
+
+Inputs are read with block_size (default BUFFER_SIZE) buffers. Output records are collected
+into block_size blocks (BlockWriter) written in one call to the unbuffered binary file or
+gzip pipe, gzip compresses at the given level (1 fastest, 9 smallest, gzip's default 6).
+"""
+import os
+import sys
+import glob
+import errno
+from subprocess import Popen, PIPE, STDOUT
+
+from proc10x.timing import TimedWriter
+from proc10x.progress import InputProgress
+
+BUFFER_SIZE = 1024 * 1024
+
+
+def sp_gzip_read(file, bufsize=BUFFER_SIZE, stderr=STDOUT):
+    """
+    returns the gzip process, read from its stdout, pass stderr=PIPE to keep gzip
+    messages out of the records (then check with sp_gzip_wait once read)
+    """
+    p = Popen(['gzip', '--decompress', '--to-stdout', file], stdout=PIPE, stderr=stderr, bufsize=bufsize)
+    return p
+
+
+def sp_gzip_write(file, bufsize=BUFFER_SIZE, mode='wb', level=None):
+    """
+    returns the gzip process, write to its stdin, mode 'ab' appends a new gzip member,
+    level is the gzip compression level (1-9, default 6)
+    """
+    filep = open(file, mode)
+    p = Popen(['gzip'] + (['-%i' % level] if level is not None else []), stdin=PIPE, stdout=filep, bufsize=bufsize)
+    filep.close()
+    return p
+
+
+def sp_gzip_wait(p, file):
+    """
+    close the gzip process pipes and wait on it, raises IOError if gzip did not exit cleanly
+    """
+    message = ''
+    if p.stdin is not None:
+        p.stdin.close()
+    if p.stdout is not None:
+        p.stdout.close()
+    if p.stderr is not None:
+        message = p.stderr.read().strip()
+        p.stderr.close()
+    if p.wait() != 0:
+        raise IOError("gzip exited with status %i on %s %s" % (p.returncode, file, message))
+
+
+class BlockWriter:
+    """
+    collect writes into blocks of at least block_size bytes, each written to f (an unbuffered
+    binary file or pipe) in a single call
+    """
+    def __init__(self, f, block_size=BUFFER_SIZE):
+        self.f = f
+        self.block_size = block_size
+        self.buf = []
+        self.size = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.size += len(data)
+        if self.size >= self.block_size:
+            self.f.write(''.join(self.buf))
+            self.buf = []
+            self.size = 0
+
+    def flush(self):
+        if self.size > 0:
+            self.f.write(''.join(self.buf))
+            self.buf = []
+            self.size = 0
+        self.f.flush()
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+def make_sure_path_exists(path):
+    """
+    Try and create a path, if not error
+    """
+    if path != '':
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+    return path
+
+
+def infer_read_file_name(baseread, seakread):
+    ''' Find other read filenames (ex. R1, R2, R3, R4) in the directory based on Read 1 filename '''
+    basename = os.path.basename(baseread)
+    path = os.path.dirname(os.path.realpath(baseread))
+    testname = glob.glob(path + '/*' + os.path.splitext(baseread)[1])
+    count = 0
+    pos = -1
+    read = []
+    for name in testname:
+        count = 0
+        if os.path.basename(name) == basename:  # ignore the same file
+            continue
+        elif len(os.path.basename(name)) != len(basename):  # must be the same length
+            continue
+        else:
+            for i, (ch1, ch2) in enumerate(zip(os.path.basename(name), basename)):  # calculate the hamming distance
+                if ch1 != ch2 and ch2 == '1' and ch1 == seakread:
+                    count += 1
+                    pos = i
+            if count == 1:
+                read.append(path + '/' + basename[0:pos] + seakread + basename[pos + 1:])
+                continue
+    if len(read) == 1:
+        return read[0]
+    else:
+        raise Exception("Error inferring read " + seakread + " from read 1, found " + str(len(read)) + " suitable matches.")
+
+
+def resolve_read_files(read1, read2, interleaved=False, tag='PROCESS'):
+    """
+    Expand the read 1 and read 2 paths (with glob), read 2 is inferred from read 1 when not
+    given, returns the lists of read 1 and read 2 files (read 2 None when interleaved)
+    """
+    fread1 = []
+    fread2 = []
+    for fread in read1:
+        fread1.extend(glob.glob(fread))
+        if len(fread1) == 0 or not all(os.path.isfile(f) for f in fread1):
+            sys.stderr.write('%s\tERROR:[TwoReadIlluminaRun] read1 file(s) not found\n' % tag)
+            raise Exception
+    if interleaved:
+        return fread1, None
+    if read2 is None:
+        for fread in fread1:
+            fread2.append(infer_read_file_name(fread, "2"))
+    else:
+        for fread in read2:
+            fread2.extend(glob.glob(fread))
+            if len(fread2) == 0 or not all(os.path.isfile(f) for f in fread2):
+                sys.stderr.write('%s\tERROR:[TwoReadIlluminaRun] read2 file not found\n' % tag)
+                raise Exception
+    if len(fread1) != len(fread2):
+        sys.stderr.write('%s\tERROR:[TwoReadIlluminaRun] Inconsistent number of files for each read\n' % tag)
+        raise Exception
+    return fread1, fread2
+
+
+def open_read_file(filename, bufsize=BUFFER_SIZE):
+    """
+    Open an input file (sys.stdin is passed through), if file ends in .gz, open will use gzip,
+    returns the file to read and its source for InputProgress (the gzip process or the file)
+    """
+    if filename is sys.stdin:
+        return sys.stdin, sys.stdin
+    if filename.split(".")[-1] == "gz":
+        p = sp_gzip_read(filename, bufsize)
+        return p.stdout, p
+    f = open(filename, 'r', bufsize)
+    return f, f
+
+
+class TwoReadIlluminaRun:
+    """
+    Class to open/close and read a two read illumina sequencing run. Data is expected to be in
+    fastq format (possibly gzipped)
+    """
+    def __init__(self, read1, read2, interleaved=False, gbctrim=16, trim=7, verbose=True, tag='PROCESS', block_size=BUFFER_SIZE):
+        """
+        Initialize a TwoReadIlluminaRun object with expandible paths (with glob) to the two
+        sequencing read files. A vector of multiple files per read is allowed. read1 sys.stdin
+        reads interleaved reads from stdin. gbctrim and trim are the gem barcode and trim
+        lengths of raw reads (next_raw), tag starts the messages, block_size is the buffer
+        size of the input files and pipes
+        """
+        self.verbose = verbose
+        self.tag = tag
+        self.block_size = block_size
+        self.gbctrim = gbctrim
+        self.trim = trim
+        self.isOpen = False
+        self.mcount = 0
+        self.interleaved = interleaved
+        # position, for checkpoints: completed file pairs, the open pair and records/bytes read from it
+        self.files_done = []
+        self.current = None
+        self.records = 0
+        self.seekable = False
+        self.offset1 = 0
+        self.offset2 = 0
+
+        if read1 is sys.stdin:
+            self.fread1 = [sys.stdin]
+            self.fread2 = None
+            self.interleaved = True
+        else:
+            self.fread1, self.fread2 = resolve_read_files(read1, read2, interleaved, tag)
+        # record the number of files per read
+        self.numberoffiles = len(self.fread1)
+        # bytes consumed of the input files (not stdin), for the percent complete and ETA
+        self.progress = InputProgress([] if read1 is sys.stdin else self.fread1 + (self.fread2 or []))
+
+    def open(self):
+        """
+        Open the next file set (in the order given), if file ends in .gz, open will use gzip
+        """
+        if self.isOpen:
+            self.close()
+        if self.current is not None:
+            self.files_done.append(self.current)
+            self.current = None
+        if self.numberoffiles > 0:
+            try:
+                read1 = self.fread1.pop(0)
+                self.R1, source1 = open_read_file(read1, self.block_size)
+                sources = [(read1, source1)]
+                if not self.interleaved:
+                    read2 = self.fread2.pop(0)
+                    self.R2, source2 = open_read_file(read2, self.block_size)
+                    sources.append((read2, source2))
+                if read1 is not sys.stdin:
+                    self.progress.opened(sources)
+            except Exception:
+                sys.stderr.write('%s\tERROR:[TwoReadIlluminaRun] cannot open input files\n' % self.tag)
+                raise
+            self.isOpen = True
+            self.numberoffiles -= 1
+            self.current = ['stdin' if read1 is sys.stdin else read1] if self.interleaved else [read1, read2]
+            self.records = 0
+            self.seekable = all(isinstance(source, file) and source is not sys.stdin for path, source in sources)
+            self.offset1 = 0
+            self.offset2 = 0
+            if self.verbose:
+                sys.stderr.write("%s\tFILES\t%s\n" % (self.tag, ','.join(self.current)))
+            return 0
+        else:
+            return 1
+
+    def close(self):
+        """
+        Close a TwoReadIlluminaRun file set
+        """
+        self.R1.close()
+        if not self.interleaved:
+            self.R2.close()
+        self.isOpen = False
+
+    def count(self):
+        """
+        Provide the current count of reads read
+        """
+        return self.mcount
+
+    def nfiles(self):
+        """
+        provide the number of files given
+        """
+        return self.numberoffiles
+
+    def read_pair(self):
+        """
+        The next read pair from the open files, the 8 lines (with line ends) of the read 1
+        and read 2 records, StopIteration at the end of the files
+        """
+        R2 = self.R1 if self.interleaved else self.R2
+        lines = (self.R1.next(), self.R1.next(), self.R1.next(), self.R1.next(),
+                 R2.next(), R2.next(), R2.next(), R2.next())
+        if self.seekable:
+            if self.interleaved:
+                self.offset1 += len(lines[0]) + len(lines[1]) + len(lines[2]) + len(lines[3]) + len(lines[4]) + len(lines[5]) + len(lines[6]) + len(lines[7])
+            else:
+                self.offset1 += len(lines[0]) + len(lines[1]) + len(lines[2]) + len(lines[3])
+                self.offset2 += len(lines[4]) + len(lines[5]) + len(lines[6]) + len(lines[7])
+        return lines
+
+    def skip_raw(self, ncount):
+        """
+        Skip the next [ncount] reads without parsing them, used to process a range of reads
+        """
+        if not self.isOpen:
+            if self.open() == 1:
+                sys.stderr.write('%s\tERROR:[TwoReadIlluminaRun] ERROR Opening files for reading\n' % self.tag)
+                raise Exception
+        i = 0
+        while i < ncount:
+            self.read_pair()
+            self.records += 1
+            i += 1
+
+    def position(self):
+        """
+        Position in the input, for a checkpoint
+        """
+        return {'files_done': self.files_done,
+                'current': self.current,
+                'records': self.records,
+                'offsets': [self.offset1, self.offset2] if self.seekable else None}
+
+    def resume(self, position):
+        """
+        Move to a checkpointed position, completed file pairs are dropped, uncompressed files
+        are seeked to the byte offset, compressed files are skipped by records (without parsing)
+        """
+        for done in position['files_done']:
+            self.fread1.remove(done[0])
+            if not self.interleaved:
+                self.fread2.remove(done[1])
+            self.numberoffiles -= 1
+            self.progress.skipped(done)
+        self.files_done = position['files_done']
+        if position['current'] is None:
+            return
+        if self.open() == 1 or self.current != position['current']:
+            sys.stderr.write('%s\tERROR:[TwoReadIlluminaRun] checkpoint does not match the input files\n' % self.tag)
+            raise Exception
+        if position['offsets'] is not None and self.seekable:
+            self.R1.seek(position['offsets'][0])
+            if not self.interleaved:
+                self.R2.seek(position['offsets'][1])
+            self.offset1, self.offset2 = position['offsets']
+            self.records = position['records']
+        else:
+            self.skip_raw(position['records'])
+
+    def parse_raw(self, lines):
+        """
+        fragment of a raw 10x read pair, the gem barcode and trim are cut from the start of read 1
+        """
+        id1 = lines[0].strip()
+        seq1 = lines[1].strip()
+        qual1 = lines[3].strip()
+        assert(len(seq1) == len(qual1))
+        if id1 == '' or seq1 == ''or qual1 == '':
+            self.close()
+            raise StopIteration
+        id2 = lines[4].strip()
+        seq2 = lines[5].strip()
+        qual2 = lines[7].strip()
+        assert(len(seq2) == len(qual2))
+        if id2 == '' or seq2 == ''or qual2 == '':
+            self.close()
+            raise StopIteration
+        # check to make sure the IDs match across all files
+        assert(id1.split()[0] == id2.split()[0])
+        rid = id1.split()[0][1:]
+        rbc = (id1.split()[1]).split(':')[3]
+        if rbc == '':
+            rbc = "1"
+        gbc = seq1[0:self.gbctrim]
+        gbcq = qual1[0:self.gbctrim]
+        trim = seq1[self.gbctrim:self.gbctrim + self.trim]
+        trimq = qual1[self.gbctrim:self.gbctrim + self.trim]
+        seq1 = seq1[self.gbctrim + self.trim:]
+        qual1 = qual1[self.gbctrim + self.trim:]
+        return {'id': rid,
+                'status': 'UNKNOWN',
+                'library_bc': rbc,
+                'gem_bc': gbc,
+                'sgem_bc': gbc,
+                'sgem_qual': gbcq,
+                'trim_seq': trim,
+                'trim_qual': trimq,
+                'read1_seq': seq1,
+                'read1_qual': qual1,
+                'read2_seq': seq2,
+                'read2_qual': qual2}
+
+    def parse_processed(self, lines):
+        """
+        fragment of a read pair written by process_10xReads.py
+        """
+        id1 = lines[0].strip()
+        seq1 = lines[1].strip()
+        qual1 = lines[3].strip()
+        assert(len(seq1) == len(qual1))
+        if id1 == '' or seq1 == ''or qual1 == '':
+            self.close()
+            raise StopIteration
+        id2 = lines[4].strip()
+        seq2 = lines[5].strip()
+        qual2 = lines[7].strip()
+        assert(len(seq2) == len(qual2))
+        if id2 == '' or seq2 == ''or qual2 == '':
+            self.close()
+            raise StopIteration
+        # check to make sure the IDs match across all files
+        assert(id1.split()[0] == id2.split()[0])
+        orid = id1.split()[0][1:]
+        rid = (':').join(orid.split(':')[1:])
+        sgbc = orid.split(':')[0]
+
+        spart = id1.split()[1].split(":", 4)
+        rbc = spart[3]
+        if rbc == '':
+            rbc = "1"
+        status, gbc, gbcq, trim, trimq = spart[4].split('_')[0:5]
+        return {'id': rid,
+                'status': status,
+                'library_bc': rbc,
+                'gem_bc': sgbc,
+                'sgem_bc': gbc,
+                'sgem_qual': gbcq,
+                'trim_seq': trim,
+                'trim_qual': trimq,
+                'read1_seq': seq1,
+                'read1_qual': qual1,
+                'read2_seq': seq2,
+                'read2_qual': qual2}
+
+    def read_batch(self, parse, ncount, profile=None):
+        """
+        Up to [ncount] parsed reads, fewer (or none) at the end of the input. At the end of a
+        file the next file in the list is opened.
+        profile, a sampled StageTimer, times the read and parse stages
+        """
+        if not self.isOpen:
+            if self.open() == 1:
+                sys.stderr.write('%s\tERROR:[TwoReadIlluminaRun] ERROR Opening files for reading\n' % self.tag)
+                raise Exception
+        reads = []
+        while len(reads) < ncount:
+            try:
+                lines = self.read_pair()
+                if profile is not None:
+                    profile.lap('read')
+                fragment = parse(lines)
+            except StopIteration:
+                if self.numberoffiles > 0:
+                    self.open()
+                    continue
+                break
+            except Exception:
+                sys.stderr.write('%s\tERROR:[TwoReadIlluminaRun] Error reading next read\n' % self.tag)
+                raise
+            reads.append(fragment)
+            self.mcount += 1
+            self.records += 1
+            if profile is not None:
+                profile.lap('parse')
+        return reads
+
+    def raw_batch(self, ncount):
+        return self.read_batch(self.parse_raw, ncount)
+
+    def processed_batch(self, ncount):
+        return self.read_batch(self.parse_processed, ncount)
+
+    def next_raw(self, ncount=1, profile=None):
+        """
+        Extract and store the next [count] raw reads, StopIteration at the end of the input
+        """
+        reads = self.read_batch(self.parse_raw, ncount, profile)
+        if len(reads) == 0:
+            raise StopIteration
+        if len(reads) == 1:
+            return reads[0]
+        return reads
+
+    def next_processed(self, ncount=1):
+        """
+        Extract and store the next [count] processed reads, StopIteration at the end of the input
+        """
+        reads = self.read_batch(self.parse_processed, ncount)
+        if len(reads) == 0:
+            raise StopIteration
+        if len(reads) == 1:
+            return reads[0]
+        return reads
+
+
+class IlluminaTwoReadOutput:
+    """
+    Given Paired-end reads, output them to a paired files (possibly gzipped)
+    """
+    def __init__(self, output_prefix, uncompressed, output_format='paired', resume=None, profile=None, tag='PROCESS', level=None, block_size=BUFFER_SIZE):
+        """
+        Initialize an IlluminaTwoReadOutput object with output_prefix and whether or not
+        output should be compressed with gzip [uncompressed True/False]
+        output_format is paired (R1 and R2 files), interleaved (R1 file) or supernova (reads
+        in their original form, R1, R2 and I1 files)
+        resume is the output state of a checkpoint, existing files are truncated to the
+        checkpoint and appended to rather than deleted
+        profile, a StageTimer, times the time blocked writing the output
+        level is the gzip compression level (None for gzip's default), writes are collected
+        into blocks of block_size bytes
+        """
+        self.isOpen = False
+        self.profile = profile
+        self.tag = tag
+        self.level = level
+        self.block_size = block_size
+        self.output_prefix = output_prefix
+        self.output_format = output_format
+        self.uncompressed = uncompressed
+        self.mcount = 0
+        self.append = False
+        self.files = []
+        self.processes = []
+
+        if output_prefix == "stdout":
+            if self.output_format == 'paired':
+                self.output_format = 'interleaved'
+            self.uncompressed = True
+        elif resume is not None:
+            self.mcount = resume['count']
+            self.append = True
+            for filename in self.filenames():
+                if filename in resume['sizes']:
+                    with open(filename, 'r+b') as f:
+                        f.truncate(resume['sizes'][filename])
+                elif os.path.isfile(filename):
+                    os.remove(filename)
+        else:
+            existing = [filename for filename in self.filenames() if os.path.isfile(filename)]
+            if len(existing) > 0:
+                sys.stderr.write('%s\tWARNING:[IlluminaTwoReadOutput] File with prefix: %s exists, DELETING\n' % (self.tag, self.output_prefix))
+                try:
+                    for filename in existing:
+                        os.remove(filename)
+                except Exception:
+                    sys.stderr.write('%s\tWARNING:[IlluminaTwoReadOutput] Cannot delete file with prefix: %s\n' % (self.tag, self.output_prefix))
+                    raise
+        self.interleaved = self.output_format == 'interleaved'
+
+    def filenames(self):
+        """
+        The output file names
+        """
+        ext = '.fastq' if self.uncompressed else '.fastq.gz'
+        reads = {'paired': ['R1', 'R2'], 'interleaved': ['R1'], 'supernova': ['R1', 'R2', 'I1']}[self.output_format]
+        return [self.output_prefix + '_' + read + '_001' + ext for read in reads]
+
+    def open(self):
+        """
+        Open the read files for writing, appending _R1_001.fastq, _R2_001.fastq (and
+        _I1_001.fastq) to the output_prefix. Create directories as needed.
+        """
+        if self.isOpen:
+            self.close()
+        try:
+            if self.output_prefix == "stdout":
+                self.files = [sys.stdout]
+            else:
+                make_sure_path_exists(os.path.dirname(self.output_prefix))
+                mode = 'ab' if self.append else 'wb'
+                self.files = []
+                for filename in self.filenames():
+                    if self.uncompressed is True:
+                        self.files.append(open(filename, mode, 0))
+                    else:
+                        p = sp_gzip_write(filename, 0, mode, self.level)
+                        self.processes.append(p)
+                        self.files.append(p.stdin)
+            if self.profile is not None:
+                self.files = [TimedWriter(f, self.profile, self.block_size) for f in self.files]
+            else:
+                self.files = [BlockWriter(f, self.block_size) for f in self.files]
+            self.R1f = self.files[0]
+            if len(self.files) > 1:
+                self.R2f = self.files[1]
+            if len(self.files) > 2:
+                self.I1f = self.files[2]
+        except Exception:
+            sys.stderr.write('%s\tERROR:[IlluminaTwoReadOutput] Cannot write reads to file with prefix: %s\n' % (self.tag, self.output_prefix))
+            raise
+        self.isOpen = True
+        return 0
+
+    def close_files(self):
+        """
+        Close the output files, waiting for gzip to finish writing, raises IOError if a
+        gzip process did not exit cleanly (eg the disk is full)
+        """
+        files, processes = self.files, self.processes
+        self.files = []
+        self.processes = []
+        self.isOpen = False
+        for f in files:
+            f.close()
+        for p, filename in zip(processes, self.filenames()):
+            sp_gzip_wait(p, filename)
+
+    def close(self):
+        """
+        Close an IlluminaTwoReadOutput file set
+        """
+        if self.isOpen:
+            self.close_files()
+        sys.stderr.write("%s\tFILES\tWrote %i reads to output\n" % (self.tag, self.mcount))
+
+    def checkpoint(self):
+        """
+        Finish the current gzip members (or flush and sync uncompressed files) and return the
+        output state, writing continues in new gzip members appended to the files
+        """
+        if self.isOpen:
+            if len(self.processes) == 0:
+                for f in self.files:
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.close_files()
+            self.append = True
+        sizes = {}
+        for filename in self.filenames():
+            if os.path.isfile(filename):
+                sizes[filename] = os.path.getsize(filename)
+        return {'count': self.mcount, 'sizes': sizes}
+
+    def count(self):
+        """
+        Provide the current read count for the file output
+        """
+        return self.mcount
+
+    def formatPairedFastq(self, fragment):
+        """
+        The read 1 and read 2 fastq records of the fragment
+        """
+        newid = '@' + (':').join([fragment['gem_bc'], fragment['id']])
+        comment = ("_").join([fragment['status'], fragment['sgem_bc'], fragment['sgem_qual'], fragment['trim_seq'], fragment['trim_qual']])
+        # read 1
+        r1 = (' ').join([newid, (':').join(['1', 'N', '0', fragment['library_bc'], comment])]) + '\n' + fragment['read1_seq'] + '\n+\n' + fragment['read1_qual'] + '\n'
+        # read 2
+        r2 = (' ').join([newid, (':').join(['2', 'N', '0', fragment['library_bc'], comment])]) + '\n' + fragment['read2_seq'] + '\n+\n' + fragment['read2_qual'] + '\n'
+        return r1, r2
+
+    def formatSupernova(self, fragment):
+        """
+        The read 1, read 2 and index fastq records of the fragment in their original form,
+        gem barcode and trim back at the start of read 1
+        """
+        newid = '@' + fragment['id']
+        # read 1
+        r1 = newid + ' 1:N:0:' + fragment['library_bc'] + '\n' + fragment['sgem_bc'] + fragment['trim_seq'] + fragment['read1_seq'] + '\n+\n' + fragment['sgem_qual'] + fragment['trim_qual'] + fragment['read1_qual'] + '\n'
+        # read 2
+        r2 = newid + ' 2:N:0:' + fragment['library_bc'] + '\n' + fragment['read2_seq'] + '\n+\n' + fragment['read2_qual'] + '\n'
+        # index
+        i1 = newid + ' 1:N:0:' + fragment['library_bc'] + '\n' + fragment['library_bc'] + '\n+\n' + 'F' * len(fragment['library_bc']) + '\n'
+        return r1, r2, i1
+
+    def writeRead(self, fragment, profile=None):
+        """
+        Write the paired read in the queue to the output files,
+        profile, a sampled StageTimer, times the format and write stages
+        """
+        if (len(fragment) == 0):
+            return
+        if not self.isOpen:
+            self.open()
+        try:
+            if self.output_format == 'supernova':
+                r1, r2, i1 = self.formatSupernova(fragment)
+            else:
+                r1, r2 = self.formatPairedFastq(fragment)
+            if profile is not None:
+                profile.lap('format')
+            if self.interleaved:
+                self.R1f.write(r1 + r2)
+            else:
+                self.R1f.write(r1)
+                self.R2f.write(r2)
+                if self.output_format == 'supernova':
+                    self.I1f.write(i1)
+            self.mcount += 1
+            if profile is not None:
+                profile.lap('write')
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                sys.exit(1)  # the reader of stdout has gone
+            sys.stderr.write('%s\tERROR:[IlluminaTwoReadOutput] Cannot write reads to file with prefix: %s\n' % (self.tag, self.output_prefix))
+            raise
+        except Exception:
+            sys.stderr.write('%s\tERROR:[IlluminaTwoReadOutput] Cannot write reads to file with prefix: %s\n' % (self.tag, self.output_prefix))
+            raise
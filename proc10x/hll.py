@@ -0,0 +1,134 @@
+"""
+Copyright 2018 Matt Settles
+
+HyperLogLog sketch for estimating the number of distinct barcodes in fixed memory,
+sketches of the same precision can be merged (union) and serialised. A sketch starts
+sparse, an exact set of the value hashes, and is promoted to the registers once it holds
+more than sparse_max hashes, so small sketches (most windows) are cheap to estimate and merge
+"""
+import base64
+import hashlib
+import math
+import struct
+import zlib
+
+
+def hash64(value):
+    """
+    Stable (across processes and machines) 64 bit hash of a string
+    """
+    return struct.unpack('<Q', hashlib.md5(value).digest()[:8])[0]
+
+
+# 2**-r for every register value
+inverse_powers = [2.0 ** -r for r in range(65)]
+
+
+class HyperLogLog:
+    """
+    HyperLogLog with 2**p one byte registers (p=12, 4KB, ~1.6% standard error), exact while
+    sparse (at most sparse_max distinct hashes, default m/4)
+    """
+    def __init__(self, p=12, registers=None, sparse_max=None):
+        self.p = p
+        self.m = 1 << p
+        self.width = 64 - p
+        self.sparse_max = self.m // 4 if sparse_max is None else sparse_max
+        if registers is None:
+            self.sparse = set()
+            self.registers = None
+        else:
+            self.sparse = None
+            self.registers = bytearray(registers)
+        if self.m >= 128:
+            self.alpha = 0.7213 / (1 + 1.079 / self.m)
+        elif self.m == 64:
+            self.alpha = 0.709
+        elif self.m == 32:
+            self.alpha = 0.697
+        else:
+            self.alpha = 0.673
+
+    def add(self, value):
+        x = hash64(value)
+        if self.sparse is not None:
+            self.sparse.add(x)
+            if len(self.sparse) > self.sparse_max:
+                self.promote()
+        else:
+            self.add_hash(x)
+
+    def add_hash(self, x):
+        idx = x >> self.width
+        rho = self.width - (x & ((1 << self.width) - 1)).bit_length() + 1
+        if rho > self.registers[idx]:
+            self.registers[idx] = rho
+
+    def promote(self):
+        """
+        Move the sparse hashes into the registers
+        """
+        if self.sparse is None:
+            return
+        hashes = self.sparse
+        self.sparse = None
+        self.registers = bytearray(self.m)
+        for x in hashes:
+            self.add_hash(x)
+
+    def dense_registers(self):
+        """
+        The registers of the sketch, computed from the hashes when sparse (the sketch stays sparse)
+        """
+        if self.sparse is None:
+            return self.registers
+        dense = HyperLogLog(self.p, bytearray(self.m))
+        for x in self.sparse:
+            dense.add_hash(x)
+        return dense.registers
+
+    def merge(self, other):
+        """
+        Union another sketch (of the same precision) into this one
+        """
+        if other.p != self.p:
+            raise ValueError("cannot merge HyperLogLog sketches of different precision")
+        if other.sparse is not None:
+            if self.sparse is not None:
+                self.sparse.update(other.sparse)
+                if len(self.sparse) > self.sparse_max:
+                    self.promote()
+            else:
+                for x in other.sparse:
+                    self.add_hash(x)
+            return self
+        self.promote()
+        registers = self.registers
+        for i, r in enumerate(other.registers):
+            if r > registers[i]:
+                registers[i] = r
+        return self
+
+    def estimate(self):
+        """
+        Estimated number of distinct values added (exact while sparse)
+        """
+        if self.sparse is not None:
+            return float(len(self.sparse))
+        zeros = self.registers.count('\x00')
+        total = sum([inverse_powers[r] for r in self.registers])
+        est = self.alpha * self.m * self.m / total
+        if est <= 2.5 * self.m and zeros > 0:  # small range correction, linear counting
+            est = self.m * math.log(float(self.m) / zeros)
+        return est
+
+    def to_string(self):
+        """
+        Compact (compressed, base64) text form of the sketch
+        """
+        return '%i:%s' % (self.p, base64.b64encode(zlib.compress(bytes(self.dense_registers()))))
+
+    @classmethod
+    def from_string(cls, text):
+        p, registers = text.split(':', 1)
+        return cls(int(p), zlib.decompress(base64.b64decode(registers)))
@@ -0,0 +1,159 @@
+"""
+Copyright 2018 Matt Settles
+
+Machine readable run metrics (--metrics FILE), for monitoring many jobs without
+parsing the stderr logs.
+
+The metrics file is rewritten every --metrics-interval seconds (and when the run
+ends) with a snapshot of the run, written to a temporary file and renamed, so a
+reader never sees a partial file. The file is JSON, or Prometheus text format
+(for the node_exporter textfile collector) when the name ends in .prom.
+
+A snapshot has the reads processed, average and recent reads/sec, status counts,
+reads output, barcodes seen, queue depths (the values the tool collects), bytes in
+and out (rchar/wchar of /proc/[pid]/io of the tool and its worker processes, the
+uncompressed streams, not available off Linux) and the peak resident memory, and of
+tools reading input files, the input bytes consumed (compressed) of the total input
+size, the percent complete and the estimated seconds remaining (proc10x/progress.py).
+"""
+import os
+import json
+import time
+import socket
+import resource
+import multiprocessing
+
+
+def proc_io(pid):
+    """
+    (rchar, wchar) of a process, None if not available
+    """
+    try:
+        with open('/proc/%s/io' % pid, 'r') as f:
+            io = dict(line.split(':') for line in f if ':' in line)
+        return int(io['rchar']), int(io['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def prom_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RunMetrics:
+    """
+    periodic snapshot of a run, collect is called for the tool values, a dict with any of
+    reads, status (dict), reads_out, barcodes, queues (dict), input (InputProgress.values)
+    """
+    def __init__(self, path, tool, collect, interval=10.0, run=None):
+        self.path = path
+        self.tool = tool
+        self.collect = collect
+        self.interval = interval
+        self.run = run
+        self.prometheus = path.endswith('.prom')
+        self.start = time.time()
+        self.last = self.start
+        self.last_reads = 0
+        self.io = {}
+        self.write('running')
+
+    def tick(self):
+        """
+        rewrite the snapshot if interval seconds have passed since the last
+        """
+        if time.time() - self.last >= self.interval:
+            self.write('running')
+
+    def finish(self, state='complete'):
+        self.write(state)
+
+    def bytes_io(self):
+        """
+        bytes read and written by this process and its (multiprocessing) workers, the last
+        seen values of workers that have exited are kept
+        """
+        for pid in [os.getpid()] + [p.pid for p in multiprocessing.active_children()]:
+            io = proc_io(pid)
+            if io is not None:
+                self.io[pid] = io
+        if len(self.io) == 0:
+            return None, None
+        return sum(io[0] for io in self.io.values()), sum(io[1] for io in self.io.values())
+
+    def snapshot(self, state):
+        now = time.time()
+        values = self.collect()
+        reads = values.get('reads', 0)
+        bytes_in, bytes_out = self.bytes_io()
+        progress = values.get('input') or {}
+        snap = {'tool': self.tool,
+                'run': self.run,
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'state': state,
+                'start_time': round(self.start, 3),
+                'update_time': round(now, 3),
+                'elapsed_seconds': round(now - self.start, 3),
+                'reads': reads,
+                'reads_per_sec': int(round(reads / max(now - self.start, 1e-9))),
+                'reads_per_sec_recent': int(round((reads - self.last_reads) / max(now - self.last, 1e-9))),
+                'status': values.get('status', {}),
+                'reads_out': values.get('reads_out'),
+                'barcodes': values.get('barcodes'),
+                'bytes_in': bytes_in,
+                'bytes_out': bytes_out,
+                'queues': values.get('queues', {}),
+                'input_bytes': progress.get('bytes'),
+                'input_bytes_total': progress.get('total'),
+                'percent_complete': progress.get('percent'),
+                'eta_seconds': progress.get('eta_seconds'),
+                'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                'max_rss_children_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024}
+        self.last = now
+        self.last_reads = reads
+        return snap
+
+    def prometheus_text(self, snap):
+        labels = 'tool="%s",run="%s"' % (prom_label(snap['tool']), prom_label(snap['run'] if snap['run'] is not None else ''))
+        lines = []
+
+        def metric(name, kind, help, value, extra=None):
+            if value is None:
+                return
+            if not any(l.startswith('# HELP %s ' % name) for l in lines):
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s{%s%s} %s' % (name, labels, ',' + extra if extra is not None else '', repr(value) if isinstance(value, float) else value))
+
+        metric('proc10x_reads_total', 'counter', 'Reads (pairs or records) processed', snap['reads'])
+        metric('proc10x_reads_per_second', 'gauge', 'Reads per second since the previous update', snap['reads_per_sec_recent'])
+        for status in sorted(snap['status']):
+            metric('proc10x_status_reads_total', 'counter', 'Reads processed by gem barcode status', snap['status'][status], 'status="%s"' % prom_label(status))
+        metric('proc10x_reads_output_total', 'counter', 'Reads written', snap['reads_out'])
+        metric('proc10x_barcodes', 'gauge', 'Whitelisted barcodes seen', snap['barcodes'])
+        metric('proc10x_bytes_in_total', 'counter', 'Bytes read (uncompressed streams)', snap['bytes_in'])
+        metric('proc10x_bytes_out_total', 'counter', 'Bytes written (uncompressed streams)', snap['bytes_out'])
+        metric('proc10x_input_bytes_consumed', 'gauge', 'Input bytes (compressed) consumed', snap['input_bytes'])
+        metric('proc10x_input_bytes_total', 'gauge', 'Total size of the input files', snap['input_bytes_total'])
+        metric('proc10x_percent_complete', 'gauge', 'Percent of the input bytes consumed', snap['percent_complete'])
+        metric('proc10x_eta_seconds', 'gauge', 'Estimated seconds remaining, from the input consumption rate', snap['eta_seconds'])
+        for queue in sorted(snap['queues']):
+            metric('proc10x_queue_depth', 'gauge', 'Items waiting in a queue', snap['queues'][queue], 'queue="%s"' % prom_label(queue))
+        metric('proc10x_max_rss_bytes', 'gauge', 'Peak resident memory of the tool process', snap['max_rss_bytes'])
+        metric('proc10x_max_rss_children_bytes', 'gauge', 'Peak resident memory of the finished child processes', snap['max_rss_children_bytes'])
+        metric('proc10x_start_time_seconds', 'gauge', 'Start time of the run', snap['start_time'])
+        metric('proc10x_last_update_seconds', 'gauge', 'Time of this snapshot', snap['update_time'])
+        metric('proc10x_state', 'gauge', 'State of the run (running, complete or failed)', 1, 'state="%s"' % prom_label(snap['state']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, state):
+        snap = self.snapshot(state)
+        tmp = self.path + '.tmp.%i' % os.getpid()
+        with open(tmp, 'w') as f:
+            if self.prometheus:
+                f.write(self.prometheus_text(snap))
+            else:
+                json.dump(snap, f, indent=1, sort_keys=True)
+                f.write('\n')
+        os.rename(tmp, self.path)
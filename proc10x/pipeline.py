@@ -0,0 +1,163 @@
+"""
+Copyright 2018 Matt Settles
+
+Pipelined execution (--pipeline): reading the input and writing the output run on their own
+threads, passing batches of reads to and from the main (processing) thread through bounded
+queues, so waiting on the gzip pipes (reading and writing release the GIL) overlaps the
+processing rather than adding to it.
+
+    ThreadedReader - calls read_batch(n) (a list of up to n reads, empty at the end) on a
+                     thread, next() returns the reads in order
+    ThreadedWriter - write(item) queues the item, write_item(item) is called on a thread
+
+StatQueue counts the batches, the depth (mean and max, at each put) and the seconds each
+side waited: a reader blocked on a full queue, or a writer waiting on an empty queue,
+means the processing is the bottleneck, the main thread waiting on the input or blocked
+on the output means the I/O is.
+"""
+import sys
+import time
+import threading
+import Queue
+
+
+class StatQueue(Queue.Queue):
+    """
+    bounded queue counting the batches, depth and seconds waited to put and get
+    """
+    def __init__(self, name, maxsize):
+        Queue.Queue.__init__(self, maxsize)
+        self.name = name
+        self.batches = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+
+    def put_batch(self, item):
+        stime = time.time()
+        self.put(item)
+        self.put_wait += time.time() - stime
+        if item is None:  # end marker
+            return
+        depth = self.qsize()
+        self.batches += 1
+        self.depth_sum += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def get_batch(self):
+        stime = time.time()
+        item = self.get()
+        self.get_wait += time.time() - stime
+        return item
+
+    def summary(self, putter, getter):
+        return "%s queue\tbatches:%i|mean_depth:%.1f|max_depth:%i|%s_waited:%.2fs|%s_waited:%.2fs" % (self.name, self.batches, float(self.depth_sum) / max(self.batches, 1), self.max_depth,
+                                                                                                      putter, self.put_wait, getter, self.get_wait)
+
+
+class ThreadedReader:
+    """
+    read ahead on a thread, in batches of batch reads, at most depth batches queued
+    """
+    def __init__(self, read_batch, batch=1000, depth=4):
+        self.read_batch = read_batch
+        self.batch_size = batch
+        self.queue = StatQueue('input', depth)
+        self.batch = []
+        self.pos = 0
+        self.done = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            while 1:
+                batch = self.read_batch(self.batch_size)
+                if len(batch) == 0:
+                    break
+                self.queue.put_batch(batch)
+        except BaseException:  # including SystemExit, re-raised on the main thread
+            self.error = sys.exc_info()
+        self.queue.put_batch(None)
+
+    def next(self):
+        if self.pos == len(self.batch):
+            if self.done:
+                raise StopIteration
+            self.batch = self.queue.get_batch()
+            self.pos = 0
+            if self.batch is None:
+                self.done = True
+                self.batch = []
+                if self.error is not None:
+                    raise self.error[0], self.error[1], self.error[2]
+                raise StopIteration
+        item = self.batch[self.pos]
+        self.pos += 1
+        return item
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def summary(self):
+        return self.queue.summary('reader', 'main')
+
+
+class ThreadedWriter:
+    """
+    write behind on a thread, in batches of batch items, at most depth batches queued
+    """
+    def __init__(self, write_item, batch=1000, depth=4):
+        self.write_item = write_item
+        self.batch_size = batch
+        self.queue = StatQueue('output', depth)
+        self.batch = []
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while 1:
+            batch = self.queue.get_batch()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue  # drain, so the main thread is not blocked
+            try:
+                for item in batch:
+                    self.write_item(item)
+            except BaseException:  # including SystemExit (broken pipe), re-raised on the main thread
+                self.error = sys.exc_info()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def write(self, item):
+        self.batch.append(item)
+        if len(self.batch) >= self.batch_size:
+            self.check()
+            self.queue.put_batch(self.batch)
+            self.batch = []
+
+    def close(self):
+        """
+        write the last batch and wait for the writer to finish
+        """
+        if len(self.batch) > 0:
+            self.queue.put_batch(self.batch)
+            self.batch = []
+        self.queue.put_batch(None)
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+        self.check()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def summary(self):
+        return self.queue.summary('main', 'writer')
@@ -0,0 +1,139 @@
+"""
+Copyright 2018 Matt Settles
+
+Progress of a run through its input files, as (compressed) bytes consumed of the total
+size of the inputs, and the estimated time remaining.
+
+Bytes consumed of a gzip file are the read position of the gzip --decompress process in
+the file (/proc/[pid]/fdinfo, Linux), of an uncompressed file the position of the file
+itself. Positions are only looked up when progress is reported, reading is not slowed.
+Input that is not a file (stdin) has no known size and no progress.
+"""
+import os
+import time
+from subprocess import Popen
+
+have_proc = os.path.isdir('/proc/self/fdinfo')
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+def process_position(pid, path):
+    """
+    read position of process pid in file path, the file size once the process has exited,
+    -1 if the process does not have the file open (not yet, or no longer), None if it cannot
+    be found
+    """
+    if not have_proc:
+        return None
+    fddir = '/proc/%i/fd' % pid
+    try:
+        fds = os.listdir(fddir)
+    except OSError:
+        return file_size(path)  # exited
+    for fd in fds:
+        try:
+            if os.readlink(os.path.join(fddir, fd)) == path:
+                with open('/proc/%i/fdinfo/%s' % (pid, fd), 'r') as f:
+                    for line in f:
+                        if line.startswith('pos:'):
+                            return int(line.split()[1])
+        except (OSError, IOError):
+            continue
+    return -1
+
+
+def format_seconds(seconds):
+    seconds = int(round(seconds))
+    return '%i:%02i:%02i' % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+class InputProgress:
+    """
+    bytes consumed of a set of input files, read one (pair) at a time
+    """
+    def __init__(self, files):
+        sizes = [file_size(os.path.realpath(f)) if isinstance(f, str) else None for f in files]
+        self.total = sum(sizes) if len(sizes) > 0 and None not in sizes else None
+        self.done = 0
+        self.current = []
+        self.seen = set()
+        self.stime = time.time()
+        self.sbytes = 0
+
+    def opened(self, sources):
+        """
+        a new set of files is being read, [(path, source)], the source is the gzip Popen or the
+        file object, the previous set is complete
+        """
+        for path, source in self.current:
+            self.done += file_size(path) or 0
+        self.current = [(os.path.realpath(path), source) for path, source in sources]
+
+    def skipped(self, paths):
+        """
+        files completed in an earlier run (checkpoint resume)
+        """
+        for path in paths:
+            self.done += file_size(os.path.realpath(path)) or 0
+
+    def consumed(self):
+        """
+        bytes consumed, None if unknown
+        """
+        if self.total is None:
+            return None
+        consumed = self.done
+        for path, source in self.current:
+            if isinstance(source, Popen):
+                pos = process_position(source.pid, path)
+                if pos == -1:
+                    # not opened yet by gzip, or closed after reading to the end
+                    pos = file_size(path) if source.pid in self.seen else 0
+                elif pos is not None:
+                    self.seen.add(source.pid)
+            else:
+                try:
+                    pos = os.lseek(source.fileno(), 0, os.SEEK_CUR)
+                except (OSError, IOError, ValueError):
+                    pos = file_size(path)  # closed
+            if pos is None:
+                return None
+            consumed += pos
+        return consumed
+
+    def start(self):
+        """
+        set the start of the rate (for the ETA), after any skipped input
+        """
+        self.stime = time.time()
+        self.sbytes = self.consumed() or 0
+
+    def values(self, consumed=None):
+        """
+        dict of bytes consumed, total, percent complete and eta seconds (None when unknown)
+        """
+        if consumed is None:
+            consumed = self.consumed()
+        if consumed is None or self.total is None:
+            return {'bytes': consumed, 'total': self.total, 'percent': None, 'eta_seconds': None}
+        consumed = min(consumed, self.total)
+        percent = 100.0 * consumed / self.total if self.total > 0 else 100.0
+        eta = None
+        if consumed > self.sbytes:
+            eta = (time.time() - self.stime) * (self.total - consumed) / (consumed - self.sbytes)
+        return {'bytes': consumed, 'total': self.total, 'percent': round(percent, 2), 'eta_seconds': int(round(eta)) if eta is not None else None}
+
+    def summary(self, consumed=None):
+        """
+        short form for the READS lines, empty when unknown
+        """
+        values = self.values(consumed)
+        if values['percent'] is None:
+            return ''
+        return '|input:%.1f%%|eta:%s' % (values['percent'], format_seconds(values['eta_seconds']) if values['eta_seconds'] is not None else 'unknown')
@@ -0,0 +1,246 @@
+"""
+Copyright 2018 Matt Settles
+
+Compact sam record, fields are split once and parsed on demand
+"""
+import string
+
+rcs = string.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+# the 10x tags added by samConcat2Tag.py, carried over to remapped records
+tenx_tags = ('ST:Z:', 'BX:Z:', 'BC:Z:', 'QT:Z:', 'RX:Z:', 'QX:Z:', 'TR:Z:', 'TQ:Z:')
+
+
+def revcomp(seq):
+    return seq.translate(rcs)[::-1]
+
+
+def cigar_reflen(cigar):
+    """
+    Number of reference bases covered by a cigar string
+    """
+    length = 0
+    num = 0
+    for c in cigar:
+        if c.isdigit():
+            num = num * 10 + ord(c) - 48
+        else:
+            if c in 'MDN=X':
+                length += num
+            num = 0
+    return length
+
+
+def attach_tags(line, tags):
+    """
+    Append the 10x tags of the original read to a (re)mapped sam line, tags is a dict of
+    (read name, read number) -> tab separated tags, as from SamRecord.tenx_tags
+    """
+    fields = line.split('\t', 2)
+    key = (fields[0], 1 if int(fields[1]) & 0x40 else 2)
+    if tags.get(key, '') == '':
+        return line
+    return line.rstrip('\n') + '\t' + tags[key] + '\n'
+
+
+def get_tag(line, tag):
+    """
+    Value of a sam tag (ex. 'BX:Z:') in a sam line, None when absent
+    """
+    start = line.find('\t' + tag)
+    if start == -1:
+        return None
+    start += len(tag) + 1
+    end = line.find('\t', start)
+    return line[start:end] if end != -1 else line[start:].rstrip('\n')
+
+
+class SamRecord(object):
+    """
+    A sam alignment line, the 11 mandatory columns are split once (the optional tags are
+    kept as a single string) and integer fields are converted when first used
+    """
+    __slots__ = ('line', 'fields', '_flag', '_pos', '_mapq')
+
+    def __init__(self, line):
+        self.line = line
+        self.fields = line.rstrip('\n').split('\t', 11)
+        self._flag = None
+        self._pos = None
+        self._mapq = None
+
+    def __getstate__(self):
+        return self.line, self.fields
+
+    def __setstate__(self, state):
+        self.line, self.fields = state
+        self._flag = None
+        self._pos = None
+        self._mapq = None
+
+    @property
+    def qname(self):
+        return self.fields[0]
+
+    @property
+    def barcode(self):
+        """
+        gem barcode, prefixed to the read name by process_10xReads.py
+        """
+        return self.fields[0].split(':', 1)[0]
+
+    @property
+    def flag(self):
+        if self._flag is None:
+            self._flag = int(self.fields[1])
+        return self._flag
+
+    @property
+    def rname(self):
+        return self.fields[2]
+
+    @property
+    def pos(self):
+        if self._pos is None:
+            self._pos = int(self.fields[3])
+        return self._pos
+
+    @property
+    def mapq(self):
+        if self._mapq is None:
+            self._mapq = int(self.fields[4])
+        return self._mapq
+
+    @property
+    def cigar(self):
+        return self.fields[5]
+
+    @property
+    def rnext(self):
+        return self.fields[6]
+
+    @property
+    def pnext(self):
+        return int(self.fields[7])
+
+    @property
+    def tlen(self):
+        return int(self.fields[8])
+
+    @property
+    def seq(self):
+        return self.fields[9]
+
+    @property
+    def qual(self):
+        return self.fields[10]
+
+    @property
+    def tags(self):
+        return self.fields[11] if len(self.fields) > 11 else ''
+
+    def tag(self, tag):
+        """
+        Value of an optional tag (ex. 'BX:Z:'), None when absent
+        """
+        return get_tag('\t' + self.tags, tag)
+
+    def tenx_tags(self):
+        """
+        The 10x tags of the record (tab separated, in their order), for attach_tags
+        """
+        return '\t'.join(tag for tag in self.tags.split('\t') if tag[0:5] in tenx_tags)
+
+    @property
+    def end(self):
+        """
+        1-based inclusive reference end of the alignment
+        """
+        return self.pos + cigar_reflen(self.fields[5]) - 1
+
+    # 0x1 template having multiple segments in sequencing
+    # 0x2 each segment properly aligned according to the aligner
+    # 0x4 segment unmapped
+    # 0x8 next segment in the template unmapped
+    # 0x10 SEQ being reverse complemented
+    # 0x40 the first segment in the template
+    # 0x80 the last segment in the template
+    # 0x100 secondary alignment
+    # 0x800 supplementary alignment
+    @property
+    def paired(self):
+        return self.flag & 0x1 != 0
+
+    @property
+    def unmapped(self):
+        return self.flag & 0x4 != 0
+
+    @property
+    def mate_unmapped(self):
+        return self.flag & 0x8 != 0
+
+    @property
+    def reverse(self):
+        return self.flag & 0x10 != 0
+
+    @property
+    def read1(self):
+        return self.flag & 0x40 != 0
+
+    @property
+    def read2(self):
+        return self.flag & 0x80 != 0
+
+    @property
+    def secondary(self):
+        return self.flag & 0x100 != 0
+
+    @property
+    def supplementary(self):
+        return self.flag & 0x800 != 0
+
+    def fastq(self, read_number):
+        """
+        The read as originally sequenced (un-reverse complemented) in fastq format
+        """
+        if self.reverse:
+            return '\n'.join(['@' + self.fields[0] + ' %i:N:O' % read_number, revcomp(self.fields[9]), '+', self.fields[10][::-1]])
+        return '\n'.join(['@' + self.fields[0] + ' %i:N:O' % read_number, self.fields[9], '+', self.fields[10]])
+
+
+def read_sam(insam, header=None):
+    """
+    Iterate SamRecords from a sam stream, header lines are passed to header (a callable)
+    """
+    for line in insam:
+        if line[0] == '@':
+            if header is not None:
+                header(line)
+        elif line.strip() != '':
+            yield SamRecord(line)
+
+
+def mate_pairs(records):
+    """
+    Group records of a read name sorted (or barcode grouped) stream by read name, yielding
+    (read1, read2, others) where read1/read2 are the primary alignments (None if absent)
+    and others the secondary and supplementary alignments
+    """
+    qname = None
+    r1 = r2 = None
+    others = []
+    for rec in records:
+        if rec.fields[0] != qname:
+            if qname is not None:
+                yield r1, r2, others
+            qname = rec.fields[0]
+            r1 = r2 = None
+            others = []
+        if rec.flag & 0x900:
+            others.append(rec)
+        elif rec.flag & 0x80:
+            r2 = rec
+        else:
+            r1 = rec
+    if qname is not None:
+        yield r1, r2, others
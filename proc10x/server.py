@@ -0,0 +1,200 @@
+"""
+Copyright 2018 Matt Settles
+
+Local job server, a long lived process (holding the whitelist) accepting jobs over a
+Unix socket, and the thin client that submits a job and relays its messages.
+
+The client sends one JSON line, the request ({'argv': [...], 'cwd': ..., 'version': ...}).
+Each job is run in a process forked from the server, so it starts with everything the
+server has loaded, at most [jobs] at a time (later connections wait). The job's stderr
+is sent back to the client as JSON lines {'stderr': text}, the last line is {'exit': status}.
+The job is interrupted (KeyboardInterrupt) if the client disconnects.
+"""
+import os
+import sys
+import json
+import errno
+import socket
+import signal
+import thread
+import threading
+import traceback
+
+
+class JobStream:
+    """
+    file like stderr of a job, written to the client connection
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, text):
+        try:
+            self.conn.sendall(json.dumps({'stderr': text}) + '\n')
+        except socket.error:
+            pass  # client gone, the job is being interrupted
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+
+def watch_client(conn, state):
+    """
+    interrupt the job when the client disconnects (before the job is done)
+    """
+    try:
+        while conn.recv(4096) != '':
+            pass
+    except socket.error:
+        pass
+    if not state['done']:
+        thread.interrupt_main()
+
+
+def run_job(conn, handle, tag):
+    """
+    in the forked job process, read the request, run handle(request) with stderr sent to the
+    client and send the exit status
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    status = 1
+    try:
+        request = json.loads(conn.makefile('r').readline())
+        state = {'done': False}
+        watcher = threading.Thread(target=watch_client, args=(conn, state))
+        watcher.daemon = True
+        watcher.start()
+        sys.stderr = JobStream(conn)
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            status = handle(request)
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                message = str(e.code)
+                sys.stderr.write(message if message.endswith('\n') else message + '\n')
+                status = 1
+        except BaseException:
+            sys.stderr.write("".join(traceback.format_exception(*sys.exc_info())))
+            sys.stderr.write("%s\tERROR\tjob failed\n" % tag)
+            status = 1
+        state['done'] = True
+        conn.sendall(json.dumps({'exit': status}) + '\n')
+    except BaseException:
+        pass
+    finally:
+        try:
+            conn.close()
+        except socket.error:
+            pass
+        os._exit(status)
+
+
+def listen(path):
+    """
+    bind the Unix socket, replacing a stale socket file (no server answering)
+    """
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            probe.close()
+            raise Exception("a server is already listening on %s" % path)
+        except socket.error:
+            os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(64)
+    return sock
+
+
+def serve(path, handle, jobs=1, tag='SERVER', verbose=True):
+    """
+    accept jobs on the Unix socket path until terminated (SIGTERM or SIGINT), handle(request)
+    runs a job and returns the exit status. Running jobs are left to finish when the server ends
+    """
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+
+    sock = listen(path)
+    children = {}
+    njobs = 0
+
+    def reap(block):
+        while len(children) > 0:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid == 0:
+                return
+            if verbose:
+                sys.stderr.write("%s\tSERVER\tjob %i finished, exit status %i\n" % (tag, children.pop(pid, 0), os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1))
+            else:
+                children.pop(pid, None)
+            if block:
+                return
+
+    if verbose:
+        sys.stderr.write("%s\tSERVER\tlistening on %s, %i job(s) at a time\n" % (tag, path, jobs))
+    try:
+        while 1:
+            try:
+                conn, address = sock.accept()
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            reap(False)
+            while len(children) >= jobs:
+                reap(True)
+            njobs += 1
+            pid = os.fork()
+            if pid == 0:
+                sock.close()
+                run_job(conn, handle, tag)
+            conn.close()
+            children[pid] = njobs
+            if verbose:
+                sys.stderr.write("%s\tSERVER\tjob %i started, pid %i\n" % (tag, njobs, pid))
+    except KeyboardInterrupt:
+        reap(False)
+        if verbose:
+            sys.stderr.write("%s\tSERVER\tstopping, %i job(s) still running\n" % (tag, len(children)))
+    finally:
+        sock.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def submit(path, request):
+    """
+    send a job to the server, relay its stderr, returns the job exit status
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(json.dumps(request) + '\n')
+    status = 1
+    messages = sock.makefile('r')
+    while 1:
+        line = messages.readline()  # not iteration, it reads ahead
+        if line == '':
+            sys.stderr.write("SERVER\tERROR\tconnection to the server lost\n")
+            break
+        message = json.loads(line)
+        if 'stderr' in message:
+            sys.stderr.write(message['stderr'])
+        elif 'exit' in message:
+            status = message['exit']
+            break
+    sock.close()
+    return status
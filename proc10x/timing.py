@@ -0,0 +1,125 @@
+"""
+Copyright 2018 Matt Settles
+
+Per stage timing of the read processing (process_10xReads.py -p).
+
+Only 1 in every [every] reads is timed (StageTimer.sample), the stages of a sampled read
+are timed as laps, each lap is the time since the previous one:
+    read    - reading the 8 fastq lines (waiting on gzip --decompress)
+    parse   - splitting the reads into the barcode, trim and read fragment
+    lookup  - hashing the gem barcode and the whitelist lookup
+    hamming - resolving a barcode not in the whitelist (one mismatch neighbours)
+    count   - the barcode count update
+    format  - building the output fastq records
+    write   - writing the records to the output buffer
+Reported seconds of these are estimated (sampled seconds * every). Time blocked writing
+to the output (the gzip pipe, the stdout pipe to bwa, or a file) is measured on every
+flush of the output buffer (TimedWriter), a large share is a sign of backpressure. A
+flush within a sampled lap is taken out of the lap, it is counted (once) as blocked, so
+the estimated stages and blocked together do not exceed the wall time.
+"""
+import sys
+import time
+
+stages = ['read', 'parse', 'lookup', 'hamming', 'count', 'format', 'write']
+
+
+class StageTimer:
+    """
+    cumulative seconds and calls of the stages of the sampled reads, and seconds blocked
+    flushing output
+    """
+    def __init__(self, every=10):
+        self.every = every
+        self.seconds = dict((stage, 0.0) for stage in stages)
+        self.calls = dict((stage, 0) for stage in stages)
+        self.blocked = 0.0
+        self.flushes = 0
+        self.last = 0.0
+        self.last_blocked = 0.0
+
+    def sample(self, count):
+        """
+        returns the timer (started) if read number count is sampled, otherwise None
+        """
+        if count % self.every == 0:
+            self.last = time.time()
+            self.last_blocked = self.blocked
+            return self
+        return None
+
+    def lap(self, stage):
+        now = time.time()
+        # time blocked flushing during the lap is already in blocked, not scaled by every
+        self.seconds[stage] += max(0.0, now - self.last - (self.blocked - self.last_blocked))
+        self.calls[stage] += 1
+        self.last = now
+        self.last_blocked = self.blocked
+
+    def merge(self, other):
+        """
+        add the counters of another timer (a lane worker)
+        """
+        for stage in stages:
+            self.seconds[stage] += other.seconds[stage]
+            self.calls[stage] += other.calls[stage]
+        self.blocked += other.blocked
+        self.flushes += other.flushes
+
+    def estimate(self, stage):
+        return self.seconds[stage] * self.every
+
+    def summary(self, wall):
+        """
+        short form for the PROCESS READS line, estimated percent of wall time per stage
+        """
+        wall = max(wall, 1e-9)
+        return '|'.join(['%s:%.1f%%' % (stage, 100 * self.estimate(stage) / wall) for stage in stages] +
+                        ['blocked:%.1f%%' % (100 * self.blocked / wall)])
+
+    def report(self, prefix, wall):
+        """
+        write the per stage summary to stderr
+        """
+        wall = max(wall, 1e-9)
+        sys.stderr.write("%s\tPROFILE\t1 in %i reads timed, stage seconds are estimated\n" % (prefix, self.every))
+        for stage in stages:
+            calls = self.calls[stage]
+            sys.stderr.write("%s\tPROFILE\t%s\tcalls:%i|seconds:%.2f|us/call:%.2f|wall:%.1f%%\n" % (prefix, stage, calls * self.every, self.estimate(stage),
+                             (1e6 * self.seconds[stage] / calls) if calls > 0 else 0, 100 * self.estimate(stage) / wall))
+        sys.stderr.write("%s\tPROFILE\tblocked\tflushes:%i|seconds:%.2f|wall:%.1f%%\n" % (prefix, self.flushes, self.blocked, 100 * self.blocked / wall))
+
+
+class TimedWriter:
+    """
+    buffer writes to a file object, timing the time blocked in each flush
+    """
+    def __init__(self, f, timer, bufsize=65536):
+        self.f = f
+        self.timer = timer
+        self.bufsize = bufsize
+        self.buf = []
+        self.size = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.size += len(data)
+        if self.size >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        stime = time.time()
+        if self.size > 0:
+            self.f.write(''.join(self.buf))
+            self.buf = []
+            self.size = 0
+        self.f.flush()
+        self.timer.blocked += time.time() - stime
+        self.timer.flushes += 1
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.flush()
+        self.f.close()
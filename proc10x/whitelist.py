@@ -0,0 +1,228 @@
+"""
+Copyright 2018 Matt Settles
+
+Gem barcode correction against the whitelist. A barcode is a MATCH when it is in the
+whitelist, MISMATCH1 when exactly one whitelisted barcode is one mismatch away,
+AMBIGUOUS when more than one is, otherwise UNKNOWN. N (and any other character)
+is treated as A, as seqToHash always has.
+
+seqToHash/getHammingOne/classify are the engine used by process_10xReads.py, a dict
+of whitelist hashes. The engine classes share one interface (key, exact, hamming1,
+classify, barcode) so alternatives can be timed and checked against it
+(bench/bench_barcodes.py):
+    HashEngine     - seqToHash + getHammingOne, the current engine
+    FastHashEngine - the same dict, hash by str.translate/int and the mismatch
+                     hashes by arithmetic on the hash, no strings are built
+    StringEngine   - a set of the (normalised) barcode strings
+
+BackgroundLoad loads the whitelist on a thread, so the load overlaps the opening (gzip
+start up and decompression) and skipping of the inputs.
+"""
+import sys
+import string
+import threading
+
+from proc10x.barcodes import seq_to_hash
+
+
+def seqToHash(seq):
+    encoding = {'a': 0, 'c': 1, 'g': 2, 't': 3, 'A': 0, 'C': 1, 'G': 2, 'T': 3}
+    result = 0
+    i = 0
+    while i < len(seq):
+        result += encoding.get(seq[i], 0) * 4**i  # N character defaults to A
+        i += 1
+    return result
+
+
+def getHammingOne(seq):
+    basedict = {
+        'A': ['C', 'G', 'T'],
+        'C': ['A', 'G', 'T'],
+        'G': ['A', 'C', 'T'],
+        'T': ['A', 'C', 'G'],
+        'N': ['A', 'C', 'G', 'T'],
+        'a': ['C', 'G', 'T'],
+        'c': ['A', 'G', 'T'],
+        'g': ['A', 'C', 'T'],
+        't': ['A', 'C', 'G'],
+        'n': ['A', 'C', 'G', 'T']}
+    res = []
+    i = 0
+    while i < len(seq):
+        for j in basedict.get(seq[i]):
+            res.append(seq[:i] + j + seq[i + 1:])
+        i += 1
+    return [seqToHash(sequence) for sequence in res]
+
+
+def classify(seq, gbcDict, profile=None):
+    """
+    Compare a gem barcode to the whitelist (gbcDict, hash -> barcode), returns the status
+    and the hash of the whitelisted barcode (None for AMBIGUOUS and UNKNOWN),
+    profile (a sampled proc10x.timing.StageTimer) times the lookup and hamming stages
+    """
+    key = seqToHash(seq)
+    if key in gbcDict:  # barcode matches whitelist
+        if profile is not None:
+            profile.lap('lookup')
+        return "MATCH", key
+    if profile is not None:
+        profile.lap('lookup')
+    hits = [ham for ham in getHammingOne(seq) if ham in gbcDict]
+    if profile is not None:
+        profile.lap('hamming')
+    if len(hits) == 0:  # greater than 1 hamming distance
+        return "UNKNOWN", None
+    elif len(hits) == 1:  # single hit hamming distance of 1
+        return "MISMATCH1", hits[0]
+    return "AMBIGUOUS", None  # multihit hamming distance of 1
+
+
+class HashEngine:
+    """
+    dict of whitelist hashes, seqToHash and getHammingOne (process_10xReads.py)
+    """
+    name = 'hash'
+
+    def __init__(self, barcodes):
+        self.gbcDict = {}
+        for bc in barcodes:
+            self.gbcDict[seqToHash(bc)] = bc
+
+    def key(self, seq):
+        return seqToHash(seq)
+
+    def exact(self, key):
+        return key in self.gbcDict
+
+    def hamming1(self, seq):
+        """
+        keys of the whitelisted barcodes one mismatch away
+        """
+        return [ham for ham in getHammingOne(seq) if ham in self.gbcDict]
+
+    def classify(self, seq):
+        return classify(seq, self.gbcDict)
+
+    def barcode(self, key):
+        return self.gbcDict[key]
+
+
+class FastHashEngine(HashEngine):
+    """
+    same keys as HashEngine, computed without per base python loops
+    """
+    name = 'fasthash'
+
+    def __init__(self, barcodes):
+        self.gbcDict = {}
+        for bc in barcodes:
+            self.gbcDict[seq_to_hash(bc)] = bc
+
+    def key(self, seq):
+        return seq_to_hash(seq)
+
+    def hamming1(self, seq, key=None):
+        if key is None:
+            key = seq_to_hash(seq)
+        gbcDict = self.gbcDict
+        hits = []
+        shift = 1
+        for i in range(len(seq)):
+            base = key - ((key // shift) & 3) * shift
+            # 4 hashes at position i, one is the barcode itself (or N as A, not whitelisted)
+            for b in (0, shift, 2 * shift, 3 * shift):
+                ham = base + b
+                if ham != key and ham in gbcDict:
+                    hits.append(ham)
+            shift *= 4
+        return hits
+
+    def classify(self, seq):
+        key = seq_to_hash(seq)
+        if key in self.gbcDict:
+            return "MATCH", key
+        hits = self.hamming1(seq, key)
+        if len(hits) == 0:
+            return "UNKNOWN", None
+        elif len(hits) == 1:
+            return "MISMATCH1", hits[0]
+        return "AMBIGUOUS", None
+
+
+class StringEngine:
+    """
+    set of the whitelisted barcode strings, barcodes are upper cased and non ACGT read as A
+    """
+    name = 'string'
+
+    _normal = string.maketrans('acgt' + ''.join(chr(i) for i in range(256) if chr(i) not in 'ACGTacgt'),
+                               'ACGT' + 'A' * 248)
+
+    def __init__(self, barcodes):
+        self.whitelist = set(barcodes)
+
+    def key(self, seq):
+        return seq.translate(self._normal)
+
+    def exact(self, key):
+        return key in self.whitelist
+
+    def hamming1(self, seq, key=None):
+        if key is None:
+            key = self.key(seq)
+        whitelist = self.whitelist
+        hits = []
+        for i in range(len(key)):
+            prefix = key[:i]
+            suffix = key[i + 1:]
+            for b in 'ACGT':
+                if b != key[i]:
+                    ham = prefix + b + suffix
+                    if ham in whitelist:
+                        hits.append(ham)
+        return hits
+
+    def classify(self, seq):
+        key = self.key(seq)
+        if key in self.whitelist:
+            return "MATCH", key
+        hits = self.hamming1(seq, key)
+        if len(hits) == 0:
+            return "UNKNOWN", None
+        elif len(hits) == 1:
+            return "MISMATCH1", hits[0]
+        return "AMBIGUOUS", None
+
+    def barcode(self, key):
+        return key
+
+
+engines = [HashEngine, FastHashEngine, StringEngine]
+
+
+class BackgroundLoad:
+    """
+    call load(*args) on a (daemon) thread, result() waits for it and returns its value, or
+    raises its exception
+    """
+    def __init__(self, load, *args):
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(load, args))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, load, args):
+        try:
+            self.value = load(*args)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def result(self):
+        while self.thread.is_alive():
+            self.thread.join(0.1)  # a plain join() would not see KeyboardInterrupt
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
@@ -13,498 +13,422 @@ import argparse
 import sys
 import os
 import time
-import glob
-import errno
-from subprocess import Popen, PIPE, STDOUT
+import json
+import shutil
+from multiprocessing import Pool, Value, TimeoutError
 import string
 from collections import Counter
-import numpy
+
+from proc10x.barcodes import seq_to_hash
+from proc10x.whitelist import seqToHash, classify, BackgroundLoad
+from proc10x.timing import StageTimer
+from proc10x.metrics import RunMetrics
+from proc10x.progress import InputProgress
+from proc10x.fastqio import TwoReadIlluminaRun, IlluminaTwoReadOutput, resolve_read_files, BUFFER_SIZE
+from proc10x.server import serve, submit
+from proc10x.pipeline import ThreadedReader, ThreadedWriter
 
 
 def median(lst):
+    import numpy  # only needed for the status lines, not at start up
     return numpy.median(numpy.array(lst))
 
 
-def sp_gzip_read(file, bufsize=-1):
-    p = Popen('gzip --decompress --to-stdout'.split() + [file], stdout=PIPE, stderr=STDOUT, bufsize=bufsize)
-    return p.stdout
+rcs = string.maketrans('TAGCtagc', 'ATCGATCG')
 
 
-def sp_gzip_write(file, bufsize=-1):
-    filep = open(file, 'wb')
-    p = Popen('gzip', stdin=PIPE, stdout=filep, shell=True, bufsize=bufsize)
-    return p.stdin
+def revcomp(seq):
+    return seq.translate(rcs)[::-1]
+
+
+def rev(seq):
+    return seq[::-1]
 
 
-def make_sure_path_exists(path):
+def load_whitelist(verbose):
     """
-    Try and create a path, if not error
+    Load the gem barcode dictionary (hash -> barcode) with the whitelist
     """
-    if path != '':
-        try:
-            os.makedirs(path)
-        except OSError as exception:
-            if exception.errno != errno.EEXIST:
-                raise
-    return path
+    gbcDict = {}
+    with open(whitelist_file, 'r') as f:
+        for bc_sequence in f:
+            gbcDict[seqToHash(bc_sequence.strip())] = bc_sequence.strip()
+        if verbose:
+            sys.stderr.write("PROCESS\tNOTE\tFinished reading in barcode whitelist\n")
+    return gbcDict
 
 
-rcs = string.maketrans('TAGCtagc', 'ATCGATCG')
+def classify_barcode(fragment, gbcDict, gbcCounter, profile=None):
+    """
+    Compare the gem barcode of the fragment to the whitelist, correcting a single mismatch,
+    count whitelisted barcodes and return the status (MATCH, MISMATCH1, AMBIGUOUS or UNKNOWN)
+    profile, a sampled StageTimer, times the lookup, hamming and count stages
+    """
+    status, key = classify(fragment['gem_bc'], gbcDict, profile)
+    if key is not None:
+        if status == "MISMATCH1":
+            fragment['gem_bc'] = gbcDict[key]
+        gbcCounter[key] += 1
+    fragment['status'] = status
+    if profile is not None:
+        profile.lap('count')
+    return fragment['status']
+
+
+def write_status(read_count, rate, gbcCounter, barcode_match, barcode_1mismatch, barcode_ambiguous, barcode_unknown):
+    sys.stderr.write("PROCESS\tREADS\treads analyzed:%i|reads/sec:%i|barcodes:%i|reads/barcode:%f\n" % (read_count, round(rate, 0), len(gbcCounter), median(gbcCounter.values())))
+    sys.stderr.write("PROCESS\tBARCODE\tMATCH: %i (%.2f%%)\n" % (barcode_match, (float(barcode_match) / read_count) * 100))
+    sys.stderr.write("PROCESS\tBARCODE\tMISMATCH1: %i (%.2f%%)\n" % (barcode_1mismatch, (float(barcode_1mismatch) / read_count) * 100))
+    sys.stderr.write("PROCESS\tBARCODE\tAMBIGUOUS: %i (%.2f%%)\n" % (barcode_ambiguous, (float(barcode_ambiguous) / read_count) * 100))
+    sys.stderr.write("PROCESS\tBARCODE\tUNKNOWN: %i (%.2f%%)\n" % (barcode_unknown, (float(barcode_unknown) / read_count) * 100))
+
+
+def write_barcode_counts(filename, gbcDict, gbcCounter):
+    """
+    write the whitelisted barcode counts, sorted by barcode, so count files can be merged without sorting (merge_barcodes.py)
+    """
+    with open(filename, 'w') as f:
+        [f.write('{0}\t{1}\n'.format(bc, value)) for bc, value in sorted((gbcDict[key], value) for key, value in gbcCounter.items())]
 
 
-def revcomp(seq):
-    return seq.translate(rcs)[::-1]
+def read_barcode_counts(filename):
+    gbcCounter = Counter()
+    with open(filename, 'r') as f:
+        for line in f:
+            bc, count = line.rstrip('\n').split('\t')
+            gbcCounter[seq_to_hash(bc)] = int(count)
+    return gbcCounter
 
 
-def rev(seq):
-    return seq[::-1]
+def write_checkpoint(output_dir, state, gbcCounter, gbcDict):
+    """
+    write the checkpoint, the barcode counts snapshot is written first under a new name, and
+    the checkpoint file is replaced atomically, so a kill at any time leaves a consistent checkpoint
+    """
+    snapshot = output_dir + '_checkpoint_%i_barcodes.txt' % state['read_count']
+    write_barcode_counts(snapshot + '.tmp', gbcDict, gbcCounter)
+    os.rename(snapshot + '.tmp', snapshot)
+    previous = state.get('barcodes')
+    state['barcodes'] = snapshot
+    write_checkpoint_state(output_dir, state)
+    if previous is not None and previous != snapshot and os.path.isfile(previous):
+        os.remove(previous)
 
 
-def seqToHash(seq):
-    encoding = {'a': 0, 'c': 1, 'g': 2, 't': 3, 'A': 0, 'C': 1, 'G': 2, 'T': 3}
-    result = 0
-    i = 0
-    while i < len(seq):
-        result += encoding.get(seq[i], 0) * 4**i  # N character defaults to A
-        i += 1
-    return result
-
-
-def getHammingOne(seq):
-    basedict = {
-        'A': ['C', 'G', 'T'],
-        'C': ['A', 'G', 'T'],
-        'G': ['A', 'C', 'T'],
-        'T': ['A', 'C', 'G'],
-        'N': ['A', 'C', 'G', 'T'],
-        'a': ['C', 'G', 'T'],
-        'c': ['A', 'G', 'T'],
-        'g': ['A', 'C', 'T'],
-        't': ['A', 'C', 'G'],
-        'n': ['A', 'C', 'G', 'T']}
-    res = []
-    i = 0
-    while i < len(seq):
-        for j in basedict.get(seq[i]):
-            res.append(seq[:i] + j + seq[i + 1:])
-        i += 1
-    return [seqToHash(sequence) for sequence in res]
-
-
-def infer_read_file_name(baseread, seakread):
-    ''' Find other read filenames (ex. R1, R2, R3, R4) in the directory based on Read 1 filename '''
-    basename = os.path.basename(baseread)
-    path = os.path.dirname(os.path.realpath(baseread))
-    testname = glob.glob(path + '/*' + os.path.splitext(baseread)[1])
-    count = 0
-    pos = -1
-    read = []
-    for name in testname:
-        count = 0
-        if os.path.basename(name) == basename:  # ignore the same file
-            continue
-        elif len(os.path.basename(name)) != len(basename):  # must be the same length
-            continue
-        else:
-            for i, (ch1, ch2) in enumerate(zip(os.path.basename(name), basename)):  # calculate the hamming distance
-                if ch1 != ch2 and ch2 == '1' and ch1 == seakread:
-                    count += 1
-                    pos = i
-            if count == 1:
-                read.append(path + '/' + basename[0:pos] + seakread + basename[pos + 1:])
-                continue
-    if len(read) == 1:
-        return read[0]
-    else:
-        raise Exception("Error inferring read " + seakread + " from read 1, found " + str(len(read)) + " suitable matches.")
+def write_checkpoint_state(output_dir, state):
+    """
+    write the checkpoint state to a temporary file and rename it over the checkpoint file
+    """
+    with open(output_dir + '_checkpoint.json.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(output_dir + '_checkpoint.json.tmp', output_dir + '_checkpoint.json')
+
 
+def init_lane_worker(gbcDict, progress, consumed):
+    global lane_gbcDict
+    global lane_progress
+    global lane_consumed
+    lane_gbcDict = gbcDict
+    lane_progress = progress
+    lane_consumed = consumed
 
-class TwoReadIlluminaRun:
+
+def add_lane_progress(reads, nbytes):
     """
-    Class to open/close and read a two read illumina sequencing run. Data is expected to be in
-    fastq format (possibly gzipped)
+    add to the reads processed and input bytes consumed by all lanes (shared with the parent, for --metrics)
     """
-    def __init__(self, read1, read2, gbctrim, trim, profile, verbose):
-        """
-        Initialize a TwoReadIlluminaRun object with expandible paths (with glob) to the two
-        sequencing read files. A vector of multiple files per read is allowed.
-        """
-        self.verbose = verbose
-        self.gbctrim = gbctrim
-        self.trim = trim
-        self.profile = profile
-        self.isOpen = False
-        self.mcount = 0
-        self.fread1 = []
-        self.fread2 = []
-        try:
-            for fread in read1:
-                self.fread1.extend(glob.glob(fread))
-                if len(self.fread1) == 0 or not all(os.path.isfile(f) for f in self.fread1):
-                    sys.stderr.write('PROCESS\tERROR:[TwoReadIlluminaRun] read1 file(s) not found\n')
-                    raise Exception
-            if read2 is None:
-                for fread in self.fread1:
-                    self.fread2.append(infer_read_file_name(fread, "2"))
-            else:
-                for fread in read2:
-                    self.fread2.extend(glob.glob(fread))
-                    if len(self.fread2) == 0 or not all(os.path.isfile(f) for f in self.fread2):
-                        sys.stderr.write('PROCESS\tERROR:[TwoReadIlluminaRun] read2 file not found\n')
-                        raise Exception
-            if len(self.fread1) != len(self.fread2):
-                sys.stderr.write('PROCESS\tERROR:[TwoReadIlluminaRun] Inconsistent number of files for each read\n')
-                raise
-        except Exception:
-            raise
-        # record the number of files per read
-        self.numberoffiles = len(self.fread1)
-
-    def open(self):
-        """
-        Open a OneReadIlluminaRun file set, if file ends in .gz, open will use gzip
-        """
-        if self.isOpen:
-            self.close()
-        if self.numberoffiles > 0:
-            try:
-                read1 = self.fread1.pop()
-                if read1.split(".")[-1] == "gz":
-                    self.R1 = sp_gzip_read(read1)
-                else:
-                    self.R1 = open(read1, 'r')
-                read2 = self.fread2.pop()
-                if read2.split(".")[-1] == "gz":
-                    self.R2 = sp_gzip_read(read2)
-                else:
-                    self.R2 = open(read2, 'r')
-            except Exception:
-                sys.stderr.write('PROCESS\tERROR:[TwoReadIlluminaRun] cannot open input files\n')
-                raise
-            self.isOpen = True
-            self.numberoffiles -= 1
-            if self.verbose:
-                sys.stderr.write("PROCESS\tFILES\t%s,%s\n" % (read1, read2))
-            return 0
-        else:
-            return 1
-
-    def close(self):
-        """
-        Close a TwoReadIlluminaRun file set
-        """
-        self.R1.close()
-        self.R2.close()
-        self.isOpen = False
-
-    def count(self):
-        """
-        Provide the current count of reads read
-        """
-        return self.mcount
-
-    def nfiles(self):
-        """
-        provide the number of files given
-        """
-        return self.numberoffiles
-
-    def next_raw(self, ncount=1):
-        """
-        Extract and store the next [count] reads into a TwoSequenceReadSet object.
-        If the file object is not open, or if 'next' reaches the end of a file, it will
-        attempt to open the file in the list, or gracefully exit
-        """
-        if not self.isOpen:
-            try:
-                if self.open() == 1:
-                    sys.stderr.write('PROCESS\tERROR:[TwoReadIlluminaRun] ERROR Opening files for reading\n')
-                    raise
-            except Exception:
-                raise
-        reads = []
-        i = 0
-        while i < ncount:
-            try:
-                # pull in read 1
-                status = 'UNKNOWN'
-                id1 = self.R1.next().strip()
-                seq1 = self.R1.next().strip()
-                self.R1.next()  # *
-                qual1 = self.R1.next().strip()
-                assert(len(seq1) == len(qual1))
-                if id1 == '' or seq1 == ''or qual1 == '':
-                    self.close()
-                    raise StopIteration
-                # pull in read2
-                id2 = self.R2.next().strip()
-                seq2 = self.R2.next().strip()
-                self.R2.next()  # *
-                qual2 = self.R2.next().strip()
-                assert(len(seq2) == len(qual2))
-                if id2 == '' or seq2 == ''or qual2 == '':
-                    self.close()
-                    raise StopIteration
-                # check to make sure the IDs match across all files
-                assert(id1.split()[0] == id2.split()[0])
-                # TODO: add in profiler
-                rid = id1.split()[0][1:]
-                rbc = (id1.split()[1]).split(':')[3]
-                if rbc == '':
-                    rbc = "1"
-                gbc = seq1[0:self.gbctrim]
-                gbcq = qual1[0:self.gbctrim]
-                trim = seq1[self.gbctrim:self.gbctrim + self.trim]
-                trimq = qual1[self.gbctrim:self.gbctrim + self.trim]
-                seq1 = seq1[self.gbctrim + self.trim:]
-                qual1 = qual1[self.gbctrim + self.trim:]
-                fragment = {'id': rid,
-                            'status': status,
-                            'library_bc': rbc,
-                            'gem_bc': gbc,
-                            'sgem_bc': gbc,
-                            'sgem_qual': gbcq,
-                            'trim_seq': trim,
-                            'trim_qual': trimq,
-                            'read1_seq': seq1,
-                            'read1_qual': qual1,
-                            'read2_seq': seq2,
-                            'read2_qual': qual2}
-                reads.append(fragment)
-                self.mcount += 1
-            except StopIteration:
-                if self.numberoffiles > 0:
-                    try:
-                        if self.open() == 1:
-                            sys.stderr.write('PROCESS\tERROR:[TwoReadIlluminaRun] ERROR Opening files for reading\n')
-                            raise
-                    except Exception:
-                        raise Exception
-                    continue
-                raise StopIteration
-            except Exception:
-                sys.stderr.write('PROCESS\tERROR:[TwoReadIlluminaRun] Error reading next read\n')
-                raise
-            i += 1
-        if len(reads) == 1:
-            return reads[0]
-        else:
-            return reads
-
-
-class IlluminaTwoReadOutput:
+    with lane_progress.get_lock():
+        lane_progress.value += reads
+    with lane_consumed.get_lock():
+        lane_consumed.value += nbytes
+
+
+def process_lane(args):
     """
-    Given Paired-end reads, output them to a paired files (possibly gzipped)
+    Process a single lane file pair (in a worker), writing to the lane output prefix,
+    returns the lane read count, status counts and barcode counts
     """
-    def __init__(self, output_prefix, uncompressed, interleaved):
-        """
-        Initialize an IlluminaTwoReadOutput object with output_prefix and whether or not
-        output should be compressed with gzip [uncompressed True/False]
-        """
-        self.isOpen = False
-        self.output_prefix = output_prefix
-        self.interleaved = interleaved
-        self.uncompressed = uncompressed
-        self.mcount = 0
-
-        if output_prefix == "stdout":
-            self.interleaved = True
-            self.uncompressed = True
-        elif self.uncompressed is True:
-            if os.path.isfile(self.output_prefix + "_R1_001.fastq"):
-                sys.stderr.write('PROCESS\tWARNING:[IlluminaTwoReadOutput] File with prefix: %s exists, DELETING\n' % self.output_prefix)
-                try:
-                    if self.interleaved:
-                        os.remove(self.output_prefix + "_R1_001.fastq")
-                    else:
-                        os.remove(self.output_prefix + "_R1_001.fastq")
-                        os.remove(self.output_prefix + "_R2_001.fastq")
-                except Exception:
-                    sys.stderr.write('PROCESS\tWARNING:[IlluminaTwoReadOutput] Cannot delete file with prefix: %s\n' % self.output_prefix)
-                    raise
-        else:
-            if os.path.isfile(self.output_prefix + "_R1_001.fastq.gz"):
-                sys.stderr.write('PROCESS\tWARNING:[IlluminaTwoReadOutput] File with prefix: %s exists, DELETING\n' % self.output_prefix)
-                try:
-                    if self.interleaved:
-                        os.remove(self.output_prefix + "_R1_001.fastq.gz")
-                    else:
-                        os.remove(self.output_prefix + "_R1_001.fastq.gz")
-                        os.remove(self.output_prefix + "_R2_001.fastq.gz")
-                except Exception:
-                    sys.stderr.write('PROCESS\tWARNING:[IlluminaTwoReadOutput] Cannot delete file with prefix: %s\n' % self.output_prefix)
-                    raise
-
-    def open(self):
-        """
-        Open the two read files for writing, appending _R1.fastq and _R2.fastq to the output_prefix.
-        Create directories as needed.
-        """
-        if self.isOpen:
-            self.close()
-        try:
-            if self.output_prefix == "stdout":
-                self.R1f = sys.stdout
-            else:
-                make_sure_path_exists(os.path.dirname(self.output_prefix))
-                if self.uncompressed is True:
-                    self.R1f = open(self.output_prefix + '_R1_001.fastq', 'w')
-                    if not self.interleaved:
-                        self.R2f = open(self.output_prefix + '_R2_001.fastq', 'w')
-                else:
-                    self.R1f = sp_gzip_write(self.output_prefix + '_R1_001.fastq.gz')
-                    if not self.interleaved:
-                        self.R2f = sp_gzip_write(self.output_prefix + '_R2_001.fastq.gz')
-        except Exception:
-            sys.stderr.write('PROCESS\tERROR:[IlluminaTwoReadOutput] Cannot write reads to file with prefix: %s\n' % self.output_prefix)
-            raise
-        self.isOpen = True
-        return 0
-
-    def close(self):
-        """
-        Close an IlluminaTwoReadOutput file set
-        """
-        try:
-            self.R1f.close()
-            if not self.interleaved:
-                self.R2f.close()
-        except Exception:
-            raise
-        self.isOpen = False
-        sys.stderr.write("PROCESS\tFILES\tWrote %i reads to output\n" % self.mcount)
-
-    def count(self):
-        """
-        Provide the current read count for the file output
-        """
-        return self.mcount
-
-    def writePairedFastq(self, fragment):
-        newid = '@' + (':').join([fragment['gem_bc'], fragment['id']])
-        # read 1
-        self.R1f.write((' ').join([newid, (':').join(['1', 'N', '0', fragment['library_bc'], ("_").join([fragment['status'], fragment['sgem_bc'], fragment['sgem_qual'], fragment['trim_seq'], fragment['trim_qual']])])]) + '\n')
-        self.R1f.write(fragment['read1_seq'] + '\n')
-        self.R1f.write('+\n')
-        self.R1f.write(fragment['read1_qual'] + '\n')
-        # read 2
-        self.R2f.write((' ').join([newid, (':').join(['2', 'N', '0', fragment['library_bc'], ("_").join([fragment['status'], fragment['sgem_bc'], fragment['sgem_qual'], fragment['trim_seq'], fragment['trim_qual']])])]) + '\n')
-        self.R2f.write(fragment['read2_seq'] + '\n')
-        self.R2f.write('+\n')
-        self.R2f.write(fragment['read2_qual'] + '\n')
-        self.mcount += 1
-
-    def writeFastqInterleaved(self, fragment):
-        newid = '@' + (':').join([fragment['gem_bc'], fragment['id']])
-        # read 1
-        self.R1f.write((' ').join([newid, (':').join(['1', 'N', '0', fragment['library_bc'], ("_").join([fragment['status'], fragment['sgem_bc'], fragment['sgem_qual'], fragment['trim_seq'], fragment['trim_qual']])])]) + '\n')
-        self.R1f.write(fragment['read1_seq'] + '\n')
-        self.R1f.write('+\n')
-        self.R1f.write(fragment['read1_qual'] + '\n')
-        # read 2
-        self.R1f.write((' ').join([newid, (':').join(['2', 'N', '0', fragment['library_bc'], ("_").join([fragment['status'], fragment['sgem_bc'], fragment['sgem_qual'], fragment['trim_seq'], fragment['trim_qual']])])]) + '\n')
-        self.R1f.write(fragment['read2_seq'] + '\n')
-        self.R1f.write('+\n')
-        self.R1f.write(fragment['read2_qual'] + '\n')
-
-    def writeRead(self, fragment):
-        """
-        Write the paired read in the queue to the output files
-        """
-        if (len(fragment) == 0):
-            pass
-        else:
-            if not self.isOpen:
-                try:
-                    if self.open() == 1:
-                        sys.stderr.write('PROCESS\tERROR:[IlluminaTwoReadOutput] ERROR Opening files for writing\n')
-                        raise
-                except Exception:
-                    raise
+    lane, read1, read2, lane_prefix, output_all, interleaved, bctrim, trim, nogzip, per_lane, profile_every, verbose, level, block_size = args
+    gbcCounter = Counter()
+    status_counts = Counter()
+    lane_count = 0
+    lstime = time.time()
+    profiler = StageTimer(profile_every) if profile_every > 0 else None
+    prof = None
+
+    output = IlluminaTwoReadOutput(lane_prefix, nogzip, 'interleaved' if interleaved else 'paired', profile=profiler, level=level, block_size=block_size)
+    iterator = TwoReadIlluminaRun([read1], [read2], gbctrim=bctrim, trim=trim, verbose=verbose, block_size=block_size)
+    consumed = 0
+    try:
+        while 1:
+            if profiler is not None:
+                prof = profiler.sample(lane_count)
+            fragment = iterator.next_raw(1, prof)
+            lane_count += 1
+            status = classify_barcode(fragment, lane_gbcDict, gbcCounter, prof)
+            status_counts[status] += 1
+            if output_all or status in ("MATCH", "MISMATCH1"):
+                output.writeRead(fragment, prof)
+            if lane_count % 10000 == 0:
+                position = iterator.progress.consumed() or consumed
+                add_lane_progress(10000, position - consumed)
+                consumed = position
+            if lane_count % 250000 == 0 and verbose:
+                sys.stderr.write("PROCESS\tREADS\tlane %i reads analyzed:%i|reads/sec:%i|barcodes:%i%s%s\n" % (lane, lane_count, round(lane_count / (time.time() - lstime), 0), len(gbcCounter),
+                                 iterator.progress.summary(), '|' + profiler.summary(time.time() - lstime) if profiler is not None else ''))
+    except StopIteration:
+        output.close()
+    add_lane_progress(lane_count % 10000, (iterator.progress.total or consumed) - consumed)
+    if per_lane:
+        write_barcode_counts(lane_prefix + '_barcodes.txt', lane_gbcDict, gbcCounter)
+    return lane, lane_count, status_counts, gbcCounter, profiler
+
+
+def main_lanes(read1, read2, output_dir, output_all, interleaved, bctrim, trim, nogzip, lanes, per_lane, verbose, profile_every=0, metrics_file=None, metrics_interval=10.0, gbcDict=None,
+               level=None, block_size=BUFFER_SIZE):
+    """
+    Process each lane file pair with its own worker, lanes write to [output]_laneN, which are
+    concatenated (in the given order) into the output as they finish unless per_lane,
+    barcode counts, status totals and stage timings (profile_every > 0) are merged,
+    gbcDict is the loaded whitelist (job server) or None to load it
+    """
+    global read_count
+
+    # resolve the lane file pairs (globs, inferred read 2)
+    pairs = zip(*resolve_read_files(read1, read2))
+
+    whitelist = BackgroundLoad(load_whitelist, verbose) if gbcDict is None else None
+
+    gbcCounter = Counter()
+    status_counts = Counter()
+    profiler = StageTimer(profile_every) if profile_every > 0 else None
+
+    output = IlluminaTwoReadOutput(output_dir, nogzip, 'interleaved' if interleaved else 'paired')
+    tasks = [(i + 1, r1, r2, output_dir + '_lane%i' % (i + 1), output_all, interleaved, bctrim, trim, nogzip, per_lane, profile_every, verbose, level, block_size) for i, (r1, r2) in enumerate(pairs)]
+
+    progress = Value('L', 0)
+    consumed = Value('L', 0)
+    input_progress = InputProgress([f for pair in pairs for f in pair])
+    # the workers are forked with the whitelist
+    if whitelist is not None:
+        gbcDict = whitelist.result()
+    pool = Pool(min(lanes, len(tasks)), init_lane_worker, (gbcDict, progress, consumed))
+    lanes_done = [0]
+    metrics = None
+    if metrics_file is not None:
+        # reads are the running total of the workers, status and barcodes of the finished lanes
+        metrics = RunMetrics(metrics_file, 'process', lambda: {'reads': progress.value,
+                                                               'status': dict(status_counts),
+                                                               'reads_out': sum(status_counts[s] for s in ["MATCH", "MISMATCH1"] + (["AMBIGUOUS", "UNKNOWN"] if output_all else [])),
+                                                               'barcodes': len(gbcCounter),
+                                                               'queues': {'lanes': len(tasks) - lanes_done[0]},
+                                                               'input': input_progress.values(consumed.value)}, metrics_interval, output_dir)
+    try:
+        results = pool.imap(process_lane, tasks)
+        while lanes_done[0] < len(tasks):
             try:
-                if self.interleaved:
-                    self.writeFastqInterleaved(fragment)
-                else:
-                    self.writePairedFastq(fragment)
-            except Exception:
-                sys.stderr.write('PROCESS\tERROR:[IlluminaTwoReadOutput] Cannot write reads to file with prefix: %s\n' % self.output_prefix)
-                raise
+                lane, lane_count, lane_status, lane_counter, lane_profiler = results.next(metrics_interval if metrics is not None else None)
+            except TimeoutError:
+                metrics.tick()
+                continue
+            lanes_done[0] += 1
+            read_count += lane_count
+            status_counts.update(lane_status)
+            gbcCounter.update(lane_counter)
+            if profiler is not None:
+                profiler.merge(lane_profiler)
+            if not per_lane:
+                for out_file in output.filenames():
+                    lane_file = output_dir + '_lane%i' % lane + out_file[len(output_dir):]
+                    if os.path.isfile(lane_file):
+                        with open(out_file, 'ab') as out:
+                            with open(lane_file, 'rb') as f:
+                                shutil.copyfileobj(f, out, 4 * 1024 * 1024)
+                        os.remove(lane_file)
+            if metrics is not None:
+                metrics.tick()
+        pool.close()
+        pool.join()
+    except (KeyboardInterrupt, SystemExit):
+        pool.terminate()
+        if metrics is not None:
+            metrics.finish('failed')
+        sys.exit("PROCESS\tERROR\t%s unexpectedly terminated\n" % (__name__))
+    except Exception:
+        pool.terminate()
+        if metrics is not None:
+            metrics.finish('failed')
+        sys.stderr.write("".join(traceback.format_exception(*sys.exc_info())))
+        sys.exit("PROCESS\tERROR\tAn unknown fatal error was encountered.\n")
+
+    write_barcode_counts(output_dir + '_barcodes.txt', gbcDict, gbcCounter)
+    if metrics is not None:
+        metrics.finish()
+    if verbose:
+        sys.stderr.write("PROCESS\tFILES\t%i lanes processed, %i at a time\n" % (len(tasks), min(lanes, len(tasks))))
+        write_status(read_count, read_count / (time.time() - stime), gbcCounter, status_counts["MATCH"], status_counts["MISMATCH1"], status_counts["AMBIGUOUS"], status_counts["UNKNOWN"])
+        if profiler is not None:
+            # worker seconds summed over the lanes, relative to the wall time of the run
+            profiler.report('PROCESS', time.time() - stime)
 
 
-def main(read1, read2, output_dir, output_all, interleaved, profile, bctrim, trim, nogzip, verbose):
+def main(read1, read2, output_dir, output_all, interleaved, profile, bctrim, trim, nogzip, verbose, skip=0, nreads=None, checkpoint=0, resume=False, metrics_file=None, metrics_interval=10.0, gbcDict=None, pipeline=0, pipeline_depth=4,
+         level=None, block_size=BUFFER_SIZE):
     # Set up the global variables
     global read_count
     global stime
     global file_path
+    # pipeline > 0, reading and writing run on threads, passing batches of this many reads
+    reader = None
+    writer = None
 
     barcode_match = 0
     barcode_1mismatch = 0
     barcode_ambiguous = 0
     barcode_unknown = 0
 
-    gbcDict = {}
     gbcCounter = Counter()
+    profiler = StageTimer(profile) if profile > 0 else None
+    prof = None
+
+    # checkpoint state, inputs/options must match to resume
+    state = {'version': version_num,
+             'read1': read1,
+             'read2': read2,
+             'options': [output_all, interleaved, bctrim, trim, nogzip, skip, nreads]}
+    checkpoint_file = output_dir + '_checkpoint.json'
+    restart = None
+    if resume and os.path.isfile(checkpoint_file):
+        with open(checkpoint_file, 'r') as f:
+            restart = json.load(f)
+        if restart['read1'] != read1 or restart['read2'] != read2 or restart['options'] != state['options']:
+            sys.exit("PROCESS\tERROR\tcheckpoint %s was written with different inputs or options\n" % checkpoint_file)
+        if restart.get('complete'):
+            sys.stderr.write("PROCESS\tNOTE\tcheckpoint %s, processing is already complete\n" % checkpoint_file)
+            return
+        barcode_match, barcode_1mismatch, barcode_ambiguous, barcode_unknown = restart['status']
+        gbcCounter = read_barcode_counts(restart['barcodes'])
+        read_count = restart['read_count']
+        state['barcodes'] = restart['barcodes']
+        if verbose:
+            sys.stderr.write("PROCESS\tNOTE\tresuming from checkpoint %s at read %i\n" % (checkpoint_file, read_count))
+    elif resume and verbose:
+        sys.stderr.write("PROCESS\tNOTE\tno checkpoint %s, starting from the beginning\n" % checkpoint_file)
+    if restart is None and os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
+    start_count = read_count
 
     # open output files
-    output = IlluminaTwoReadOutput(output_dir, nogzip, interleaved)
+    output = IlluminaTwoReadOutput(output_dir, nogzip, 'interleaved' if interleaved else 'paired', restart['output'] if restart is not None else None, profiler, level=level, block_size=block_size)
 
     # Process read inputs:
-    iterator = TwoReadIlluminaRun(read1, read2, bctrim, trim, profile, verbose)
+    iterator = TwoReadIlluminaRun(read1, read2, gbctrim=bctrim, trim=trim, verbose=verbose, block_size=block_size)
 
-    # Load the gem barcode dictionary with the whitelist
-    with open(os.path.join(file_path, 'barcodes/4M-with-alts-february-2016.txt'), 'r') as f:
-        for bc_sequence in f:
-            gbcDict[seqToHash(bc_sequence.strip())] = bc_sequence.strip()
-        if verbose:
-            sys.stderr.write("PROCESS\tNOTE\tFinished reading in barcode whitelist\n")
+    # Load the gem barcode dictionary with the whitelist (unless given), while the inputs are opened
+    whitelist = BackgroundLoad(load_whitelist, verbose) if gbcDict is None else None
+
+    metrics = None
+    if metrics_file is not None:
+        metrics = RunMetrics(metrics_file, 'process', lambda: {'reads': read_count,
+                                                               'status': {'MATCH': barcode_match, 'MISMATCH1': barcode_1mismatch, 'AMBIGUOUS': barcode_ambiguous, 'UNKNOWN': barcode_unknown},
+                                                               'reads_out': output.count(),
+                                                               'barcodes': len(gbcCounter),
+                                                               'queues': {'input': reader.depth(), 'output': writer.depth()} if reader is not None else {},
+                                                               'input': iterator.progress.values()}, metrics_interval, output_dir)
 
     try:
+        if restart is not None:
+            iterator.resume(restart['input'])
+        elif skip > 0:
+            iterator.skip_raw(skip)
+        # start gzip decompressing the first inputs before waiting on the whitelist
+        if not iterator.isOpen:
+            iterator.open()
+        if whitelist is not None:
+            gbcDict = whitelist.result()
+        iterator.progress.start()
+        if pipeline > 0:
+            reader = ThreadedReader(iterator.raw_batch, pipeline, pipeline_depth)
+            writer = ThreadedWriter(output.writeRead, pipeline, pipeline_depth)
         while 1:
-            fragment = iterator.next_raw()
+            if nreads is not None and read_count >= nreads:
+                break
+            if checkpoint > 0 and read_count % checkpoint == 0 and read_count > start_count:
+                state['read_count'] = read_count
+                state['status'] = [barcode_match, barcode_1mismatch, barcode_ambiguous, barcode_unknown]
+                state['input'] = iterator.position()
+                state['output'] = output.checkpoint()
+                write_checkpoint(output_dir, state, gbcCounter, gbcDict)
+                if verbose:
+                    sys.stderr.write("PROCESS\tNOTE\tcheckpoint at read %i\n" % read_count)
+            if metrics is not None and read_count % 1000 == 0:
+                metrics.tick()
+            if profiler is not None:
+                prof = profiler.sample(read_count)
+            try:
+                if reader is not None:
+                    fragment = reader.next()
+                else:
+                    fragment = iterator.next_raw(1, prof)
+            except StopIteration:
+                break
             read_count += 1
-            if seqToHash(fragment['gem_bc']) in gbcDict:  # barcode matches whitelist
-                gbcCounter[seqToHash(fragment['gem_bc'])] += 1
+            status = classify_barcode(fragment, gbcDict, gbcCounter, prof)
+            if status == "MATCH":
                 barcode_match += 1
-                fragment['status'] = "MATCH"
+            elif status == "MISMATCH1":
+                barcode_1mismatch += 1
+            elif status == "UNKNOWN":
+                barcode_unknown += 1
+                if not output_all:
+                    continue
+            else:
+                barcode_ambiguous += 1
+                if not output_all:
+                    continue
+
+            if writer is not None:
+                writer.write(fragment)
             else:
-                hamming = getHammingOne(fragment['gem_bc'])
-                hamming_test = [ham in gbcDict for ham in hamming]
-                if sum(hamming_test) == 0:  # greater than 1 hamming distance
-                    barcode_unknown += 1
-                    if not output_all:
-                        continue
-                elif sum(hamming_test) == 1:  # single hit hamming distance of 1
-                    index = hamming[[i for i, x in enumerate(hamming_test) if x][0]]
-                    fragment['gem_bc'] = gbcDict[index]
-                    gbcCounter[index] += 1
-                    barcode_1mismatch += 1
-                    fragment['status'] = "MISMATCH1"
-                else:  # multihit hamming distance of 1
-                    barcode_ambiguous += 1
-                    fragment['status'] = "AMBIGUOUS"
-                    if not output_all:
-                        continue
-
-            output.writeRead(fragment)
+                output.writeRead(fragment, prof)
 
             if read_count % 250000 == 0 and verbose:
-                sys.stderr.write("PROCESS\tREADS\treads analyzed:%i|reads/sec:%i|barcodes:%i|median_reads/barcode:%.2f\n" % (read_count, round(read_count / (time.time() - stime), 0), len(gbcCounter), median(gbcCounter.values())))
+                sys.stderr.write("PROCESS\tREADS\treads analyzed:%i|reads/sec:%i|barcodes:%i|median_reads/barcode:%.2f%s%s\n" % (read_count, round((read_count - start_count) / (time.time() - stime), 0), len(gbcCounter), median(gbcCounter.values()),
+                                 iterator.progress.summary(), '|' + profiler.summary(time.time() - stime) if profiler is not None else ''))
 
-    except StopIteration:
-        with open(output_dir + '_barcodes.txt', 'w') as f:
-            [f.write('{0}\t{1}\n'.format(gbcDict[key], value)) for key, value in gbcCounter.items()]
+        # end of the input, a writer thread error is raised here and fails the run
+        if writer is not None:
+            writer.close()
+        write_barcode_counts(output_dir + '_barcodes.txt', gbcDict, gbcCounter)
         output.close()
+        if checkpoint > 0 and os.path.isfile(checkpoint_file):
+            # mark the checkpoint complete, so a requeued job (--resume) does not redo the work,
+            # the last barcode snapshot is removed once the complete checkpoint replaced it
+            snapshot = state.get('barcodes')
+            state['complete'] = True
+            state['barcodes'] = None
+            write_checkpoint_state(output_dir, state)
+            if snapshot is not None and os.path.isfile(snapshot):
+                os.remove(snapshot)
+        if metrics is not None:
+            metrics.finish()
 
         if verbose:
-            sys.stderr.write("PROCESS\tREADS\treads analyzed:%i|reads/sec:%i|barcodes:%i|reads/barcode:%f\n" % (read_count, round(read_count / (time.time() - stime), 0), len(gbcCounter), median(gbcCounter.values())))
-            sys.stderr.write("PROCESS\tBARCODE\tMATCH: %i (%.2f%%)\n" % (barcode_match, (float(barcode_match) / read_count) * 100))
-            sys.stderr.write("PROCESS\tBARCODE\tMISMATCH1: %i (%.2f%%)\n" % (barcode_1mismatch, (float(barcode_1mismatch) / read_count) * 100))
-            sys.stderr.write("PROCESS\tBARCODE\tAMBIGUOUS: %i (%.2f%%)\n" % (barcode_ambiguous, (float(barcode_ambiguous) / read_count) * 100))
-            sys.stderr.write("PROCESS\tBARCODE\tUNKNOWN: %i (%.2f%%)\n" % (barcode_unknown, (float(barcode_unknown) / read_count) * 100))
-        pass
+            write_status(read_count, (read_count - start_count) / (time.time() - stime), gbcCounter, barcode_match, barcode_1mismatch, barcode_ambiguous, barcode_unknown)
+            if profiler is not None:
+                profiler.report('PROCESS', time.time() - stime)
+            if reader is not None:
+                sys.stderr.write("PROCESS\tPIPELINE\t%s\n" % reader.summary())
+                sys.stderr.write("PROCESS\tPIPELINE\t%s\n" % writer.summary())
     except (KeyboardInterrupt, SystemExit):
+        if metrics is not None:
+            metrics.finish('failed')
         sys.exit("PROCESS\tERROR\t%s unexpectedly terminated\n" % (__name__))
     except Exception:
+        if metrics is not None:
+            metrics.finish('failed')
         sys.stderr.write("".join(traceback.format_exception(*sys.exc_info())))
         sys.exit("PROCESS\tERROR\tAn unknown fatal error was encountered.\n")
 
@@ -525,8 +449,14 @@ parser.add_argument('-a', '--all', help="output all reads, not just those with v
 parser.add_argument('-i', help="output in interleaved format, if -o stdout, interleaved will be chosen automatically [default: %(default)s]",
                     action="store_true", dest="interleaved", default=False)
 
-# parser.add_option('-p', '', help="profile the reads and barcodes, FUTURE",
-#                  action="store_true", dest="profile", default=False)
+parser.add_argument('-p', '--profile', help="time the processing stages and the time blocked writing output, reported with the status [default: %(default)s]",
+                    action="store_true", dest="profile", default=False)
+
+parser.add_argument('--profile-every', help="with -p, time the stages of 1 in this many reads [default: %(default)s]",
+                    type=int, dest="profile_every", default=10)
+
+parser.add_argument('-w', '--whitelist', help="gem barcode whitelist [default: barcodes/4M-with-alts-february-2016.txt, relative to the script]",
+                    action="store", type=str, dest="whitelist", default=None)
 
 parser.add_argument('-b', '--bctrim', help='trim gem barcode [default: %(default)s]',
                     type=int, dest="bctrim", default=16)
@@ -537,9 +467,53 @@ parser.add_argument('-t', '--trim', help="trim addional bases after the gem barc
 parser.add_argument('-g', '--nogzip', help="do not gzip the output, ignored if output is stdout",
                     action="store_true", dest="nogzip", default=False)
 
+parser.add_argument('--compress-level', help="gzip compression level of the output, 1 (fastest) to 9 (smallest) [default: gzip's 6]",
+                    type=int, dest="compress_level", default=None)
+
+parser.add_argument('--block-size', help="KiB read and written per block, the buffer size of the input and output files and pipes [default: %(default)s]",
+                    type=int, dest="block_size", default=BUFFER_SIZE // 1024)
+
 parser.add_argument('--quiet', help="turn off verbose output",
                     action="store_false", dest="verbose", default=True)
 
+parser.add_argument('--skip', help="skip this many reads (pairs) at the start of the input, to process a range of reads [default: %(default)s]",
+                    type=int, dest="skip", default=0)
+
+parser.add_argument('--nreads', help="process at most this many reads (pairs), to process a range of reads [default: all]",
+                    type=int, dest="nreads", default=None)
+
+parser.add_argument('--lanes', help="process up to this many lane file pairs concurrently, one worker per lane, requires -o [default: %(default)s]",
+                    type=int, dest="lanes", default=1)
+
+parser.add_argument('--per-lane', help="with --lanes, keep the per lane outputs ([output]_laneN_*) rather than concatenating them [default: %(default)s]",
+                    action="store_true", dest="per_lane", default=False)
+
+parser.add_argument('--checkpoint', help="write a checkpoint ([output]_checkpoint.json) every this many reads, 0 for none [default: %(default)s]",
+                    type=int, dest="checkpoint", default=0)
+
+parser.add_argument('--resume', help="resume from the last checkpoint of the output prefix, if there is one [default: %(default)s]",
+                    action="store_true", dest="resume", default=False)
+
+parser.add_argument('--metrics', help="periodically rewrite run metrics to this file, JSON or Prometheus text format if the name ends in .prom [default: %(default)s]",
+                    action="store", type=str, dest="metrics", default=None)
+
+parser.add_argument('--metrics-interval', help="seconds between --metrics updates [default: %(default)s]",
+                    type=float, dest="metrics_interval", default=10.0)
+
+parser.add_argument('--pipeline', help="read and write on their own threads, passing batches of this many reads through bounded queues, 0 for off [default: %(default)s]",
+                    type=int, dest="pipeline", default=0)
+
+parser.add_argument('--pipeline-depth', help="with --pipeline, batches each queue holds [default: %(default)s]",
+                    type=int, dest="pipeline_depth", default=4)
+
+parser.add_argument('--server', help="run as a job server on this Unix socket, holding the whitelist in memory, jobs are submitted with --connect [default: %(default)s]",
+                    action="store", type=str, dest="server", default=None)
+
+parser.add_argument('--server-jobs', help="with --server, run up to this many jobs at a time [default: %(default)s]",
+                    type=int, dest="server_jobs", default=1)
+
+parser.add_argument('--connect', help="submit this run to the job server on this Unix socket, messages and exit status are relayed [default: %(default)s]",
+                    action="store", type=str, dest="connect", default=None)
 
 group = parser.add_argument_group("Inputs", "10x fastq files to input (can be gz).")
 
@@ -549,37 +523,110 @@ group.add_argument('-1', '--read1', metavar="read1", dest='read1', help='read1 o
 group.add_argument('-2', '--read2', metavar="read2", dest='read2', help='read2 of a pair, multiple files can be specified separated by comma',
                    action='store', type=str, nargs='+')
 
-options = parser.parse_args()
 
-output_dir = options.output_dir
-# profile = options.profile
-profile = False
-bctrim = options.bctrim
-trim = options.trim
-nogzip = options.nogzip
-output_all = options.output_all
-interleaved = options.interleaved
-
-infile1 = options.read1
-if infile1 is None:
-    sys.stderr.write("PROCESS\tERROR\tRead file 1 is missing\n")
-    sys.exit(1)
-infile2 = options.read2
-if infile2 is None:
-    sys.stderr.write("PROCESS\tERROR\tRead file 2 is missing\n")
-    sys.exit(1)
-
-verbose = options.verbose
+def run(options, gbcDict=None):
+    """
+    check the options and process the reads, gbcDict is the whitelist already loaded (by the
+    job server) or None to load it
+    """
+    global whitelist_file
+    global read_count
+    global stime
 
-file_path = os.path.dirname(os.path.realpath(__file__))
+    output_dir = options.output_dir
+    profile = options.profile_every if options.profile else 0
+    if options.profile and options.profile_every < 1:
+        sys.stderr.write("PROCESS\tERROR\t--profile-every must be at least 1\n")
+        sys.exit(1)
+    bctrim = options.bctrim
+    trim = options.trim
+    nogzip = options.nogzip
+    output_all = options.output_all
+    interleaved = options.interleaved
+
+    infile1 = options.read1
+    if infile1 is None:
+        sys.stderr.write("PROCESS\tERROR\tRead file 1 is missing\n")
+        sys.exit(1)
+    infile2 = options.read2
+    if infile2 is None:
+        sys.stderr.write("PROCESS\tERROR\tRead file 2 is missing\n")
+        sys.exit(1)
+
+    verbose = options.verbose
+
+    if (options.checkpoint > 0 or options.resume) and output_dir == "stdout":
+        sys.stderr.write("PROCESS\tERROR\tcheckpoint and resume require an output prefix (-o)\n")
+        sys.exit(1)
+
+    if options.lanes > 1 and (output_dir == "stdout" or options.checkpoint > 0 or options.resume or options.skip > 0 or options.nreads is not None):
+        sys.stderr.write("PROCESS\tERROR\t--lanes requires an output prefix (-o), and cannot be used with checkpoints or read ranges\n")
+        sys.exit(1)
+
+    if options.pipeline > 0 and (options.lanes > 1 or options.checkpoint > 0 or options.profile or options.pipeline_depth < 1):
+        sys.stderr.write("PROCESS\tERROR\t--pipeline cannot be used with --lanes, checkpoints or -p, and --pipeline-depth must be at least 1\n")
+        sys.exit(1)
+
+    if (options.compress_level is not None and not 1 <= options.compress_level <= 9) or options.block_size < 1:
+        sys.stderr.write("PROCESS\tERROR\t--compress-level must be 1 to 9 and --block-size at least 1\n")
+        sys.exit(1)
+
+    whitelist_file = options.whitelist
+    if whitelist_file is None:
+        whitelist_file = os.path.join(file_path, 'barcodes/4M-with-alts-february-2016.txt')
+
+    # need to check, can write to output folder
+
+    # global variables
+    read_count = 0
+
+    stime = time.time()
+
+    if options.lanes > 1:
+        main_lanes(infile1, infile2, output_dir, output_all, interleaved, bctrim, trim, nogzip, options.lanes, options.per_lane, verbose, profile, options.metrics, options.metrics_interval, gbcDict,
+                   options.compress_level, options.block_size * 1024)
+    else:
+        main(infile1, infile2, output_dir, output_all, interleaved, profile, bctrim, trim, nogzip, verbose, options.skip, options.nreads, options.checkpoint, options.resume, options.metrics, options.metrics_interval, gbcDict,
+             options.pipeline, options.pipeline_depth, options.compress_level, options.block_size * 1024)
 
-# need to check, can write to output folder
 
-# global variables
-read_count = 0
+def server_job(request):
+    """
+    run a job submitted to the server (in the forked job process) with the server's whitelist,
+    a job given another whitelist is rejected
+    """
+    if request.get('version') != version_num:
+        sys.exit("PROCESS\tERROR\tclient version %s does not match the server version %s\n" % (request.get('version'), version_num))
+    os.chdir(request['cwd'])
+    options = parser.parse_args(request['argv'])
+    if options.server is not None:
+        sys.exit("PROCESS\tERROR\t--server cannot be submitted as a job\n")
+    if options.output_dir == "stdout":
+        sys.exit("PROCESS\tERROR\tjobs run by the server require an output prefix (-o)\n")
+    job_whitelist = options.whitelist if options.whitelist is not None else os.path.join(file_path, 'barcodes/4M-with-alts-february-2016.txt')
+    # resolved against the job's directory, the server's whitelist was resolved at startup
+    if os.path.realpath(os.path.join(request['cwd'], job_whitelist)) != server_whitelist:
+        sys.exit("PROCESS\tERROR\tthe job whitelist %s is not the server whitelist %s, run it without --connect\n" % (job_whitelist, server_whitelist))
+    run(options, server_gbcDict)
+    return 0
+
 
-stime = time.time()
+options = parser.parse_args()
+
+file_path = os.path.dirname(os.path.realpath(__file__))
 
-main(infile1, infile2, output_dir, output_all, interleaved, profile, bctrim, trim, nogzip, verbose)
+if options.server is not None:
+    # load the whitelist once, each job is forked with it
+    whitelist_file = options.whitelist
+    if whitelist_file is None:
+        whitelist_file = os.path.join(file_path, 'barcodes/4M-with-alts-february-2016.txt')
+    # absolute, jobs run in the client's directory
+    whitelist_file = server_whitelist = os.path.realpath(whitelist_file)
+    server_gbcDict = load_whitelist(options.verbose)
+    serve(options.server, server_job, max(1, options.server_jobs), 'PROCESS', options.verbose)
+elif options.connect is not None:
+    sys.exit(submit(options.connect, {'argv': sys.argv[1:], 'cwd': os.getcwd(), 'version': version_num}))
+else:
+    run(options)
 
 sys.exit(0)
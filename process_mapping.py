@@ -2,29 +2,49 @@
 """
 Copyright 2017 Matt Settles
 Created June 8, 2017
+
+Reads of a barcode with a poor mapping quality, or unmapped, are remapped through a single
+long lived bwa mem process (BwaMemWorker) rather than starting bwa for every barcode.
+
+With --local, reads are instead remapped only against the regions (padded) where the
+barcode has confident alignments, the regions are extracted from the faidx indexed
+reference into small bwa indexes which are cached (LRU) and shared between barcodes.
+
+Barcode groups are independent, with -p they are processed by a pool of worker processes
+(each with its own local index cache), results are written back in input order.
 """
 from optparse import OptionParser
+from collections import OrderedDict, Counter, deque
+from multiprocessing import Pool
 import os
 import sys
 import time
 import traceback
 import signal
+import shutil
+import tempfile
+import threading
+from Queue import Queue, Empty
 
 from subprocess import Popen
 from subprocess import PIPE
 
+from proc10x.sam import SamRecord, mate_pairs, attach_tags
 
-def sp_bwa_index(ref, overwrite=False):
+
+def sp_bwa_index(ref, overwrite=False, verbose=True):
     if os.path.isfile(ref):
         if os.path.isfile(ref + '.sa') and not overwrite:
-            sys.stderr.write('MAPPING\tNOTE\tFound existing bwo index for %s\n' % ref)
+            if verbose:
+                sys.stderr.write('MAPPING\tNOTE\tFound existing bwo index for %s\n' % ref)
             return 0
         else:
             FNULL = open(os.devnull, 'w')
             call = 'bwa index'
             call = call + ' ' + ref
-            sys.stdout.write(call + '\n')
-            p = Popen(['bwa index', ref],
+            if verbose:
+                sys.stderr.write('MAPPING\tNOTE\t' + call + '\n')
+            p = Popen(['bwa', 'index', ref],
                       stdout=FNULL,
                       stderr=FNULL,
                       bufsize=-1,
@@ -34,7 +54,8 @@ def sp_bwa_index(ref, overwrite=False):
                 sys.stderr.write('MAPPING\tERROR\tSomething in bwa index went wrong\n')
                 raise
             # system call, check for return
-            sys.stderr.write('MAPPING\tNOTE\tSuccessfully indexed %s\n' % ref)
+            if verbose:
+                sys.stderr.write('MAPPING\tNOTE\tSuccessfully indexed %s\n' % ref)
             return 0
     else:
         sys.stderr.write("MAPPING\tERROR\t%s Reference file not found\n" % ref)
@@ -43,247 +64,325 @@ def sp_bwa_index(ref, overwrite=False):
     raise
 
 
-def sp_bwa_map_bc(reads, ref, overwrite=False, sensitivity=0, procs=1):
-    # build the call,
-    if sp_bwa_index(ref, overwrite) != 0:
-        sys.exit(1)
+def sp_faidx_extract(ref, regions, outfile):
+    """
+    Extract regions (samtools style chr:start-end) from a faidx indexed fasta into outfile
+    """
+    with open(outfile, 'w') as fout:
+        p = Popen(['samtools', 'faidx', ref] + regions,
+                  stdout=fout,
+                  stderr=open(os.devnull, 'w'),
+                  preexec_fn=lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL))
+        p.communicate()
+    if p.returncode:
+        sys.stderr.write('MAPPING\tERROR\tSomething in samtools faidx went wrong\n')
+        raise Exception
+    return 0
 
-    call = 'bwa mem -p -a -t ' + procs
-    p = Popen([call, ref],
+
+def sp_bwa_map_local(reads, ref):
+    """
+    Map interleaved reads against a small (local) bwa index, returns the sam records
+    """
+    p = Popen(['bwa', 'mem', '-p', '-a', ref],
               stdin=PIPE,
               stdout=PIPE,
-              stderr=None,
+              stderr=open(os.devnull, 'w'),
               bufsize=-1,
-              shell=True,
-              executable='/bin/bash',
               preexec_fn=lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL))
-    p.communicate(input=reads)
+    out = p.communicate(input='\n'.join(reads) + '\n')[0]
     if p.returncode:
-        raise
-    return p.stdout
+        sys.stderr.write('MAPPING\tERROR\tSomething in bwa mem went wrong\n')
+        raise Exception
+    return [line + '\n' for line in out.split('\n') if line != '' and line[0] != '@']
+
+
+def barcode_regions(records, refDict, pad=10000):
+    """
+    Padded, merged regions covered by the confident alignments of a barcode. Region
+    bounds are snapped to multiples of pad so that barcodes from the same area share
+    the same region set (and so cached local index).
+    """
+    intervals = []
+    for rec in records:
+        start = max(1, ((rec.pos - pad) // pad) * pad + 1)
+        end = min(refDict.get(rec.rname, rec.end + pad), ((rec.end + pad) // pad + 1) * pad)
+        intervals.append((rec.rname, start, end))
+    intervals.sort()
+    regions = []
+    for rname, start, end in intervals:
+        if len(regions) > 0 and regions[-1][0] == rname and start <= regions[-1][2] + 1:
+            regions[-1][2] = max(regions[-1][2], end)
+        else:
+            regions.append([rname, start, end])
+    return tuple('%s:%i-%i' % (rname, start, end) for rname, start, end in regions)
 
 
-def reverseComplement(s):
+def translate_local(line):
     """
-    given a seqeucne with 'A', 'C', 'T', and 'G' return the reverse complement
+    Convert a sam record mapped to a local region (chr:start-end) back to
+    reference coordinates
     """
-    basecomplement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}
-    letters = list(s)
-    try:
-        letters = [basecomplement[base] for base in letters]
-    except:
-        raise
-    return ''.join(letters[::-1])
+    def to_global(rname, pos):
+        if rname in ['*', '='] or ':' not in rname:
+            return rname, pos
+        chrom, span = rname.rsplit(':', 1)
+        return chrom, str(int(pos) + int(span.split('-')[0]) - 1)
+
+    line2 = line.rstrip('\n').split('\t')
+    rname, pos = to_global(line2[2], line2[3])
+    if line2[6] == '=':
+        rnext, pnext = to_global(line2[2], line2[7])
+        rnext = '='
+    else:
+        rnext, pnext = to_global(line2[6], line2[7])
+        if rnext == rname:
+            rnext = '='
+    line2[2], line2[3], line2[6], line2[7] = rname, pos, rnext, pnext
+    for i in range(11, len(line2)):
+        if line2[i][0:5] in ['SA:Z:', 'XA:Z:']:
+            hits = []
+            for hit in line2[i][5:].split(';'):
+                if hit == '':
+                    hits.append(hit)
+                    continue
+                hit2 = hit.split(',')
+                sign = hit2[1][0] if hit2[1][0] in '+-' else ''
+                hit2[0], hit2[1] = to_global(hit2[0], hit2[1].lstrip('+-'))
+                hit2[1] = sign + hit2[1]
+                hits.append(','.join(hit2))
+            line2[i] = line2[i][0:5] + ';'.join(hits)
+    return '\t'.join(line2) + '\n'
 
 
-def reverse(s):
+class LocalIndexCache:
     """
-    given a sequence return the reverse
+    LRU cache of small bwa indexes built from regions of the reference, keyed by region set
     """
-    letters = list(s)
-    return ''.join(letters[::-1])
+    def __init__(self, ref, size=100, tmpdir=None):
+        self.ref = ref
+        self.size = size
+        self.tmpdir = tempfile.mkdtemp(prefix='process_mapping.', dir=tmpdir)
+        self.cache = OrderedDict()
+        self.nindex = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, regions):
+        """
+        Return the fasta (bwa indexed) of the region set, building it if needed
+        """
+        if regions in self.cache:
+            self.hits += 1
+            fasta = self.cache.pop(regions)
+            self.cache[regions] = fasta  # most recently used
+            return fasta
+        self.misses += 1
+        self.nindex += 1
+        fasta = os.path.join(self.tmpdir, 'local%08i.fa' % self.nindex)
+        sp_faidx_extract(self.ref, list(regions), fasta)
+        sp_bwa_index(fasta, verbose=False)
+        self.cache[regions] = fasta
+        while len(self.cache) > self.size:
+            self.remove(self.cache.popitem(last=False)[1])
+        return fasta
+
+    def remove(self, fasta):
+        for ext in ['', '.amb', '.ann', '.bwt', '.pac', '.sa', '.fai']:
+            if os.path.isfile(fasta + ext):
+                os.remove(fasta + ext)
+
+
+class BwaMemWorker:
+    """
+    Long lived bwa mem coprocess, started once (paying the index load once) and fed
+    interleaved read batches over stdin by a writer thread. A reader thread collects the
+    sam output and matches records back to the submitting barcode by read name, bwa mem
+    reports reads in input order so a batch is complete once a record of a later batch
+    (or the end of the output) is seen. The 10x tags of the original reads are attached
+    to the records, completed (batch id, sam lines) tuples are placed on the results queue.
+    """
+    def __init__(self, ref, procs=1, overwrite=False, max_batches=64, verbose=False):
+        if sp_bwa_index(ref, overwrite, verbose) != 0:
+            sys.exit(1)
+        self.verbose = verbose
+        self.names = {}  # read name -> batch id
+        self.batches = {}  # batch id -> [barcode, read names, 10x tags]
+        self.nbatches = 0
+        self.mcount = 0
+        self.inq = Queue(max_batches)
+        self.results = Queue()
+        self.p = Popen(['bwa', 'mem', '-p', '-a', '-t', str(procs), ref],
+                       stdin=PIPE,
+                       stdout=PIPE,
+                       stderr=open(os.devnull, 'w'),
+                       bufsize=-1,
+                       preexec_fn=lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL))
+        self.writer = threading.Thread(target=self._write)
+        self.writer.daemon = True
+        self.writer.start()
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+        if self.verbose:
+            sys.stderr.write('MAPPING\tNOTE\tStarted bwa mem worker against %s\n' % ref)
+
+    def submit(self, bc, names, reads, tags):
+        """
+        Queue the interleaved fastq reads (with read names and 10x tags) of barcode bc for
+        mapping, returns the batch id (None when there is nothing to map), blocks when
+        max_batches are waiting to be written
+        """
+        if len(names) == 0:
+            return None
+        self.nbatches += 1
+        self.batches[self.nbatches] = [bc, names, tags]
+        for name in names:
+            self.names[name] = self.nbatches
+        self.inq.put('\n'.join(reads) + '\n')
+        return self.nbatches
+
+    def _write(self):
+        while True:
+            reads = self.inq.get()
+            if reads is None:
+                break
+            self.p.stdin.write(reads)
+        self.p.stdin.close()
+
+    def _finish(self, batch_id, lines):
+        bc, names, tags = self.batches.pop(batch_id)
+        for name in names:
+            del self.names[name]
+        self.results.put((batch_id, [attach_tags(line, tags) for line in lines]))
+
+    def _read(self):
+        current = None
+        lines = []
+        for line in self.p.stdout:
+            if line[0] == '@':
+                continue
+            batch_id = self.names.get(line.split('\t', 1)[0], current)
+            if batch_id != current:
+                if current is not None:
+                    self._finish(current, lines)
+                current = batch_id
+                lines = []
+            lines.append(line)
+            self.mcount += 1
+        if current is not None:
+            self._finish(current, lines)
+        self.results.put(None)
+
+    def get_results(self, block=False):
+        """
+        Return the (batch id, sam lines) of the batches completed so far, with block wait
+        for the worker to finish all batches
+        """
+        res = []
+        while True:
+            try:
+                item = self.results.get(block)
+            except Empty:
+                break
+            if item is None:
+                break
+            res.append(item)
+        return res
+
+    def close(self):
+        """
+        Signal the end of input, returns the remaining results once bwa has finished
+        """
+        self.inq.put(None)
+        res = self.get_results(block=True)
+        self.writer.join()
+        self.reader.join()
+        self.p.wait()
+        if self.p.returncode:
+            sys.stderr.write('MAPPING\tERROR\tSomething in bwa mem went wrong\n')
+            raise Exception
+        return res
 
 
 class bcProcessing:
-    orig_bc_lines = []
-    remap_reads = []
-    remap_lines = []
-    ok_bc_lines = []
 
     def __init__(self, minMQ=40, verbose=False):
         self.verbose = verbose
         self.minMQ = minMQ
-
-    def addLine(self, line):
-        self.orig_bc_lines.append(line)
+        self.mcount = 0
+        self.clearbc()
 
     def clearbc(self):
-        self.orig_bc_lines = []
-        self.remap_lines = []
-        self.ok_bc_lines = []
-
-    def addRead(self, read):
+        self.counts = Counter()
+        self.orig_bc_records = []
+        self.remap_reads = []
+        self.remap_names = []
+        self.remap_tags = {}
+        self.ok_bc_records = []
+
+    def addRead(self, r1, r2):
         """
-        Add a pair of reads to the output queue
+        Add a pair of reads (interleaved fastq) to the remap queue, keeping their 10x tags
         """
-        self.R1.append(read[0])
-        self.R2.append(read[3])
+        self.remap_reads.append('\n'.join([r1.fastq(1), r2.fastq(2)]))
+        self.remap_names.append(r1.qname)
+        self.remap_tags[(r1.qname, 1)] = r1.tenx_tags()
+        self.remap_tags[(r2.qname, 2)] = r2.tenx_tags()
         self.mcount += 1
 
-    def mapReads(self):
+    def mapReadsLocal(self, cache, refDict, pad):
         """
-        Write the paired reads in the queue to the output files
+        Map the paired reads in the remap queue against the regions of the barcodes
+        confident alignments, returns the sam records (with the 10x tags of the original
+        reads) in reference coordinates or None when the barcode has no confident alignments
         """
-        if (len(self.R1) == 0):
-            pass
-        else:
-            if not self.isOpen:
-                try:
-                    if self.open() == 1:
-                        sys.stderr.write('MAPPING\tERROR:[IlluminaFourReadOutput] ERROR Opening files for writing\n')
-                        raise
-                except Exception:
-                    raise
-            try:
-                self.R1f.write('\n'.join(self.R1) + '\n')
-                self.R4f.write('\n'.join(self.R2) + '\n')
-            except Exception:
-                sys.stderr.write('MAPPING\tERROR:[IlluminaFourReadOutput] Cannot write reads to file with prefix: %s\n' % self.output_prefix)
-                raise
-            self.R1 = []
-            self.R2 = []
-            self.B1 = []
-            self.B2 = []
-            self.close()
-
-    def process(self, refDB):
+        if (len(self.remap_reads) == 0 or len(self.ok_bc_records) == 0):
+            return None
+        local_ref = cache.get(barcode_regions(self.ok_bc_records, refDict, pad))
+        lines = [attach_tags(translate_local(line), self.remap_tags) for line in sp_bwa_map_local(self.remap_reads, local_ref)]
+        self.remap_reads = []
+        self.remap_names = []
+        self.remap_tags = {}
+        return lines
+
+    def process(self):
         """
-        process reads against a reference fasta file
+        process the alignments of a barcode, separating confident pairs from those to remap
         """
         try:
-            bc = self.orig_bc_lines[0].split(":")[0]
+            bc = self.orig_bc_records[0].barcode
             mapped_pairs_count = 0
             remapped_pairs_count = 0
-            mapped_singles_count = 0
-            remapped_singles_count = 0
             secondary_alignment = 0
             count = 0
-            PE1 = {}
-            PE2 = {}
-
-            for line in self.orig_bc_lines:
-                # 0x1 template having multiple segments in sequencing
-                # 0x2 each segment properly aligned according to the aligner
-                # 0x4 segment unmapped
-                # 0x8 next segment in the template unmapped
-                # 0x10 SEQ being reverse complemented
-                # 0x20 SEQ of the next segment in the template being reversed
-                # 0x40 the first segment in the template
-                # 0x80 the last segment in the template
-                # 0x100 secondary alignment
-                # 0x200 not passing quality controls
-                # 0x400 PCR or optical duplicate
-                lbc = line.split(":")[0]
-                if lbc != bc:
-                    sys.err("Something went wrong, more than one barcode in process barcodes")
-
-                count += 1
-                line2 = line.strip().split()
-                flag = int(line2[1])
-                # Secondary alignment
-                if (flag & 0x100):  # not sure what to do with secondary alignment yet, for now ignore
-                    secondary_alignment += 1
-                    continue
 
-                mq = int(line2[4])
-#                if mq < self.minMQ:
-#                    # add to those that need to be remapped
-#                    self.remap_lines.append(line)
-                # Handle SE:
-                # mapped SE reads have 0x1 set to 0, and 0x4 (third bit) set to 1
-                if not (flag & 0x1):  # SE READ, shouldn't see singles, maybe handle them later
-                    # if not (flag & 0x4 and mq >= self.minMQ):  # MAPPED
-                    #     self.ok_bc_lines.append(line)
-                    #     # TODO: NEED to determine read cloud for read
-                    #     mapped_singles_count += 1
-                    # else:  # UNMAPPED or Poor minMQ, remap the read
-                    #     if (flag & 0x10):  # reverse complement
-                    #         line2[9] = reverseComplement(line2[9])
-                    #         line2[10] = reverse(line2[10])
-                    #     self.addRead(['\n'.join(['@' + line2[0] + ' 1:N:O', line2[9], '+', line2[10]])])
-                    #     remapped_singles_count += 1
+            for r1, r2, others in mate_pairs(self.orig_bc_records):
+                count += len(others) + (r1 is not None) + (r2 is not None)
+                # Secondary alignment, not sure what to do with secondary alignment yet, for now ignore
+                secondary_alignment += sum(1 for rec in others if rec.secondary)
+                if r1 is None or r2 is None or not r1.paired:
+                    # SE READ or mate missing, shouldn't see singles, maybe handle them later
                     continue
+                if r1.barcode != bc:
+                    sys.stderr.write("MAPPING\tERROR\tSomething went wrong, more than one barcode in process barcodes\n")
+                    raise Exception
                 # Handle PE:
-                # logic:  0x1 = multiple segments in sequencing,   0x4 = segment unmapped,  0x8 = next segment unmapped
-                if (flag & 0x1):  # PE READ
-                    if (not (flag & 0x4) and not (flag & 0x8)):  # both pairs mapped
-                        if (flag & 0x40):  # is this PE1 (first segment in template)
-                            # PE1 read, check that PE2 is in dict
-                            ID = line2[0]
-                            if ID in PE2:
-                                if mq >= self.minMQ and int(PE2[ID].strip().split()[4]) >= self.minMQ:  # check MQ of both reads
-                                    self.ok_bc_lines.append(line)
-                                    self.ok_bc_lines.append(PE2[ID])
-                                    del PE2[ID]
-                                    # TODO: NEED to determine read cloud for read
-                                    mapped_pairs_count += 1
-                                else:
-                                    if (flag & 0x10):  # reverse complement
-                                        line2[9] = reverseComplement(line2[9])
-                                        line2[10] = reverse(line2[10])
-                                    r1 = '\n'.join(['@' + line2[0] + ' 1:N:O', line2[9], '+', line2[10]])  # sequence + qual
-                                    rl2 = PE2[ID].strip().split()
-                                    if (int(rl2[1]) & 0x10):  # reverse complement
-                                        rl2[9] = reverseComplement(rl2[9])
-                                        rl2[10] = reverse(rl2[10])
-                                    r2 = '\n'.join(['@' + rl2[0] + ' 2:N:O', rl2[9], '+', rl2[10]])  # sequence + qual
-                                    self.addRead('\n'.join([r1, r2]))
-                                    del PE2[ID]
-                                    remapped_pairs_count += 1
-                            else:
-                                PE1[ID] = line
-                        elif (flag & 0x80):  # is this PE2 (last segment in template)
-                            # PE2 read, check that PE1 is in dict and write out
-                            ID = line2[0]
-                            if ID in PE1:
-                                if mq >= self.minMQ and int(PE1[ID].strip().split()[4]) >= self.minMQ:  # check MQ of both reads
-                                    self.ok_bc_lines.append(line)
-                                    self.ok_bc_lines.append(PE1[ID])
-                                    del PE1[ID]
-                                    # TODO: NEED to determine read cloud for read
-                                    mapped_pairs_count += 1
-                                else:
-                                    if (flag & 0x10):  # reverse complement
-                                        line2[9] = reverseComplement(line2[9])
-                                        line2[10] = reverse(line2[10])
-                                    r2 = '\n'.join(['@' + line2[0] + ' 2:N:O', line2[9], '+', line2[10]])  # sequence + qual
-                                    rl1 = PE1[ID].strip().split()
-                                    if (int(rl1[1]) & 0x10):  # reverse complement
-                                        rl1[9] = reverseComplement(rl1[9])
-                                        rl1[10] = reverse(rl1[10])
-                                    r1 = '\n'.join(['@' + rl1[0] + ' 1:N:O', rl1[9], '+', rl1[10]])  # sequence + qual
-                                    self.addRead('\n'.join([r1, r2]))
-                                    del PE1[ID]
-                                    remapped_pairs_count += 1
-                            else:
-                                PE2[ID] = line
-                    else:  # an 'unmapped' pair, at least 1 unmapped
-                        if (flag & 0x40):  # is this PE1 (first segment in template)
-                            # PE1 read, check that PE2 is in dict and write out
-                            ID = line2[0]
-                            if ID in PE2:
-                                if (flag & 0x10):  # reverse complement
-                                    line2[9] = reverseComplement(line2[9])
-                                    line2[10] = reverse(line2[10])
-                                r1 = '\n'.join(['@' + line2[0] + ' 1:N:O', line2[9], '+', line2[10]])  # sequence + qual
-                                rl2 = PE2[ID].strip().split()
-                                if (int(rl2[1]) & 0x10):  # reverse complement
-                                    rl2[9] = reverseComplement(rl2[9])
-                                    rl2[10] = reverse(rl2[10])
-                                r2 = '\n'.join(['@' + rl2[0] + ' 2:N:O', rl2[9], '+', rl2[10]])  # sequence + qual
-                                self.addRead('\n'.join([r1, r2]))
-                                del PE2[ID]
-                                remapped_pairs_count += 1
-                            else:
-                                PE1[ID] = line
-                        elif (flag & 0x80):  # is this PE2 (last segment in template)
-                            # PE2 read, check that PE1 is in dict and write out
-                            ID = line2[0]
-                            if ID in PE1:
-                                if (flag & 0x10):  # reverse complement
-                                    line2[9] = reverseComplement(line2[9])
-                                    line2[10] = reverse(line2[10])
-                                r1 = '\n'.join(['@' + line2[0] + ' 1:N:O', line2[9], '+', line2[10]])  # sequence + qual
-                                rl2 = PE2[ID].strip().split()
-                                if (int(rl2[1]) & 0x10):  # reverse complement
-                                    rl2[9] = reverseComplement(rl2[9])
-                                    rl2[10] = reverse(rl2[10])
-                                r2 = '\n'.join(['@' + rl2[0] + ' 2:N:O', rl2[9], '+', rl2[10]])  # sequence + qual
-                                self.addRead('\n'.join([r1, r2]))
-                                del PE2[ID]
-                                remapped_pairs_count += 1
-                            else:
-                                PE2[ID] = line
+                # logic:  0x4 = segment unmapped,  0x8 = next segment unmapped
+                if not r1.unmapped and not r2.unmapped and r1.mapq >= self.minMQ and r2.mapq >= self.minMQ:
+                    # both pairs mapped, check MQ of both reads
+                    self.ok_bc_records.append(r1)
+                    self.ok_bc_records.append(r2)
+                    # TODO: NEED to determine read cloud for read
+                    mapped_pairs_count += 1
+                else:  # poor mapping quality or an 'unmapped' pair (at least 1 unmapped), remap the pair
+                    self.addRead(r1, r2)
+                    remapped_pairs_count += 1
+            self.counts.update({'records': count,
+                                'mapped_pairs_count': mapped_pairs_count,
+                                'remapped_pairs_count': remapped_pairs_count,
+                                'secondary_alignment': secondary_alignment})
+            return 0
 
         except (KeyboardInterrupt, SystemExit):
             sys.stderr.write("MAPPING\tERROR\t%s unexpectedly terminated\n" % (__name__))
@@ -293,49 +392,126 @@ class bcProcessing:
             return 1
 
 
-def main(insam, outsam, output_all, verbose):
+def write_ready(outsam, results, pending, remapped, final=False):
+    """
+    Write the barcode groups in input order, pending holds (batch id, lines) of the groups
+    not yet written, a group is written once its remapped lines (batch id) are returned by
+    the bwa mem worker (or with final, once the worker is done), so the output stays
+    grouped by barcode
+    """
+    for batch_id, lines in results:
+        remapped[batch_id] = lines
+    while len(pending) > 0 and (final or pending[0][0] is None or pending[0][0] in remapped):
+        batch_id, lines = pending.popleft()
+        outsam.writelines(lines)
+        if batch_id is not None:
+            outsam.writelines(remapped.pop(batch_id, []))
+
+
+def init_worker(minMQ, refDB, local, pad, cache_size, tmpdir, refDict, verbose):
+    """
+    Set up the per process barcode processing state (also used when running serially)
+    """
+    global proc_bc, cache, worker_refDict, worker_pad
+    proc_bc = bcProcessing(minMQ, verbose)
+    worker_refDict = refDict
+    worker_pad = pad
+    if local:
+        cache = LocalIndexCache(refDB, cache_size, tmpdir)
+    else:
+        cache = None
+
+
+def process_group(records):
+    """
+    Process the alignments of one barcode, returns the barcode, confident alignments, locally
+    remapped alignments (or None), the reads still to remap and the barcode counts
+    """
+    proc_bc.clearbc()
+    proc_bc.orig_bc_records = records
+    proc_bc.process()
+    local_lines = None
+    if cache is not None:
+        misses = cache.misses
+        local_lines = proc_bc.mapReadsLocal(cache, worker_refDict, worker_pad)
+        if local_lines is not None:
+            proc_bc.counts['local_remaps'] += 1
+            proc_bc.counts['local_index_builds'] += cache.misses - misses
+    return records[0].barcode, [rec.line for rec in proc_bc.ok_bc_records], local_lines, proc_bc.remap_names, proc_bc.remap_reads, proc_bc.remap_tags, proc_bc.counts
+
+
+def write_group(result, worker, outsam, counts, pending, remapped):
+    """
+    Queue a processed barcode group for writing, submitting the reads still to remap to the
+    bwa mem worker, and write the groups that are complete
+    """
+    bc, ok_lines, local_lines, remap_names, remap_reads, remap_tags, bc_counts = result
+    lines = ok_lines + local_lines if local_lines is not None else ok_lines
+    pending.append((worker.submit(bc, remap_names, remap_reads, remap_tags), lines))
+    counts.update(bc_counts)
+    write_ready(outsam, worker.get_results(), pending, remapped)
+
+
+def main(insam, outsam, refDB, procs, nprocesses, max_inflight, local, pad, cache_size, tmpdir, output_all, verbose, minMQ=40):
     global file_path
     refDict = {}
-    proc_bc = bcProcessing(verbose)
+    counts = Counter()
+    worker = None
+    pool = None
+    inflight = deque()
+    pending = deque()  # processed groups waiting on their remapped reads, in input order
+    remapped = {}
+    tmpdir = tempfile.mkdtemp(prefix='process_mapping.', dir=tmpdir)
+
+    def dispatch(records):
+        """
+        Hand a barcode group to the pool (or process in place), writing finished groups in order
+        """
+        if pool is None:
+            write_group(process_group(records), worker, outsam, counts, pending, remapped)
+            return
+        inflight.append(pool.apply_async(process_group, (records,)))
+        while len(inflight) >= max_inflight or (len(inflight) > 0 and inflight[0].ready()):
+            write_group(inflight.popleft().get(), worker, outsam, counts, pending, remapped)
 
     line_count = 0
     current_bc = None
-    current_bc_count = 0
+    current_bc_records = []
     bc_count = 0
     for line in insam:
         # Comment/header lines start with @
         if line[0] != "@" and len(line.strip().split()) > 2:
+            if worker is None:
+                # header is complete, start the barcode workers (before any threads) and bwa,
+                # with a pool the barcodes are only processed in the workers
+                if nprocesses > 1:
+                    pool = Pool(nprocesses, init_worker, (minMQ, refDB, local, pad, cache_size, tmpdir, refDict, verbose))
+                else:
+                    init_worker(minMQ, refDB, local, pad, cache_size, tmpdir, refDict, verbose)
+                worker = BwaMemWorker(refDB, procs, verbose=verbose)
             line_count += 1
-            bc = line.split(":")[0]
+            rec = SamRecord(line)
+            bc = rec.barcode
             # instead check the ST:Z:GOOD for GOOD or MATCH or MISMATCH1
-            if line.split()[15][5:] not in ['GOOD', 'MATCH', 'MISMATCH1']:
+            if rec.tag('ST:Z:') not in ['GOOD', 'MATCH', 'MISMATCH1']:
                 # if seqToHash(bc) not in gbcDict:
                 # barcode does not match whitelist
                 if output_all:
                     # if output_all pass line directly to output
                     outsam.write(line)
-            elif bc == current_bc:
+            elif bc == current_bc or current_bc is None:
                 # add line to bc processing
-                proc_bc.addLine(line)
-                current_bc_count += 1
-            elif current_bc is None:
                 current_bc = bc
-                # add line to bc processing
-                proc_bc.addLine(line)
-                current_bc_count += 1
+                current_bc_records.append(rec)
             else:
                 # this is a new barcode
                 # can add a check to see if seen bc before, which is a no-no
                 # process the bc
-                proc_bc.process()
+                dispatch(current_bc_records)
                 # record having processed the barcode
-                # output to sam file
                 bc_count += 1
-                proc_bc.clearbc()
                 current_bc = bc
-                # add line to bc processing
-                current_bc_count = 1
-                proc_bc.addLine(line)
+                current_bc_records = [rec]
         else:
             # pass header directly to output
             outsam.write(line)
@@ -345,7 +521,24 @@ def main(insam, outsam, output_all, verbose):
                 refDict[sp[1][3:]] = int(sp[2][3:])
 
         if line_count % 100000 == 0 and line_count > 0 and verbose:
-            print "Records processed: %s" % (line_count)
+            sys.stderr.write("MAPPING\tRECORDS\tRecords processed: %s\n" % (line_count))
+
+    if current_bc is not None:
+        dispatch(current_bc_records)
+        bc_count += 1
+    while len(inflight) > 0:
+        write_group(inflight.popleft().get(), worker, outsam, counts, pending, remapped)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if worker is not None:
+        write_ready(outsam, worker.close(), pending, remapped, final=True)
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    if verbose:
+        sys.stderr.write("MAPPING\tRECORDS\tRecords processed: %s|barcodes:%s|records remapped:%s\n" % (line_count, bc_count, worker.mcount if worker is not None else 0))
+        sys.stderr.write("MAPPING\tSUMMARY\tmapped pairs:%i|remapped pairs:%i|secondary alignments:%i\n" % (counts['mapped_pairs_count'], counts['remapped_pairs_count'], counts['secondary_alignment']))
+        if local:
+            sys.stderr.write("MAPPING\tSUMMARY\tbarcodes remapped locally:%i|local indexes built:%i\n" % (counts['local_remaps'], counts['local_index_builds']))
 
 
 #####################################
@@ -357,6 +550,33 @@ parser = OptionParser(usage=usage, version="%prog 0.0.1")
 parser.add_option('-o', '--output', help="Directory + filename to output sam file, or stdout",
                   action="store", type="str", dest="outfile", default="stdout")
 
+parser.add_option('-r', '--reference', help="reference fasta file (bwa indexed, or index will be built) used for remapping",
+                  action="store", type="str", dest="refDB", default=None)
+
+parser.add_option('-t', '--threads', help="number of threads for the bwa mem worker [default: %default]",
+                  action="store", type="int", dest="procs", default=1)
+
+parser.add_option('-q', '--min-mapq', help="minimum mapping quality of both reads for a pair to be kept as a confident alignment, others are remapped [default: %default]",
+                  action="store", type="int", dest="min_mapq", default=40)
+
+parser.add_option('-p', '--processes', help="number of processes used to process barcodes in parallel [default: %default]",
+                  action="store", type="int", dest="nprocesses", default=1)
+
+parser.add_option('--max-inflight', help="maximum number of barcodes queued for the processes [default: 4 x processes]",
+                  action="store", type="int", dest="max_inflight", default=None)
+
+parser.add_option('--local', help="remap reads only against the (padded) regions of the barcodes confident alignments, reference must be samtools faidx indexed, with -p each process keeps its own index cache",
+                  action="store_true", dest="local", default=False)
+
+parser.add_option('--pad', help="padding added around the barcodes confident alignments with --local [default: %default]",
+                  action="store", type="int", dest="pad", default=10000)
+
+parser.add_option('--cache-size', help="number of local region indexes kept with --local, per process [default: %default]",
+                  action="store", type="int", dest="cache_size", default=100)
+
+parser.add_option('-T', '--tmpdir', help="directory for the local region indexes [default: system temp directory]",
+                  action="store", type="str", dest="tmpdir", default=None)
+
 parser.add_option('-a', '--all', help="output all alignment, not just those with valid gem barcode (STATUS is UNKNOWN, or AMBIGUOUS)",
                   action="store_true", dest="output_all", default=False)
 
@@ -380,11 +600,15 @@ outfile = options.outfile
 if outfile == "stdout":
     outsam = sys.stdout
 else:
-    outsam = open(outfile, 'r')
+    outsam = open(outfile, 'w')
 
 output_all = options.output_all
 verbose = options.verbose
 
+refDB = options.refDB
+if refDB is None:
+    sys.exit("MAPPING\tERROR\tA reference fasta file (-r) is required for remapping")
+
 # need to check, can write to output folder
 
 # global variables
@@ -392,6 +616,10 @@ file_path = os.path.dirname(os.path.realpath(__file__))
 
 stime = time.time()
 
-main(insam, outsam, output_all, verbose)
+max_inflight = options.max_inflight
+if max_inflight is None:
+    max_inflight = 4 * options.nprocesses
+
+main(insam, outsam, refDB, options.procs, options.nprocesses, max_inflight, options.local, options.pad, options.cache_size, options.tmpdir, output_all, verbose, options.min_mapq)
 
 sys.exit(0)
@@ -2,166 +2,738 @@
 """
 Copyright 2017 Matt Settles
 Created June 8, 2017
+
+Profile the alignments of each gem barcode in a single streaming pass over a barcode
+grouped sam file (samConcat2Tag.py -s, or samtools sort -n), only the current barcode
+is held in memory. Reads of a barcode within --mol-gap bases on the same reference are
+merged into molecules, one row per barcode is written with columns
+
+barcode, pairs, mapped_pairs, fraction_mapped, molecules, reads/molecule,
+molecule length (min, median, mean, max) and span (total length of the molecules)
+
+With --coverage, binned (--bin-size) read coverage and distinct barcode counts per reference
+are accumulated in the same pass and saved as numpy arrays (.npz), requires numpy
+
+With --links, barcodes shared between contig ends (the first/last --end-size bases of each
+reference) are counted in the same pass and saved as a sparse matrix (.npz), requires numpy
+
+With --window-size, the input must instead be coordinate sorted and the number of distinct
+barcodes in each window is estimated with a HyperLogLog sketch (fixed memory regardless of
+the number of barcodes), one row per window is written with columns
+
+reference, start, end, reads, barcodes (estimate)
+
+the sketches can be saved (--sketches) to be merged with those of other shards. With --bam
+(a coordinate sorted, indexed bam) the genome is split into region shards from the @SQ
+lengths, shards are profiled by a pool of --processes (each reading only its region with
+samtools view) and the shard results are merged in genome order. With --coverage the
+coordinate sorted input (stream or --bam shards) is also binned, each shard bins only its
+region and the shard arrays are concatenated. The barcode rows and --links need the barcode
+grouped stream.
 """
 from optparse import OptionParser
-from collectons import Counter
+from collections import OrderedDict
+from fractions import gcd
 import os
 import sys
 import time
-import traceback
 import signal
+from multiprocessing import Pool
+from subprocess import Popen, PIPE
+
+from proc10x.sam import read_sam, mate_pairs
+from proc10x.hll import HyperLogLog
+
+
+def barcode_groups(records):
+    """
+    Group a barcode sorted stream of records by gem barcode, yields (barcode, records)
+    """
+    current_bc = None
+    current_bc_records = []
+    for rec in records:
+        bc = rec.barcode
+        if bc != current_bc:
+            if current_bc is not None:
+                yield current_bc, current_bc_records
+            current_bc = bc
+            current_bc_records = []
+        current_bc_records.append(rec)
+    if current_bc is not None:
+        yield current_bc, current_bc_records
+
+
+profile_columns = ['barcode', 'pairs', 'mapped_pairs', 'fraction_mapped', 'molecules', 'reads_per_molecule',
+                   'molecule_min', 'molecule_median', 'molecule_mean', 'molecule_max', 'span']
+
+
+def infer_molecules(intervals, mol_gap):
+    """
+    Merge (reference, start, end) read intervals within mol_gap bases of each other into
+    molecules, returns a list of [reference, start, end, reads]
+    """
+    intervals.sort()
+    molecules = []
+    for rname, start, end in intervals:
+        if len(molecules) > 0 and molecules[-1][0] == rname and start - molecules[-1][2] <= mol_gap:
+            mol = molecules[-1]
+            mol[2] = max(mol[2], end)
+            mol[3] += 1
+        else:
+            molecules.append([rname, start, end, 1])
+    return molecules
+
+
+def profile_barcode(bc, records, mol_gap=50000, min_mapq=1):
+    """
+    Profile the alignments of a single barcode, returns the row of profile_columns
+    """
+    pairs = 0
+    mapped_pairs = 0
+    intervals = []
+    for r1, r2, others in mate_pairs(records):
+        if r1 is None or r2 is None:
+            continue
+        pairs += 1
+        if not r1.unmapped and not r2.unmapped:
+            mapped_pairs += 1
+        for rec in (r1, r2):
+            if not rec.unmapped and rec.mapq >= min_mapq:
+                intervals.append((rec.rname, rec.pos, rec.end))
+    molecules = infer_molecules(intervals, mol_gap)
+    lengths = sorted(end - start + 1 for rname, start, end, reads in molecules)
+    nmol = len(lengths)
+    if nmol > 0:
+        length_stats = [lengths[0], float(lengths[nmol // 2]) if nmol % 2 else (lengths[nmol // 2 - 1] + lengths[nmol // 2]) / 2.0,
+                        float(sum(lengths)) / nmol, lengths[-1]]
+        reads_per_molecule = float(len(intervals)) / nmol
+    else:
+        length_stats = [0, 0, 0, 0]
+        reads_per_molecule = 0
+    return [bc, pairs, mapped_pairs, float(mapped_pairs) / pairs if pairs > 0 else 0.0, nmol, reads_per_molecule] + length_stats + [sum(lengths)]
+
+
+class BarcodeCoverage:
+    """
+    Binned coverage of each reference (mean read depth, and number of distinct barcodes
+    with a read in the bin). Alignments are collected per barcode and added to the arrays
+    in vectorised batches, a barcode is never split across batches so barcodes are
+    counted once per bin. Reads are counted toward the barcodes of their first and last bin,
+    reads running past the end of the reference are clipped to its length.
+    """
+    def __init__(self, refDict, bin_size=1000, batch_size=200000):
+        import numpy
+        self.numpy = numpy
+        self.bin_size = bin_size
+        self.batch_size = batch_size
+        self.references = list(refDict.keys())
+        self.lengths = [refDict[ref] for ref in self.references]
+        self.offsets = {}
+        self.reflengths = dict(zip(self.references, self.lengths))
+        total = 0
+        for ref, length in zip(self.references, self.lengths):
+            self.offsets[ref] = total
+            total += (length - 1) // bin_size + 1
+        self.nbins = total
+        # one flat buffer, per reference arrays are views into it
+        self.bases = numpy.zeros(total + 1, dtype=numpy.int64)
+        self.spanned = numpy.zeros(total + 1, dtype=numpy.int64)
+        self.barcodes = numpy.zeros(total, dtype=numpy.uint32)
+        self.clear_batch()
+
+    def clear_batch(self):
+        self.offs = []
+        self.lens = []
+        self.starts = []
+        self.ends = []
+        self.bcs = []
+        self.nbc = 0
+
+    def add_barcode(self, records, min_mapq=1):
+        """
+        Queue the mapped (primary) alignments of a barcode
+        """
+        for rec in records:
+            if rec.flag & 0x904 or rec.mapq < min_mapq or rec.rname not in self.offsets:
+                continue
+            self.offs.append(self.offsets[rec.rname])
+            self.lens.append(self.reflengths[rec.rname])
+            self.starts.append(rec.pos - 1)
+            self.ends.append(rec.end)
+            self.bcs.append(self.nbc)
+        self.nbc += 1
+        if len(self.starts) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Add the queued alignments to the coverage arrays
+        """
+        if len(self.starts) == 0:
+            return
+        np = self.numpy
+        off = np.array(self.offs, dtype=np.int64)
+        s = np.array(self.starts, dtype=np.int64)
+        # end exclusive, clipped to the reference so the last bin never spills into the next reference
+        e = np.maximum(np.minimum(np.array(self.ends, dtype=np.int64), np.array(self.lens, dtype=np.int64)), s + 1)
+        bcs = np.array(self.bcs, dtype=np.int64)
+        bs, be = add_bases(np, self.bases, self.spanned, off, s, e, self.bin_size)
+        # distinct barcodes per bin
+        keys = np.unique(np.concatenate([bcs * self.nbins + off + bs, bcs * self.nbins + off + be]))
+        np.add.at(self.barcodes, keys % self.nbins, 1)
+        self.clear_batch()
+
+    def save(self, filename):
+        """
+        Write the arrays (coverage_<reference> as mean depth, barcodes_<reference>) to a .npz file
+        """
+        np = self.numpy
+        self.flush()
+        depth = (self.bases + np.cumsum(self.spanned))[:self.nbins].astype(np.float32) / self.bin_size
+        coverage = OrderedDict()
+        for ref, length in zip(self.references, self.lengths):
+            start = self.offsets[ref]
+            end = start + (length - 1) // self.bin_size + 1
+            coverage[ref] = (depth[start:end], self.barcodes[start:end])
+        write_coverage(filename, self.bin_size, self.references, self.lengths, coverage)
+
+
+def add_bases(np, bases, spanned, off, s, e, b):
+    """
+    Add the bases of alignments [s, e) to the bins of size b (bins offset by off), full bins
+    in between are added to spanned as a difference array, returns the first and last bins
+    """
+    bs = s // b
+    be = (e - 1) // b
+    same = bs == be
+    # bases in the first bin, the last bin, and full bins in between
+    np.add.at(bases, off + bs, np.where(same, e - s, (bs + 1) * b - s))
+    diff = ~same
+    if isinstance(off, np.ndarray):
+        off = off[diff]
+    np.add.at(bases, off + be[diff], e[diff] - be[diff] * b)
+    np.add.at(spanned, off + bs[diff] + 1, b)
+    np.add.at(spanned, off + be[diff], -b)
+    return bs, be
+
+
+def write_coverage(filename, bin_size, references, lengths, coverage):
+    """
+    Write the coverage (coverage_<reference> as mean depth, barcodes_<reference>) of each
+    reference, given as {reference: (depth, barcodes)}, to a .npz file
+    """
+    import numpy as np
+    arrays = {'bin_size': np.array(bin_size),
+              'references': np.array(references),
+              'lengths': np.array(lengths, dtype=np.int64)}
+    for ref in references:
+        arrays['coverage_' + ref] = coverage[ref][0]
+        arrays['barcodes_' + ref] = coverage[ref][1]
+    np.savez_compressed(filename, **arrays)
+
+
+class SortedCoverage:
+    """
+    Binned coverage (as BarcodeCoverage) of one region of a coordinate sorted stream, so the
+    region shards of a reference can be binned separately and their arrays concatenated.
+    The region starts on a bin bound, alignments overlapping it are clipped to it, and a read
+    is counted toward the barcodes of its first and last bin only where that bin is in the
+    region. The barcodes of a bin are held in a set until the stream moves past the bin.
+    """
+    def __init__(self, region, reflength, bin_size=1000, min_mapq=1, batch_size=200000):
+        import numpy
+        self.numpy = numpy
+        self.rname = region[0]
+        self.reflength = reflength
+        self.bin_size = bin_size
+        self.min_mapq = min_mapq
+        self.batch_size = batch_size
+        self.lo = region[1] - 1
+        self.hi = min(region[2], reflength)
+        self.first = self.lo // bin_size
+        self.last = (self.hi - 1) // bin_size
+        nbins = self.last - self.first + 1
+        self.bases = numpy.zeros(nbins + 1, dtype=numpy.int64)
+        self.spanned = numpy.zeros(nbins + 1, dtype=numpy.int64)
+        self.barcodes = numpy.zeros(nbins, dtype=numpy.uint32)
+        self.open = {}
+        self.current = -1
+        self.starts = []
+        self.ends = []
+
+    def add(self, rec):
+        if rec.flag & 0x904 or rec.mapq < self.min_mapq or rec.rname != self.rname:
+            return
+        b = self.bin_size
+        s = rec.pos - 1
+        e = max(min(rec.end, self.reflength), s + 1)
+        bs = s // b
+        if bs > self.current:
+            # no later read starts before bs, so its barcodes can no longer change
+            self.close(bs)
+            self.current = bs
+        for i in set((bs, (e - 1) // b)):
+            if self.first <= i <= self.last:
+                if i not in self.open:
+                    self.open[i] = set()
+                self.open[i].add(rec.barcode)
+        s = max(s, self.lo)
+        e = min(e, self.hi)
+        if s < e:
+            self.starts.append(s - self.lo)
+            self.ends.append(e - self.lo)
+            if len(self.starts) >= self.batch_size:
+                self.flush()
+
+    def close(self, before):
+        for i in [i for i in self.open if i < before]:
+            self.barcodes[i - self.first] = len(self.open.pop(i))
+
+    def flush(self):
+        if len(self.starts) == 0:
+            return
+        np = self.numpy
+        add_bases(np, self.bases, self.spanned, 0,
+                  np.array(self.starts, dtype=np.int64), np.array(self.ends, dtype=np.int64), self.bin_size)
+        self.starts = []
+        self.ends = []
+
+    def finish(self):
+        """
+        Return the region arrays (reference, first bin, depth, barcodes)
+        """
+        np = self.numpy
+        self.flush()
+        self.close(self.last + 1)
+        depth = (self.bases + np.cumsum(self.spanned))[:-1].astype(np.float32) / self.bin_size
+        return self.rname, self.first, depth, self.barcodes
+
+
+def sorted_coverage(records, refDict, bin_size, min_mapq, output_all, pieces, region=None):
+    """
+    Pass a coordinate sorted record stream through, binning the coverage of region (or of each
+    reference in turn), the finished SortedCoverage arrays are appended to pieces
+    """
+    coverage = None
+    for rec in records:
+        # instead check the ST:Z:GOOD for GOOD or MATCH or MISMATCH1
+        if rec.rname in refDict and (output_all or rec.tag('ST:Z:') in ['GOOD', 'MATCH', 'MISMATCH1']):
+            if coverage is None or rec.rname != coverage.rname:
+                if coverage is not None:
+                    pieces.append(coverage.finish())
+                coverage = SortedCoverage(region or (rec.rname, 1, refDict[rec.rname]), refDict[rec.rname], bin_size, min_mapq)
+            coverage.add(rec)
+        yield rec
+    if coverage is not None:
+        pieces.append(coverage.finish())
+
+
+def save_sorted_coverage(filename, refDict, bin_size, pieces):
+    """
+    Concatenate the SortedCoverage arrays of the regions into per reference arrays (bins of
+    regions without reads are 0) and write them to a .npz file
+    """
+    import numpy as np
+    coverage = OrderedDict()
+    for ref, length in refDict.items():
+        nbins = (length - 1) // bin_size + 1
+        coverage[ref] = (np.zeros(nbins, dtype=np.float32), np.zeros(nbins, dtype=np.uint32))
+    for ref, first, depth, barcodes in pieces:
+        coverage[ref][0][first:first + len(depth)] = depth
+        coverage[ref][1][first:first + len(barcodes)] = barcodes
+    write_coverage(filename, bin_size, list(refDict.keys()), list(refDict.values()), coverage)
+
+
+class EndLinks:
+    """
+    Sparse matrix of the number of barcodes shared between contig ends, for scaffolding.
+    End 2*i is the start and 2*i+1 the end of reference i. The ends a barcode touches are
+    deduplicated with a set, its end pairs are queued as integer keys and reduced (summed)
+    with numpy in batches, so memory grows with the number of linked end pairs only.
+    Barcodes touching more than max_ends ends are skipped to avoid a quadratic blow up.
+    """
+    def __init__(self, refDict, end_size=20000, min_mapq=1, max_ends=100, batch_size=1000000):
+        import numpy
+        self.numpy = numpy
+        self.end_size = end_size
+        self.min_mapq = min_mapq
+        self.max_ends = max_ends
+        self.batch_size = batch_size
+        self.references = list(refDict.keys())
+        self.lengths = [refDict[ref] for ref in self.references]
+        self.index = dict((ref, i) for i, ref in enumerate(self.references))
+        self.nends = 2 * len(self.references)
+        self.end_barcodes = numpy.zeros(self.nends, dtype=numpy.uint32)
+        self.keys = numpy.zeros(0, dtype=numpy.int64)
+        self.counts = numpy.zeros(0, dtype=numpy.uint32)
+        self.queue = []
+        self.skipped = 0
+
+    def add_barcode(self, records):
+        ends = set()
+        for rec in records:
+            if rec.flag & 0x904 or rec.mapq < self.min_mapq or rec.rname not in self.index:
+                continue
+            i = self.index[rec.rname]
+            if rec.pos <= self.end_size:
+                ends.add(2 * i)
+            if rec.end > self.lengths[i] - self.end_size:
+                ends.add(2 * i + 1)
+        if len(ends) > self.max_ends:
+            self.skipped += 1
+            return
+        ends = sorted(ends)
+        for e in ends:
+            self.end_barcodes[e] += 1
+        nends = self.nends
+        for j in range(1, len(ends)):
+            for i in range(j):
+                self.queue.append(ends[i] * nends + ends[j])
+        if len(self.queue) >= self.batch_size:
+            self.reduce()
+
+    def reduce(self):
+        """
+        Sum the queued end pairs into the sparse counts
+        """
+        if len(self.queue) == 0:
+            return
+        np = self.numpy
+        keys, counts = np.unique(np.array(self.queue, dtype=np.int64), return_counts=True)
+        keys, inverse = np.unique(np.concatenate([self.keys, keys]), return_inverse=True)
+        self.counts = np.bincount(inverse, weights=np.concatenate([self.counts, counts])).astype(np.uint32)
+        self.keys = keys
+        self.queue = []
+
+    def save(self, filename):
+        """
+        Write the upper triangle of the end link matrix in coordinate (row, col, data) and
+        compressed sparse row (indptr) form, with the ends labels, to a .npz file
+        """
+        np = self.numpy
+        self.reduce()
+        row = self.keys // self.nends
+        col = self.keys % self.nends
+        labels = ['%s:%s' % (ref, side) for ref in self.references for side in ('start', 'end')]
+        np.savez_compressed(filename,
+                            row=row.astype(np.uint32),
+                            col=col.astype(np.uint32),
+                            data=self.counts,
+                            indptr=np.concatenate([[0], np.cumsum(np.bincount(row, minlength=self.nends))]).astype(np.int64),
+                            shape=np.array([self.nends, self.nends]),
+                            end_barcodes=self.end_barcodes,
+                            labels=np.array(labels),
+                            end_size=np.array(self.end_size))
+
+
+window_columns = ['reference', 'start', 'end', 'reads', 'barcodes']
+
+
+class WindowBarcodes:
+    """
+    Distinct barcode estimates per fixed size window of a coordinate sorted stream, only
+    the sketch of the current window is held, it is emitted once the stream moves on
+    """
+    def __init__(self, window_size=10000, min_mapq=1, p=12):
+        self.window_size = window_size
+        self.min_mapq = min_mapq
+        self.p = p
+        self.window = None
+        self.sketch = None
+        self.reads = 0
+        self.rname = None
+        self.pos = 0
+
+    def add(self, rec):
+        """
+        Add an alignment, returns the finished window [reference, start, end, reads, sketch]
+        when the alignment starts a new window, otherwise None
+        """
+        if rec.flag & 0x904 or rec.mapq < self.min_mapq:
+            return None
+        window = (rec.rname, (rec.pos - 1) // self.window_size)
+        if rec.rname == self.rname and rec.pos < self.pos:
+            sys.stderr.write("PROFILE\tERROR\tinput must be coordinate sorted to profile windows\n")
+            sys.exit(1)
+        self.rname = rec.rname
+        self.pos = rec.pos
+        done = None
+        if window != self.window:
+            done = self.finish()
+            self.window = window
+            self.sketch = HyperLogLog(self.p)
+            self.reads = 0
+        self.sketch.add(rec.barcode)
+        self.reads += 1
+        return done
+
+    def finish(self):
+        """
+        Return the current window [reference, start, end, reads, sketch], or None
+        """
+        if self.window is None:
+            return None
+        rname, i = self.window
+        done = [rname, i * self.window_size + 1, (i + 1) * self.window_size, self.reads, self.sketch]
+        self.window = None
+        return done
 
-from subprocess import Popen
-from subprocess import PIPE
-
-                # Handle PE:
-                # logic:  0x1 = multiple segments in sequencing,   0x4 = segment unmapped,  0x8 = next segment unmapped
-                if (flag & 0x1):  # PE READ
-                    if (not (flag & 0x4) and not (flag & 0x8)):  # both pairs mapped
-                        if (flag & 0x40):  # is this PE1 (first segment in template)
-                            # PE1 read, check that PE2 is in dict
-                            ID = line2[0]
-                            if ID in PE2:
-                                if mq >= self.minMQ and int(PE2[ID].strip().split()[4]) >= self.minMQ:  # check MQ of both reads
-                                    self.ok_bc_lines.append(line)
-                                    self.ok_bc_lines.append(PE2[ID])
-                                    del PE2[ID]
-                                    # TODO: NEED to determine read cloud for read
-                                    mapped_pairs_count += 1
-                                else:
-                                    if (flag & 0x10):  # reverse complement
-                                        line2[9] = reverseComplement(line2[9])
-                                        line2[10] = reverse(line2[10])
-                                    r1 = '\n'.join(['@' + line2[0] + ' 1:N:O', line2[9], '+', line2[10]])  # sequence + qual
-                                    rl2 = PE2[ID].strip().split()
-                                    if (int(rl2[1]) & 0x10):  # reverse complement
-                                        rl2[9] = reverseComplement(rl2[9])
-                                        rl2[10] = reverse(rl2[10])
-                                    r2 = '\n'.join(['@' + rl2[0] + ' 2:N:O', rl2[9], '+', rl2[10]])  # sequence + qual
-                                    self.addRead('\n'.join([r1, r2]))
-                                    del PE2[ID]
-                                    remapped_pairs_count += 1
-                            else:
-                                PE1[ID] = line
-                        elif (flag & 0x80):  # is this PE2 (last segment in template)
-                            # PE2 read, check that PE1 is in dict and write out
-                            ID = line2[0]
-                            if ID in PE1:
-                                if mq >= self.minMQ and int(PE1[ID].strip().split()[4]) >= self.minMQ:  # check MQ of both reads
-                                    self.ok_bc_lines.append(line)
-                                    self.ok_bc_lines.append(PE1[ID])
-                                    del PE1[ID]
-                                    # TODO: NEED to determine read cloud for read
-                                    mapped_pairs_count += 1
-                                else:
-                                    if (flag & 0x10):  # reverse complement
-                                        line2[9] = reverseComplement(line2[9])
-                                        line2[10] = reverse(line2[10])
-                                    r2 = '\n'.join(['@' + line2[0] + ' 2:N:O', line2[9], '+', line2[10]])  # sequence + qual
-                                    rl1 = PE1[ID].strip().split()
-                                    if (int(rl1[1]) & 0x10):  # reverse complement
-                                        rl1[9] = reverseComplement(rl1[9])
-                                        rl1[10] = reverse(rl1[10])
-                                    r1 = '\n'.join(['@' + rl1[0] + ' 1:N:O', rl1[9], '+', rl1[10]])  # sequence + qual
-                                    self.addRead('\n'.join([r1, r2]))
-                                    del PE1[ID]
-                                    remapped_pairs_count += 1
-                            else:
-                                PE2[ID] = line
-                    else:  # an 'unmapped' pair, at least 1 unmapped
-                        if (flag & 0x40):  # is this PE1 (first segment in template)
-                            # PE1 read, check that PE2 is in dict and write out
-                            ID = line2[0]
-                            if ID in PE2:
-                                if (flag & 0x10):  # reverse complement
-                                    line2[9] = reverseComplement(line2[9])
-                                    line2[10] = reverse(line2[10])
-                                r1 = '\n'.join(['@' + line2[0] + ' 1:N:O', line2[9], '+', line2[10]])  # sequence + qual
-                                rl2 = PE2[ID].strip().split()
-                                if (int(rl2[1]) & 0x10):  # reverse complement
-                                    rl2[9] = reverseComplement(rl2[9])
-                                    rl2[10] = reverse(rl2[10])
-                                r2 = '\n'.join(['@' + rl2[0] + ' 2:N:O', rl2[9], '+', rl2[10]])  # sequence + qual
-                                self.addRead('\n'.join([r1, r2]))
-                                del PE2[ID]
-                                remapped_pairs_count += 1
-                            else:
-                                PE1[ID] = line
-                        elif (flag & 0x80):  # is this PE2 (last segment in template)
-                            # PE2 read, check that PE1 is in dict and write out
-                            ID = line2[0]
-                            if ID in PE1:
-                                if (flag & 0x10):  # reverse complement
-                                    line2[9] = reverseComplement(line2[9])
-                                    line2[10] = reverse(line2[10])
-                                r1 = '\n'.join(['@' + line2[0] + ' 1:N:O', line2[9], '+', line2[10]])  # sequence + qual
-                                rl2 = PE2[ID].strip().split()
-                                if (int(rl2[1]) & 0x10):  # reverse complement
-                                    rl2[9] = reverseComplement(rl2[9])
-                                    rl2[10] = reverse(rl2[10])
-                                r2 = '\n'.join(['@' + rl2[0] + ' 2:N:O', rl2[9], '+', rl2[10]])  # sequence + qual
-                                self.addRead('\n'.join([r1, r2]))
-                                del PE2[ID]
-                                remapped_pairs_count += 1
-                            else:
-                                PE2[ID] = line
-
-
-def main(insam, output_all, verbose):
+
+def format_window(window):
+    return '%s\t%i\t%i\t%i\t%.0f\n' % (window[0], window[1], window[2], window[3], window[4].estimate())
+
+
+def format_row(row):
+    return '\t'.join(('%.4f' % v) if isinstance(v, float) else str(v) for v in row) + '\n'
+
+
+def window_profile(records, window_size, min_mapq, output_all, shard=None):
+    """
+    Yield the finished windows [reference, start, end, reads, sketch] of a coordinate sorted
+    record stream, with a shard (reference, start, end) only reads starting in it are used
+    """
+    windows = WindowBarcodes(window_size, min_mapq)
+    for rec in records:
+        if shard is not None and (rec.pos < shard[1] or rec.pos > shard[2]):
+            continue  # overlaps the shard but belongs to the previous one
+        # instead check the ST:Z:GOOD for GOOD or MATCH or MISMATCH1
+        if output_all or rec.tag('ST:Z:') in ['GOOD', 'MATCH', 'MISMATCH1']:
+            window = windows.add(rec)
+            if window is not None:
+                yield window
+    window = windows.finish()
+    if window is not None:
+        yield window
+
+
+def sp_samtools_view(bam, region=None, header_only=False):
+    """
+    Stream the sam records (or header) of a bam file, optionally for a region only
+    """
+    call = ['samtools', 'view']
+    if header_only:
+        call.append('-H')
+    call.append(bam)
+    if region is not None:
+        call.append(region)
+    return Popen(call, stdout=PIPE, bufsize=-1,
+                 preexec_fn=lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL))
+
+
+def make_shards(refDict, shard_size, step):
+    """
+    Split the references into (reference, start, end) shards, shard bounds fall on multiples
+    of step (window and coverage bin bounds) so no window or bin is split between shards
+    """
+    shard_size = max(step, (shard_size // step) * step)
+    shards = []
+    for ref, length in refDict.items():
+        for start in range(1, length + 1, shard_size):
+            shards.append((ref, start, min(length, start + shard_size - 1)))
+    return shards
+
+
+def profile_shard(args):
+    """
+    Profile the windows and/or coverage bins of one region shard of an indexed bam, returns
+    (records, windows, summary, coverage), the summary of the shard windows is merged in the
+    worker (None if not wanted), coverage is the SortedCoverage arrays (None without bin_size)
+    """
+    bam, shard, reflength, window_size, bin_size, min_mapq, output_all, summarise = args
+    counter = {'records': 0}
+    pieces = []
+
+    def records():
+        for rec in read_sam(p.stdout):
+            counter['records'] += 1
+            yield rec
+
+    p = sp_samtools_view(bam, '%s:%i-%i' % shard)
+    shard_records = records()
+    if bin_size is not None:
+        shard_records = sorted_coverage(shard_records, {shard[0]: reflength}, bin_size, min_mapq, output_all, pieces, shard)
+    windows = []
+    if window_size is not None:
+        windows = list(window_profile(shard_records, window_size, min_mapq, output_all, shard))
+    else:
+        for rec in shard_records:
+            pass
+    p.wait()
+    if p.returncode:
+        raise Exception("samtools view failed on region %s:%i-%i" % shard)
+    summary = None
+    if summarise:
+        summary = WindowSummary()
+        for window in windows:
+            summary.add(window)
+    return counter['records'], windows, summary, pieces[0] if pieces else None
+
+
+class WindowSummary:
+    """
+    Merge window results into per reference totals (reads, union of barcode sketches),
+    summaries of shards (in genome order) are merged with merge
+    """
+    def __init__(self):
+        self.references = OrderedDict()
+
+    def add(self, window):
+        self.add_reference(window[0], 1, window[3], window[4])
+
+    def add_reference(self, name, nwindows, nreads, sketch):
+        if name not in self.references:
+            self.references[name] = [0, 0, HyperLogLog(sketch.p)]
+        ref = self.references[name]
+        ref[0] += nwindows
+        ref[1] += nreads
+        ref[2].merge(sketch)
+
+    def merge(self, other):
+        for name, (nwindows, nreads, sketch) in other.references.items():
+            self.add_reference(name, nwindows, nreads, sketch)
+
+    def write(self, out):
+        total = None
+        reads = 0
+        for name, (nwindows, nreads, sketch) in self.references.items():
+            out.write("PROFILE\tREFERENCE\t%s\twindows:%i|reads:%i|barcodes:%.0f\n" % (name, nwindows, nreads, sketch.estimate()))
+            reads += nreads
+            if total is None:
+                total = HyperLogLog(sketch.p)
+            total.merge(sketch)
+        if total is not None:
+            out.write("PROFILE\tSUMMARY\treferences:%i|reads:%i|barcodes:%.0f\n" % (len(self.references), reads, total.estimate()))
+
+
+def main_windows(insam, outf, window_size, min_mapq, sketch_file, output_all, verbose, bam=None, processes=1, shard_size=10000000,
+                 coverage_file=None, bin_size=1000):
+    """
+    Estimate distinct barcodes per window (and/or bin the coverage) of a coordinate sorted sam
+    stream, or of an indexed bam profiled in parallel region shards
+    """
+    # the summary is only written with verbose output, no need to merge the sketches otherwise
+    summary = WindowSummary() if verbose else None
+    counter = {'records': 0, 'windows': 0}
+    if sketch_file is not None:
+        sketchf = open(sketch_file, 'w')
+
+    def emit(window):
+        outf.write(format_window(window))
+        if sketch_file is not None:
+            sketchf.write('%s\t%i\t%i\t%i\t%s\n' % (window[0], window[1], window[2], window[3], window[4].to_string()))
+        counter['windows'] += 1
+
+    refDict = OrderedDict()
+    pieces = []
+
+    def header(line):
+        if line[0:3] == "@SQ":
+            # reference sequence id
+            sp = line.split()
+            refDict[sp[1][3:]] = int(sp[2][3:])
+
+    def records():
+        for rec in read_sam(insam, header):
+            counter['records'] += 1
+            if counter['records'] % 100000 == 0 and verbose:
+                sys.stderr.write("PROFILE\tRECORDS\tRecords processed: %s\n" % (counter['records']))
+            yield rec
+
+    if window_size is not None:
+        outf.write('\t'.join(window_columns) + '\n')
+    if bam is None:
+        stream = records()
+        if coverage_file is not None:
+            stream = sorted_coverage(stream, refDict, bin_size, min_mapq, output_all, pieces)
+        if window_size is not None:
+            for window in window_profile(stream, window_size, min_mapq, output_all):
+                emit(window)
+                if summary is not None:
+                    summary.add(window)
+        else:
+            for rec in stream:
+                pass
+    else:
+        p = sp_samtools_view(bam, header_only=True)
+        for line in p.stdout:
+            header(line)
+        p.wait()
+        # shards fall on both window and coverage bin bounds
+        step = window_size or bin_size
+        if window_size is not None and coverage_file is not None:
+            step = window_size * bin_size // gcd(window_size, bin_size)
+        shards = make_shards(refDict, shard_size, step)
+        if verbose:
+            sys.stderr.write("PROFILE\tSHARDS\tprofiling %i region shards with %i processes\n" % (len(shards), processes))
+        pool = Pool(processes)
+        try:
+            # imap returns shards in genome order, so the merged output is deterministic
+            shard_bins = bin_size if coverage_file is not None else None
+            for nrecords, windows, shard_summary, shard_coverage in pool.imap(profile_shard, [(bam, shard, refDict[shard[0]], window_size, shard_bins, min_mapq, output_all, verbose) for shard in shards]):
+                counter['records'] += nrecords
+                for window in windows:
+                    emit(window)
+                if summary is not None:
+                    summary.merge(shard_summary)
+                if shard_coverage is not None:
+                    pieces.append(shard_coverage)
+        finally:
+            pool.close()
+            pool.join()
+    if sketch_file is not None:
+        sketchf.close()
+    if coverage_file is not None:
+        save_sorted_coverage(coverage_file, refDict, bin_size, pieces)
+
+    if verbose:
+        sys.stderr.write("PROFILE\tRECORDS\tRecords processed: %s|windows:%s\n" % (counter['records'], counter['windows']))
+        summary.write(sys.stderr)
+
+
+def main(insam, outf, mol_gap, min_mapq, coverage_file, bin_size, links_file, end_size, max_ends, output_all, verbose):
     global file_path
-    refDict = {}
-    bcDict = {}
-
-    line_count = 0
-    bc_count = 0
-
-    for line in insam:
-        # Comment/header lines start with @
-        if line[0] == "@":
-            # pass header directly to output
-            if line[0:3] == "@SQ":
-                # reference sequence id
-                sp = line.split()
-                refDict[sp[1][3:]] = int(sp[2][3:])
-        elif line[0] != "@" and len(line.strip().split()) > 2:
-            line_count += 1
-            bc = line.split(":")[0]
+    refDict = OrderedDict()
+    coverage = None
+    links = None
+    counts = {'records': 0, 'barcodes': 0}
 
+    def header(line):
+        if line[0:3] == "@SQ":
+            # reference sequence id
+            sp = line.split()
+            refDict[sp[1][3:]] = int(sp[2][3:])
+
+    def records():
+        for rec in read_sam(insam, header):
+            counts['records'] += 1
+            if counts['records'] % 100000 == 0 and verbose:
+                sys.stderr.write("PROFILE\tRECORDS\tRecords processed: %s\n" % (counts['records']))
             # instead check the ST:Z:GOOD for GOOD or MATCH or MISMATCH1
-            if line.split()[15][5:] not in ['GOOD', 'MATCH', 'MISMATCH1']:
-                # if seqToHash(bc) not in gbcDict:
-                # barcode does not match whitelist
-                if output_all:
-                    # if output_all pass line directly to output
-                    outsam.write(line)
-            elif bc == current_bc:
-                # add line to bc processing
-                proc_bc.addLine(line)
-                current_bc_count += 1
-            elif current_bc is None:
-                current_bc = bc
-                # add line to bc processing
-                proc_bc.addLine(line)
-                current_bc_count += 1
-            else:
-                # this is a new barcode
-                # can add a check to see if seen bc before, which is a no-no
-                # process the bc
-                proc_bc.process()
-                # record having processed the barcode
-                # output to sam file
-                bc_count += 1
-                proc_bc.clearbc()
-                current_bc = bc
-                # add line to bc processing
-                current_bc_count = 1
-                proc_bc.addLine(line)
-        else:
-            # Not sure what happened
-            sys.stderr.write("Unknown line: %s" % line)
+            if output_all or rec.tag('ST:Z:') in ['GOOD', 'MATCH', 'MISMATCH1']:
+                yield rec
+
+    outf.write('\t'.join(profile_columns) + '\n')
+    for bc, bc_records in barcode_groups(records()):
+        counts['barcodes'] += 1
+        outf.write(format_row(profile_barcode(bc, bc_records, mol_gap, min_mapq)))
+        if coverage_file is not None:
+            if coverage is None:
+                coverage = BarcodeCoverage(refDict, bin_size)
+            coverage.add_barcode(bc_records, min_mapq)
+        if links_file is not None:
+            if links is None:
+                links = EndLinks(refDict, end_size, min_mapq, max_ends)
+            links.add_barcode(bc_records)
 
-        if line_count % 100000 == 0 and line_count > 0 and verbose:
-            print "Records processed: %s" % (line_count)
+    if coverage is not None:
+        coverage.save(coverage_file)
+    if links is not None:
+        links.save(links_file)
+        if verbose:
+            sys.stderr.write("PROFILE\tLINKS\tlinked end pairs:%i|barcodes skipped (> %i ends):%i\n" % (len(links.keys), max_ends, links.skipped))
+
+    if verbose:
+        sys.stderr.write("PROFILE\tRECORDS\tRecords processed: %s|barcodes:%s\n" % (counts['records'], counts['barcodes']))
 
 
 #####################################
@@ -173,6 +745,42 @@ parser = OptionParser(usage=usage, version="%prog 0.0.1")
 parser.add_option('-o', '--output', help="Directory + filename to output bc stats",
                   action="store", type="str", dest="outfile", default="bc_profile.txt")
 
+parser.add_option('-g', '--mol-gap', help="maximum distance between reads of a barcode within the same molecule [default: %default]",
+                  action="store", type="int", dest="mol_gap", default=50000)
+
+parser.add_option('-q', '--min-mapq', help="minimum mapping quality of a read used to infer molecules [default: %default]",
+                  action="store", type="int", dest="min_mapq", default=1)
+
+parser.add_option('-c', '--coverage', help="save binned read coverage and distinct barcodes per bin for each reference to this .npz file (requires numpy)",
+                  action="store", type="str", dest="coverage_file", default=None)
+
+parser.add_option('-b', '--bin-size', help="bin size of the coverage arrays [default: %default]",
+                  action="store", type="int", dest="bin_size", default=1000)
+
+parser.add_option('-l', '--links', help="save the number of barcodes shared between contig ends as a sparse matrix to this .npz file (requires numpy)",
+                  action="store", type="str", dest="links_file", default=None)
+
+parser.add_option('--end-size', help="size of the contig ends used for --links [default: %default]",
+                  action="store", type="int", dest="end_size", default=20000)
+
+parser.add_option('--max-ends', help="skip barcodes touching more than this many contig ends with --links [default: %default]",
+                  action="store", type="int", dest="max_ends", default=100)
+
+parser.add_option('-w', '--window-size', help="estimate distinct barcodes per window of this size instead of profiling barcodes, input must be coordinate sorted (--coverage is then binned from the sorted input)",
+                  action="store", type="int", dest="window_size", default=None)
+
+parser.add_option('--sketches', help="with --window-size, also save the barcode sketch of each window to this file (for merging shards)",
+                  action="store", type="str", dest="sketch_file", default=None)
+
+parser.add_option('--bam', help="with --window-size and/or --coverage, profile this coordinate sorted and indexed bam in parallel region shards (not --links)",
+                  action="store", type="str", dest="bam", default=None)
+
+parser.add_option('-p', '--processes', help="number of processes used to profile region shards with --bam [default: %default]",
+                  action="store", type="int", dest="processes", default=1)
+
+parser.add_option('--shard-size', help="size of the region shards with --bam [default: %default]",
+                  action="store", type="int", dest="shard_size", default=10000000)
+
 parser.add_option('-a', '--all', help="output all barcodes, not just those with valid gem barcode (STATUS is UNKNOWN, or AMBIGUOUS)",
                   action="store_true", dest="output_all", default=False)
 
@@ -181,7 +789,15 @@ parser.add_option('--quiet', help="turn off verbose output",
 
 (options, args) = parser.parse_args()
 
-if len(args) == 1:
+if (options.window_size is not None or options.bam is not None) and options.links_file is not None:
+    sys.exit("PROFILE\tERROR\t--links needs a barcode grouped input, it cannot be used with --window-size or --bam")
+if options.bam is not None:
+    if options.window_size is None and options.coverage_file is None:
+        sys.exit("PROFILE\tERROR\t--bam requires --window-size or --coverage")
+    if not os.path.exists(options.bam):
+        sys.exit("Error, can't find input file %s" % options.bam)
+    insam = None
+elif len(args) == 1:
     infile = args[0]
     # Start opening input/output files:
     if not os.path.exists(infile):
@@ -196,7 +812,7 @@ outfile = options.outfile
 if outfile == "stdout":
     outf = sys.stdout
 else:
-    outf = open(outfile, 'r')
+    outf = open(outfile, 'w')
 
 output_all = options.output_all
 verbose = options.verbose
@@ -208,6 +824,11 @@ file_path = os.path.dirname(os.path.realpath(__file__))
 
 stime = time.time()
 
-main(insam, outf, output_all, verbose)
+if options.window_size is not None or options.bam is not None:
+    main_windows(insam, outf, options.window_size, options.min_mapq, options.sketch_file, output_all, verbose,
+                 options.bam, options.processes, options.shard_size, options.coverage_file, options.bin_size)
+else:
+    main(insam, outf, options.mol_gap, options.min_mapq, options.coverage_file, options.bin_size,
+         options.links_file, options.end_size, options.max_ends, output_all, verbose)
 
 sys.exit(0)
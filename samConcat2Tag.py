@@ -7,10 +7,313 @@ bwa mem -C option concatenats the fasta/fastq
 CTACATTGTCAAGGGT:E00558:34:HGCJ3ALXX:1:1101:2108:1731   99      000000F 922571  60      127M    =       922961  517     ACTCGGGGAGGTGTTAGCTGCTGCCTCACACATTGGGTTTATAGGCTGAATCTTGTTCTCTTTAGGCTTCCAGAGTTTTCTCAGTTACTATTTCTCCTGTCACATACTCGCTGCTTCTTCTGTCATA JJJJJJ<JJF<7A7FJJJJJJ<JJJAJAJJJFJFFFJ----AJJFJ---7---<FJJ<JF<7FFFJJJFJJAJF-AAFFFFF-AFJF7FF<A--FJJJAF)-7-77<<7--)7)<<--77A7-<--< NM:i:3  MD:Z:74T34A3T13 AS:i:112        XS:i:19 1:N:0:GOOD:CCGATTAA:CTACATTGTCAAGGGT:<AAFFJJFJJFJJJJJ:CCAGTGA:J<FFFJJ
 
 This pulls it out, 9 columns and produces new 10x tags in the bam then writes to out
+
+With --molecules (input must be coordinate sorted) reads of a barcode within --mol-gap
+bases of each other are assigned to the same molecule and given a MI tag, a window is kept
+per active barcode and dropped once the coordinate moves beyond the gap distance
+
+With --sort the tagged records are sorted by BX then QNAME (an external merge sort,
+sorted runs are spilled compressed to a temporary directory when the memory cap is
+reached), producing the barcode grouped stream expected by process_mapping.py and
+profile_mapping.py without the need for samtools sort -n
 '''
 import sys
 import os
 import argparse
+import heapq
+import shutil
+import tempfile
+from subprocess import PIPE
+from multiprocessing import Pool
+
+from proc10x.sam import cigar_reflen, get_tag
+from proc10x.metrics import RunMetrics
+from proc10x.progress import InputProgress
+from proc10x.fastqio import sp_gzip_read, sp_gzip_write, sp_gzip_wait
+
+
+def parse_memory(mem):
+    """
+    Convert a samtools style memory string (ex. 768M, 2G) to bytes
+    """
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    mem = mem.strip().upper()
+    if mem[-1] in units:
+        return int(float(mem[:-1]) * units[mem[-1]])
+    return int(mem)
+
+
+def concat2tag(line):
+    """
+    Convert the comment bwa mem -C appended to a sam record into 10x tags,
+    returns the new sam line
+    """
+    line2 = line.strip().split()
+    # Handle TAG:
+    # get the final concatenatd tag
+    tag = line2[-1]
+    if (tag[0:6] in ['1:N:0:', '2:N:0:']):
+        tsplit = tag.split(":", 4)
+        tsplit2 = tsplit[4].split("_")
+        if len(tsplit2) != 5:
+            sys.stderr.write("SAMCONCAT\tERROR\tsam file has concatenated info, but its the wrong size")
+            sys.exit(1)
+        # fixed barcode
+        line2 = line2[0:-1]
+        line2.extend(["ST:Z:" + tsplit2[0],
+                      "BX:Z:" + line2[0].split(":")[0] + "-1",
+                      "BC:Z:" + tsplit[3],
+                      "QT:Z:" + '!' * len(tsplit[3]),
+                      "RX:Z:" + tsplit2[1],
+                      "QX:Z:" + tsplit2[2],
+                      "TR:Z:" + tsplit2[3],
+                      "TQ:Z:" + tsplit2[4]])
+    # Does not contain a concatenated tag as expected by bwa mem, write as is
+    return '\t'.join(line2) + '\n'
+
+
+class MoleculeTagger:
+    """
+    Assign molecule (MI) ids to the reads of a coordinate sorted sam stream. A read
+    extends the active molecule of its barcode when on the same reference and within
+    gap bases of the molecule end, otherwise a new molecule is started. Molecules are
+    evicted once the coordinate has moved more than gap bases past their end, so memory
+    is bounded by the number of active molecules rather than genome size. Likewise a
+    first mate's molecule is kept only for a mate on the same reference, and dropped once
+    the coordinate is more than gap bases past the mate position.
+    """
+    def __init__(self, gap=50000, min_mapq=1, status=('MATCH', 'MISMATCH1')):
+        self.gap = gap
+        self.min_mapq = min_mapq
+        self.status = status
+        self.active = {}  # barcode -> [molecule id, molecule end]
+        self.heap = []  # (molecule end, barcode, molecule id), stale entries skipped
+        self.mates = {}  # read id -> molecule id of the first mate
+        self.mate_heap = []  # (mate position, read id), entries of mates seen are skipped
+        self.rname = None
+        self.pos = 0
+        self.molecules = 0
+        self.mcount = 0
+
+    def evict(self, pos):
+        """
+        Drop molecules that end more than gap bases before pos
+        """
+        heap = self.heap
+        while len(heap) > 0 and heap[0][0] + self.gap < pos:
+            end, bc, mi = heapq.heappop(heap)
+            mol = self.active.get(bc)
+            if mol is None or mol[0] != mi:
+                continue
+            if mol[1] + self.gap < pos:
+                del self.active[bc]
+            else:  # molecule was extended since queued
+                heapq.heappush(heap, (mol[1], bc, mi))
+        mate_heap = self.mate_heap
+        while len(mate_heap) > 0 and mate_heap[0][0] + self.gap < pos:
+            self.mates.pop(heapq.heappop(mate_heap)[1], None)
+
+    def tag(self, line):
+        """
+        Return the sam line with a MI tag appended when a molecule can be assigned
+        """
+        fields = line.split('\t', 9)
+        flag = int(fields[1])
+        if flag & 0x904:  # unmapped, secondary or supplementary
+            return line
+        rname = fields[2]
+        pos = int(fields[3])
+        if rname != self.rname:
+            self.active = {}
+            self.heap = []
+            self.mates = {}
+            self.mate_heap = []
+            self.rname = rname
+        elif pos < self.pos:
+            sys.stderr.write("SAMCONCAT\tERROR\tinput must be coordinate sorted to infer molecules\n")
+            sys.exit(1)
+        self.pos = pos
+        self.evict(pos)
+        qname = fields[0]
+        mi = self.mates.pop(qname, None)
+        if int(fields[4]) < self.min_mapq:
+            return line
+        bc = get_tag(line, 'BX:Z:')
+        if bc is None or get_tag(line, 'ST:Z:') not in self.status:
+            return line
+        end = pos + cigar_reflen(fields[5]) - 1
+        mol = self.active.get(bc)
+        if mi is None:
+            if mol is not None and pos - mol[1] <= self.gap:
+                mi = mol[0]
+            else:
+                self.molecules += 1
+                mi = self.molecules
+                mol = self.active[bc] = [mi, end]
+                heapq.heappush(self.heap, (end, bc, mi))
+            # remember the molecule for a mate still to come on this reference
+            if flag & 0x1 and not flag & 0x8 and fields[6] == '=':
+                pnext = int(fields[7])
+                if pnext >= pos:
+                    self.mates[qname] = mi
+                    heapq.heappush(self.mate_heap, (pnext, qname))
+        if mol is not None and mol[0] == mi and end > mol[1]:
+            mol[1] = end
+        self.mcount += 1
+        return line[:-1] + '\tMI:i:%i\n' % mi
+
+
+def sort_key(line):
+    """
+    Sort key of a tagged sam line, BX tag (empty when absent) then QNAME
+    """
+    start = line.find('\tBX:Z:')
+    if start == -1:
+        bx = ''
+    else:
+        start += 6
+        end = line.find('\t', start)
+        bx = line[start:end] if end != -1 else line[start:-1]
+    return bx, line[:line.find('\t')]
+
+
+def read_run(filename, run):
+    """
+    Stream the lines of a sorted run back, decorated for a stable merge
+    """
+    i = 0
+    # many runs are read at once, smaller buffers, gzip messages kept out of the records
+    p = sp_gzip_read(filename, 65536, stderr=PIPE)
+    for line in p.stdout:
+        bx, qname = sort_key(line)
+        yield bx, qname, run, i, line
+        i += 1
+    # a truncated or corrupt run must not pass as a short one
+    sp_gzip_wait(p, filename)
+
+
+def merge_runs(runs):
+    """
+    k-way merge of sorted runs, yields lines in sorted order
+    """
+    for record in heapq.merge(*[read_run(filename, i) for i, filename in enumerate(runs)]):
+        yield record[4]
+
+
+def merge_to_run(args):
+    """
+    Merge a batch of sorted runs into a single new run, removing the inputs
+    """
+    runs, filename = args
+    p = sp_gzip_write(filename, level=1)
+    for line in merge_runs(runs):
+        p.stdin.write(line)
+    sp_gzip_wait(p, filename)
+    for run in runs:
+        os.remove(run)
+    return filename
+
+
+class ExternalBarcodeSort:
+    """
+    Sort tagged sam lines by BX then QNAME in bounded memory. Lines are held in memory
+    until the memory cap is reached, then sorted and spilled as a compressed run to the
+    temporary directory, runs are k-way merged when the sorted output is requested.
+    """
+    # approximate per line overhead of the python objects holding a line in memory
+    line_overhead = 200
+
+    def __init__(self, max_mem=768 * 1024**2, tmpdir=None, threads=1, max_open=64, verbose=True):
+        self.max_mem = max_mem
+        self.threads = threads
+        self.max_open = max(2, max_open)
+        self.verbose = verbose
+        self.tmpdir = tempfile.mkdtemp(prefix='samConcat2Tag.', dir=tmpdir)
+        self.runs = []
+        self.nruns = 0
+        self.buffer = []
+        self.buffer_mem = 0
+        self.mcount = 0
+
+    def new_run_name(self):
+        self.nruns += 1
+        return os.path.join(self.tmpdir, 'run%06i.sam.gz' % self.nruns)
+
+    def add(self, line):
+        self.buffer.append((sort_key(line), line))
+        self.buffer_mem += len(line) + self.line_overhead
+        self.mcount += 1
+        if self.buffer_mem >= self.max_mem:
+            self.spill()
+
+    def spill(self):
+        """
+        Sort the in memory lines and write them out as a compressed run
+        """
+        if len(self.buffer) == 0:
+            return
+        # list.sort is stable, so records of the same key keep their input order
+        self.buffer.sort(key=lambda record: record[0])
+        filename = self.new_run_name()
+        p = sp_gzip_write(filename, level=1)
+        for record in self.buffer:
+            p.stdin.write(record[1])
+        # only a run gzip finished cleanly is listed for the merge
+        sp_gzip_wait(p, filename)
+        self.runs.append(filename)
+        if self.verbose:
+            sys.stderr.write("SAMCONCAT\tSORT\twrote run %i with %i records\n" % (len(self.runs), len(self.buffer)))
+        self.buffer = []
+        self.buffer_mem = 0
+
+    def reduce_runs(self):
+        """
+        Merge runs in batches of max_open (in parallel when threads > 1) until
+        they can all be opened at once for the final merge
+        """
+        while len(self.runs) > self.max_open:
+            batches = [(self.runs[i:i + self.max_open], self.new_run_name())
+                       for i in range(0, len(self.runs), self.max_open)]
+            if self.threads > 1:
+                pool = Pool(self.threads)
+                try:
+                    self.runs = pool.map(merge_to_run, batches)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                self.runs = [merge_to_run(batch) for batch in batches]
+            if self.verbose:
+                sys.stderr.write("SAMCONCAT\tSORT\tmerged runs down to %i\n" % len(self.runs))
+
+    def sorted_lines(self):
+        """
+        Yield all lines added in sorted order
+        """
+        if len(self.runs) == 0:
+            # everything fit in memory, no need to touch disk
+            self.buffer.sort(key=lambda record: record[0])
+            for record in self.buffer:
+                yield record[1]
+            self.buffer = []
+            return
+        self.spill()
+        self.reduce_runs()
+        for line in merge_runs(self.runs):
+            yield line
+
+    def cleanup(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def sorted_header(line):
+    """
+    Mark the @HD line as grouped by query (barcode) rather than sorted
+    """
+    fields = [f for f in line.strip().split('\t') if f[0:3] not in ['SO:', 'GO:']]
+    fields.extend(['SO:unsorted', 'GO:query'])
+    return '\t'.join(fields) + '\n'
+
 
 version_num = "0.0.2"
 parser = argparse.ArgumentParser(
@@ -22,22 +325,60 @@ parser.add_argument('--version', action='version', version="%(prog)s version: "
 parser.add_argument('-o', '--output_base', help="Directory + prefix to output, [default: %(default)s]",
                     action="store", type=str, dest="output_base", default="stdout")
 
+parser.add_argument('-s', '--sort', help="sort output by BX tag (gem barcode) then read name, replaces samtools sort -n [default: %(default)s]",
+                    action="store_true", dest="sort", default=False)
+
+parser.add_argument('-m', '--sort-mem', help="maximum memory used for sorting before spilling to disk (ex. 768M, 2G) [default: %(default)s]",
+                    action="store", type=str, dest="sort_mem", default="768M")
+
+parser.add_argument('-T', '--tmpdir', help="directory for temporary sort files [default: system temp directory]",
+                    action="store", type=str, dest="tmpdir", default=None)
+
+parser.add_argument('--sort-threads', help="number of processes used to merge temporary sort files, only used when there are more than --sort-fanin files [default: %(default)s]",
+                    action="store", type=int, dest="sort_threads", default=1)
+
+parser.add_argument('--sort-fanin', help="maximum number of temporary sort files merged at once, more are first merged in batches [default: %(default)s]",
+                    action="store", type=int, dest="sort_fanin", default=64)
+
+parser.add_argument('-M', '--molecules', help="infer molecules and add MI tags, input must be coordinate sorted [default: %(default)s]",
+                    action="store_true", dest="molecules", default=False)
+
+parser.add_argument('--mol-gap', help="maximum distance between reads of a barcode within the same molecule [default: %(default)s]",
+                    action="store", type=int, dest="mol_gap", default=50000)
+
+parser.add_argument('--mol-mapq', help="minimum mapping quality of a read to be assigned a molecule [default: %(default)s]",
+                    action="store", type=int, dest="mol_mapq", default=1)
+
+parser.add_argument('--quiet', help="turn off verbose output",
+                    action="store_false", dest="verbose", default=True)
+
+parser.add_argument('--metrics', help="periodically rewrite run metrics to this file, JSON or Prometheus text format if the name ends in .prom [default: %(default)s]",
+                    action="store", type=str, dest="metrics", default=None)
+
+parser.add_argument('--metrics-interval', help="seconds between --metrics updates [default: %(default)s]",
+                    type=float, dest="metrics_interval", default=10.0)
+
 parser.add_argument('inputfile', metavar='inputsam', type=str, nargs='?',
                     help='Sam file to process [default: %(default)s]', default="stdin")
 
 
 args = parser.parse_args()  # uncomment this line for command line support
 
+if args.sort_fanin < 2:
+    sys.exit("SAMCONCAT\tERROR\t--sort-fanin must be at least 2")
 
 if args.inputfile == 'stdin':
     # reading from stdin
     insam = sys.stdin
+    progress = InputProgress([])
 else:
     infile = args.inputfile
     # Start opening input/output files:
     if not os.path.exists(infile):
         sys.exit("Error, can't find input file %s" % infile)
     insam = open(infile, 'r')
+    progress = InputProgress([infile])
+    progress.opened([(infile, insam)])
 
 base = args.output_base
 
@@ -46,35 +387,67 @@ if base is "stdout":
 else:
     out = open(base + ".sam", 'w')
 
-for line in insam:
-    # Comment/header lines start with @
-    if line[0] != "@" and len(line.strip().split()) > 2:
-        line2 = line.strip().split()
-        # Handle TAG:
-        # get the final concatenatd tag
-        tag = line2[-1]
-        if (tag[0:6] in ['1:N:0:', '2:N:0:']):
-            tsplit = tag.split(":", 4)
-            tsplit2 = tsplit[4].split("_")
-            if len(tsplit2) != 5:
-                sys.stderr.write("SAMCONCAT\tERROR\tsam file has concatenated info, but its the wrong size")
-                sys.exit(1)
-            # fixed barcode
-            line2 = line2[0:-1]
-            line2.extend(["ST:Z:" + tsplit2[0],
-                          "BX:Z:" + line2[0].split(":")[0] + "-1",
-                          "BC:Z:" + tsplit[3],
-                          "QT:Z:" + '!' * len(tsplit[3]),
-                          "RX:Z:" + tsplit2[1],
-                          "QX:Z:" + tsplit2[2],
-                          "TR:Z:" + tsplit2[3],
-                          "TQ:Z:" + tsplit2[4]])
-            out.write('\t'.join(line2) + '\n')
-        else:   # Does not contain a concatenated tag as expected by bwa mem
-            out.write('\t'.join(line2) + '\n')
-    else:  # Its the header lines, so just put back on the stream/file
-        out.write(line)
+if args.sort:
+    sorter = ExternalBarcodeSort(parse_memory(args.sort_mem), args.tmpdir, args.sort_threads, args.sort_fanin, verbose=args.verbose)
+else:
+    sorter = None
+
+if args.molecules:
+    molecules = MoleculeTagger(args.mol_gap, args.mol_mapq)
+else:
+    molecules = None
+
+# records tagged and written, for --metrics
+nrecords = 0
+nwritten = 0
+if args.metrics is not None:
+    metrics = RunMetrics(args.metrics, 'samconcat', lambda: {'reads': nrecords,
+                                                             'reads_out': nwritten if sorter is not None else nrecords,
+                                                             'queues': {'sort_buffer': len(sorter.buffer), 'sort_runs': len(sorter.runs)} if sorter is not None else {},
+                                                             'input': progress.values()},
+                         args.metrics_interval, base)
+else:
+    metrics = None
+
+try:
+    for line in insam:
+        # Comment/header lines start with @
+        if line[0] != "@" and len(line.strip().split()) > 2:
+            nrecords += 1
+            if metrics is not None and nrecords % 1000 == 0:
+                metrics.tick()
+            line = concat2tag(line)
+            if molecules is not None:
+                line = molecules.tag(line)
+            if sorter is None:
+                out.write(line)
+            else:
+                sorter.add(line)
+        elif sorter is not None and line[0:3] == "@HD":
+            out.write(sorted_header(line))
+        else:  # Its the header lines, so just put back on the stream/file
+            out.write(line)
+
+    if molecules is not None and args.verbose:
+        sys.stderr.write("SAMCONCAT\tMOLECULES\tassigned %i reads to %i molecules\n" % (molecules.mcount, molecules.molecules))
 
+    if sorter is not None:
+        for line in sorter.sorted_lines():
+            out.write(line)
+            nwritten += 1
+            if metrics is not None and nwritten % 1000 == 0:
+                metrics.tick()
+        if args.verbose:
+            sys.stderr.write("SAMCONCAT\tSORT\tsorted %i records\n" % sorter.mcount)
+    if metrics is not None:
+        metrics.finish()
+except BaseException:
+    if metrics is not None:
+        metrics.finish('failed')
+    raise
+finally:
+    if sorter is not None:
+        sorter.cleanup()
 
 if base is not None:
     out.close()
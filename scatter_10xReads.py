@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 Matt Settles
+
+Scatter/gather driver for process_10xReads.py, split a (large) set of 10x
+fastq files into independent tasks, run the tasks as a SLURM array job (or a
+local pool) and gather the per task results into a single output.
+
+    scatter_10xReads.py plan -w WORKDIR -n NTASKS -1 R1 ... -2 R2 ...
+    scatter_10xReads.py run -w WORKDIR [--task I | --local N]
+    scatter_10xReads.py gather -w WORKDIR -o OUTPUT_PREFIX
+
+Tasks are created from whole file pairs (--split files) or from ranges of
+reads within each file pair (--split records). Records splitting costs more,
+the reads are counted first and each task reads (and for gzip decompresses)
+its file pair from the start up to its range, about ntasks/2 extra passes over
+the input, so whole file pairs are used when there are at least ntasks of them.
+Each task runs
+process_10xReads.py with output prefix WORKDIR/task_XXXX, standard error is
+kept in WORKDIR/task_XXXX.log and WORKDIR/task_XXXX.done is written when the
+task completes. gather sums the whitelisted barcode counts and status totals
+of all tasks and concatenates the read files (gzip files can be concatenated).
+"""
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import traceback
+from collections import Counter
+from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
+
+from proc10x.fastqio import sp_gzip_read, sp_gzip_wait
+
+statuses = ['MATCH', 'MISMATCH1', 'AMBIGUOUS', 'UNKNOWN']
+
+read_suffixes = ['_R1_001.fastq.gz', '_R2_001.fastq.gz', '_R1_001.fastq', '_R2_001.fastq']
+
+
+def count_reads(read1):
+    """
+    count the reads in a (gzipped) fastq file
+    """
+    if read1.split(".")[-1] == "gz":
+        # gzip messages kept out of the count, a truncated file is an error not a short count
+        p = sp_gzip_read(read1, stderr=PIPE)
+        f = p.stdout
+    else:
+        p = None
+        f = open(read1, 'r')
+    lines = 0
+    for line in f:
+        lines += 1
+    if p is not None:
+        sp_gzip_wait(p, read1)
+    else:
+        f.close()
+    return lines / 4
+
+
+def task_name(workdir, index):
+    return os.path.join(workdir, "task_%04i" % index)
+
+
+def plan_tasks(read1, read2, ntasks, split, workdir, verbose):
+    """
+    split the read pairs into ntasks tasks, returns the list of tasks
+    """
+    pairs = zip(read1, read2)
+    tasks = []
+    if split == 'files':
+        ntasks = min(ntasks, len(pairs))
+        for i in range(ntasks):
+            tasks.append({'read1': [p[0] for p in pairs[i::ntasks]],
+                          'read2': [p[1] for p in pairs[i::ntasks]],
+                          'skip': 0,
+                          'nreads': None})
+    else:
+        if verbose and any(r1.split(".")[-1] == "gz" for r1 in read1):
+            sys.stderr.write("SCATTER\tPLAN\tsplitting gzipped files by records, each task decompresses its file pair up to its range\n")
+        # count the reads of every pair, in parallel
+        pool = ThreadPool(min(len(read1), 8))
+        counts = pool.map(count_reads, read1)
+        pool.close()
+        if verbose:
+            for r1, count in zip(read1, counts):
+                sys.stderr.write("SCATTER\tPLAN\t%s: %i reads\n" % (r1, count))
+        chunk = max(1, -(-sum(counts) // ntasks))  # ceiling
+        for (r1, r2), count in zip(pairs, counts):
+            for skip in range(0, count, chunk):
+                tasks.append({'read1': [r1],
+                              'read2': [r2],
+                              'skip': skip,
+                              'nreads': min(chunk, count - skip)})
+    for i, task in enumerate(tasks):
+        task['task'] = i
+        task['output'] = task_name(workdir, i)
+    return tasks
+
+
+def task_command(plan, task):
+    cmd = [sys.executable, os.path.join(file_path, 'process_10xReads.py'), '-o', task['output']] + plan['process_args']
+    if task['skip'] > 0:
+        cmd += ['--skip', str(task['skip'])]
+    if task['nreads'] is not None:
+        cmd += ['--nreads', str(task['nreads'])]
+    if plan.get('metrics') is not None:
+        cmd += ['--metrics', task['output'] + '_metrics.' + plan['metrics']]
+    return cmd + ['-1'] + task['read1'] + ['-2'] + task['read2']
+
+
+def run_task(args):
+    """
+    run a single task, stderr of process_10xReads.py is written to the tasks log file
+    """
+    plan, index, verbose = args
+    task = plan['tasks'][index]
+    if os.path.isfile(task['output'] + '.done'):
+        os.remove(task['output'] + '.done')
+    stime = time.time()
+    with open(task['output'] + '.log', 'w') as log:
+        rc = Popen(task_command(plan, task), stderr=log).wait()
+    if rc == 0:
+        open(task['output'] + '.done', 'w').close()
+    if verbose:
+        sys.stderr.write("SCATTER\tRUN\ttask %i %s in %i seconds\n" % (index, "finished" if rc == 0 else "FAILED (see %s.log)" % task['output'], round(time.time() - stime)))
+    return rc
+
+
+def read_status(logfile):
+    """
+    parse the PROCESS READS/BARCODE lines of a task log
+    """
+    totals = Counter()
+    with open(logfile, 'r') as f:
+        for line in f:
+            line2 = line.strip().split('\t')
+            if len(line2) < 3 or line2[0] != 'PROCESS':
+                continue
+            if line2[1] == 'BARCODE':
+                status, count = line2[2].split(' ')[:2]
+                totals[status.rstrip(':')] += int(count)
+            elif line2[1] == 'FILES' and line2[2].startswith('Wrote '):
+                totals['written'] += int(line2[2].split(' ')[1])
+    totals['reads'] = sum(totals[s] for s in statuses)
+    return totals
+
+
+def main_plan(options):
+    if options.read1 is None or options.read2 is None or len(options.read1) != len(options.read2):
+        sys.stderr.write("SCATTER\tERROR\tRead 1 and read 2 files are required, and must be in pairs\n")
+        sys.exit(1)
+    if not os.path.isdir(options.workdir):
+        os.makedirs(options.workdir)
+    process_args = []
+    if options.output_all:
+        process_args.append('-a')
+    if options.interleaved:
+        process_args.append('-i')
+    if options.nogzip:
+        process_args.append('-g')
+    if options.compress_level is not None:
+        process_args += ['--compress-level', str(options.compress_level)]
+    process_args += ['-b', str(options.bctrim), '-t', str(options.trim)]
+    read1 = [os.path.abspath(r) for r in options.read1]
+    read2 = [os.path.abspath(r) for r in options.read2]
+    if options.split == 'records' and len(read1) >= options.ntasks:
+        # every task skips through its file pair up to its range, whole pairs avoid that
+        if options.verbose:
+            sys.stderr.write("SCATTER\tPLAN\t%i file pairs for %i tasks, splitting by files\n" % (len(read1), options.ntasks))
+        options.split = 'files'
+    tasks = plan_tasks(read1, read2, options.ntasks, options.split, os.path.abspath(options.workdir), options.verbose)
+    plan = {'version': version_num,
+            'split': options.split,
+            'process_args': process_args,
+            'metrics': options.metrics,
+            'tasks': tasks}
+    with open(os.path.join(options.workdir, 'plan.json'), 'w') as f:
+        json.dump(plan, f, indent=1)
+    if options.verbose:
+        sys.stderr.write("SCATTER\tPLAN\t%i tasks written to %s\n" % (len(tasks), os.path.join(options.workdir, 'plan.json')))
+        sys.stderr.write("SCATTER\tPLAN\tsbatch --array=0-%i --export=ALL,WORKDIR=%s scatter_10xReads.slurm\n" % (len(tasks) - 1, options.workdir))
+
+
+def main_run(options):
+    with open(os.path.join(options.workdir, 'plan.json'), 'r') as f:
+        plan = json.load(f)
+    if options.local is not None:
+        todo = [i for i in range(len(plan['tasks'])) if not os.path.isfile(plan['tasks'][i]['output'] + '.done')]
+        if options.verbose:
+            sys.stderr.write("SCATTER\tRUN\t%i of %i tasks to run, %i at a time\n" % (len(todo), len(plan['tasks']), options.local))
+        pool = ThreadPool(options.local)
+        rcs = pool.map(run_task, [(plan, i, options.verbose) for i in todo])
+        pool.close()
+        if sum(rc != 0 for rc in rcs) > 0:
+            sys.stderr.write("SCATTER\tERROR\t%i tasks failed\n" % sum(rc != 0 for rc in rcs))
+            sys.exit(1)
+        return
+    index = options.task
+    if index is None:
+        if 'SLURM_ARRAY_TASK_ID' not in os.environ:
+            sys.stderr.write("SCATTER\tERROR\tno task given, use --task, --local or run as a SLURM array job\n")
+            sys.exit(1)
+        index = int(os.environ['SLURM_ARRAY_TASK_ID'])
+    if index < 0 or index >= len(plan['tasks']):
+        sys.stderr.write("SCATTER\tERROR\ttask %i is not in the plan (%i tasks)\n" % (index, len(plan['tasks'])))
+        sys.exit(1)
+    if run_task((plan, index, options.verbose)) != 0:
+        sys.exit(1)
+
+
+def main_gather(options):
+    with open(os.path.join(options.workdir, 'plan.json'), 'r') as f:
+        plan = json.load(f)
+    tasks = plan['tasks']
+    missing = [task['task'] for task in tasks if not os.path.isfile(task['output'] + '.done')]
+    if len(missing) > 0:
+        sys.stderr.write("SCATTER\tERROR\ttasks not complete: %s\n" % ','.join(str(m) for m in missing))
+        sys.exit(1)
+
+    # whitelisted barcode counts
+    gbcCounter = Counter()
+    for task in tasks:
+        with open(task['output'] + '_barcodes.txt', 'r') as f:
+            for line in f:
+                bc, count = line.rstrip('\n').split('\t')
+                gbcCounter[bc] += int(count)
+    with open(options.output + '_barcodes.txt', 'w') as f:
+        for bc in sorted(gbcCounter):
+            f.write('{0}\t{1}\n'.format(bc, gbcCounter[bc]))
+
+    # status totals
+    totals = Counter()
+    for task in tasks:
+        totals.update(read_status(task['output'] + '.log'))
+
+    # concatenate the reads
+    if options.concat:
+        for suffix in read_suffixes:
+            if not os.path.isfile(tasks[0]['output'] + suffix):
+                continue
+            with open(options.output + suffix, 'wb') as out:
+                for task in tasks:
+                    with open(task['output'] + suffix, 'rb') as f:
+                        shutil.copyfileobj(f, out, 4 * 1024 * 1024)
+            if options.verbose:
+                sys.stderr.write("SCATTER\tFILES\tWrote %s\n" % (options.output + suffix))
+
+    if options.clean:
+        for task in tasks:
+            for suffix in read_suffixes + ['_barcodes.txt', '.log', '.done', '_metrics.json', '_metrics.prom']:
+                if os.path.isfile(task['output'] + suffix) and (options.concat or suffix not in read_suffixes):
+                    os.remove(task['output'] + suffix)
+
+    if options.verbose:
+        reads = max(totals['reads'], 1)
+        sys.stderr.write("SCATTER\tREADS\ttasks:%i|reads analyzed:%i|reads written:%i|barcodes:%i\n" % (len(tasks), totals['reads'], totals['written'], len(gbcCounter)))
+        for status in statuses:
+            sys.stderr.write("SCATTER\tBARCODE\t%s: %i (%.2f%%)\n" % (status, totals[status], (float(totals[status]) / reads) * 100))
+
+
+#####################################
+# Parse options and setup #
+version_num = "0.0.1"
+parser = argparse.ArgumentParser(description='scatter_10xReads.py, to run process_10xReads.py over many nodes, as planned tasks of file pairs or read ranges',
+                                 epilog='For questions or comments, please contact Matt Settles <settles@ucdavis.edu>\n%(prog)s version: ' + version_num, add_help=True)
+parser.add_argument('--version', action='version', version="%(prog)s version: " + version_num)
+
+subparsers = parser.add_subparsers(dest='command')
+
+# plan
+plan_parser = subparsers.add_parser('plan', help='split the input into tasks, and write WORKDIR/plan.json')
+
+plan_parser.add_argument('-w', '--workdir', help="working directory for the plan and task outputs [default: %(default)s]",
+                         action="store", type=str, dest="workdir", default="scatter")
+
+plan_parser.add_argument('-n', '--ntasks', help="number of tasks [default: %(default)s]",
+                         type=int, dest="ntasks", default=10)
+
+plan_parser.add_argument('-s', '--split', help="split by whole file pairs, or ranges of reads in each file pair, records requires counting the reads and each task reads its file pair up to its range (files is used when there are at least NTASKS file pairs) [default: %(default)s]",
+                         choices=['files', 'records'], dest="split", default="files")
+
+plan_parser.add_argument('-a', '--all', help="process_10xReads.py output all reads [default: %(default)s]",
+                         action="store_true", dest="output_all", default=False)
+
+plan_parser.add_argument('-i', help="process_10xReads.py output in interleaved format [default: %(default)s]",
+                         action="store_true", dest="interleaved", default=False)
+
+plan_parser.add_argument('-b', '--bctrim', help='process_10xReads.py trim gem barcode [default: %(default)s]',
+                         type=int, dest="bctrim", default=16)
+
+plan_parser.add_argument('-t', '--trim', help="process_10xReads.py trim addional bases after the gem barcode [default: %(default)s]",
+                         type=int, dest="trim", default=7)
+
+plan_parser.add_argument('-g', '--nogzip', help="process_10xReads.py do not gzip the output",
+                         action="store_true", dest="nogzip", default=False)
+
+plan_parser.add_argument('--compress-level', help="process_10xReads.py gzip compression level of the output, 1 (fastest) to 9 (smallest) [default: gzip's 6]",
+                         type=int, dest="compress_level", default=None)
+
+plan_parser.add_argument('--metrics', help="each task writes process_10xReads.py --metrics to WORKDIR/task_XXXX_metrics.json (or .prom) [default: none]",
+                         action="store", type=str, dest="metrics", choices=['json', 'prom'], default=None)
+
+plan_parser.add_argument('--quiet', help="turn off verbose output",
+                         action="store_false", dest="verbose", default=True)
+
+group = plan_parser.add_argument_group("Inputs", "10x fastq files to input (can be gz).")
+
+group.add_argument('-1', '--read1', metavar="read1", dest='read1', help='read1 of a pair, multiple files can be specified',
+                   action='store', type=str, nargs='+')
+
+group.add_argument('-2', '--read2', metavar="read2", dest='read2', help='read2 of a pair, multiple files can be specified',
+                   action='store', type=str, nargs='+')
+
+# run
+run_parser = subparsers.add_parser('run', help='run a task of the plan, by index, SLURM_ARRAY_TASK_ID or all of them in a local pool')
+
+run_parser.add_argument('-w', '--workdir', help="working directory of the plan [default: %(default)s]",
+                        action="store", type=str, dest="workdir", default="scatter")
+
+run_parser.add_argument('--task', help="index of the task to run [default: SLURM_ARRAY_TASK_ID]",
+                        type=int, dest="task", default=None)
+
+run_parser.add_argument('--local', help="run all (not yet completed) tasks locally, N at a time",
+                        type=int, dest="local", default=None)
+
+run_parser.add_argument('--quiet', help="turn off verbose output",
+                        action="store_false", dest="verbose", default=True)
+
+# gather
+gather_parser = subparsers.add_parser('gather', help='merge barcode counts and status totals, and concatenate the task outputs')
+
+gather_parser.add_argument('-w', '--workdir', help="working directory of the plan [default: %(default)s]",
+                           action="store", type=str, dest="workdir", default="scatter")
+
+gather_parser.add_argument('-o', '--output', help="Directory + prefix to output reads and barcodes, [default: %(default)s]",
+                           action="store", type=str, dest="output", default="scatter_out")
+
+gather_parser.add_argument('--noconcat', help="do not concatenate the task reads, only merge counts",
+                           action="store_false", dest="concat", default=True)
+
+gather_parser.add_argument('--clean', help="remove the task outputs after gathering [default: %(default)s]",
+                           action="store_true", dest="clean", default=False)
+
+gather_parser.add_argument('--quiet', help="turn off verbose output",
+                           action="store_false", dest="verbose", default=True)
+
+options = parser.parse_args()
+
+file_path = os.path.dirname(os.path.realpath(__file__))
+
+try:
+    if options.command == 'plan':
+        main_plan(options)
+    elif options.command == 'run':
+        main_run(options)
+    else:
+        main_gather(options)
+except (KeyboardInterrupt, SystemExit):
+    raise
+except Exception:
+    sys.stderr.write("".join(traceback.format_exception(*sys.exc_info())))
+    sys.exit("SCATTER\tERROR\tAn unknown fatal error was encountered.\n")
+
+sys.exit(0)
@@ -0,0 +1,87 @@
+"""
+Copyright 2018 Matt Settles
+
+Tests of the stage timing (process_10xReads.py -p), run with python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from proc10x import timing
+from proc10x.timing import StageTimer, TimedWriter, stages
+
+
+class Clock:
+    """
+    fake time.time, advanced by the simulated work
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class BlockingFile:
+    """
+    output file whose writes block for a fixed time, like a full gzip pipe
+    """
+    def __init__(self, clock, seconds):
+        self.clock = clock
+        self.seconds = seconds
+
+    def write(self, data):
+        self.clock.advance(self.seconds)
+
+    def flush(self):
+        pass
+
+
+class StageTimerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.real_time = timing.time
+        timing.time = self.clock
+
+    def tearDown(self):
+        timing.time = self.real_time
+
+    def run_reads(self, every, nreads):
+        """
+        simulate processing nreads reads, each stage taking 1us, the output flushed (blocking
+        for 5ms) every 100 reads, returns the timer and the wall time
+        """
+        timer = StageTimer(every)
+        out = TimedWriter(BlockingFile(self.clock, 0.005), timer, bufsize=100)
+        start = self.clock.time()
+        for count in range(nreads):
+            prof = timer.sample(count)
+            for stage in stages:
+                self.clock.advance(1e-6)
+                if stage == 'write':
+                    out.write('x')
+                if prof is not None:
+                    prof.lap(stage)
+        return timer, self.clock.time() - start
+
+    def test_stages_within_wall(self):
+        for every in (1, 7, 10, 100):
+            timer, wall = self.run_reads(every, 10000)
+            total = sum(timer.estimate(stage) for stage in stages) + timer.blocked
+            self.assertTrue(total <= wall * 1.0001, "every %i: stages and blocked %.4f > wall %.4f" % (every, total, wall))
+
+    def test_write_excludes_blocked(self):
+        for every in (1, 10, 100):
+            timer, wall = self.run_reads(every, 10000)
+            self.assertAlmostEqual(timer.estimate('write'), 10000 * 1e-6, places=6)
+            self.assertAlmostEqual(timer.blocked, 100 * 0.005, places=6)
+
+
+if __name__ == '__main__':
+    unittest.main()